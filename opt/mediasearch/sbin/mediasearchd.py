@@ -14,6 +14,8 @@ WEB_ADDRESS = 'localhost'
 WEB_PORT = 9020
 WEB_USER = 'www-data'
 WEB_GROUP = 'www-data'
+WEB_WORKERS = 0
+WEB_MAX_REQUESTS = 10000
 
 LOG_LEVEL = logging.WARNING
 TO_DAEMONIZE = False
@@ -22,6 +24,17 @@ PID_PATH = ''
 LOG_PATH = ''
 LOCK_PATH = ''
 
+INDEX_ENGINE = None
+INDEX_WHOLE = False
+HASH_WORKERS = 0
+HASH_CACHE_SIZE = None
+LINKS_LAYOUT = None
+JOB_WORKERS = None
+COMPARE_GATE = None
+COMPARE_VERIFY = False
+FETCH_HOST_CONNECTIONS = None
+FETCH_HOST_RATE = None
+
 HOME_DIR = '/tmp'
 LOG_SERVER_NAME = 'mediasearchd'
 IMPORT_DIRS = ['/opt/mediasearch/lib', '/opt/mediasearch/local/site-packages', '/opt/mediasearch/local/dist-packages']
@@ -34,6 +47,8 @@ parser.add_argument('-a', '--web_address', help='web address to listen at')
 parser.add_argument('-p', '--web_port', help='web port to listen at', type=int, default=WEB_PORT)
 parser.add_argument('-u', '--web_user', help='web server user')
 parser.add_argument('-g', '--web_group', help='web server group')
+parser.add_argument('-f', '--web_workers', help='count of pre-forked web server processes, zero for the single-process development server', type=int)
+parser.add_argument('-r', '--max_requests', help='count of requests a web server process serves before being replaced, zero for no limit', type=int)
 
 parser.add_argument('-v', '--verbose', help='increase log verbosity', action='store_true')
 parser.add_argument('-d', '--daemonize', help='daemonize the server', action='store_true')
@@ -42,6 +57,17 @@ parser.add_argument('-i', '--pid_path', help='pid file path')
 parser.add_argument('-l', '--log_path', help='log file path')
 parser.add_argument('-k', '--lock_path', help='lock file path')
 
+parser.add_argument('-e', '--index_engine', help='hash index engine for similarity comparisons; mih serves the thresholds it can prune, the others are scanned linearly', choices=['linear', 'mih'])
+parser.add_argument('-w', '--index_whole', help='compare against whole feeds, not just the latest limit count', action='store_true')
+parser.add_argument('-x', '--hash_workers', help='count of worker processes for media hashing, zero for hashing in the server threads', type=int)
+parser.add_argument('-c', '--hash_cache', help='count of cached media hashes, zero to disable the cache', type=int)
+parser.add_argument('-y', '--links_layout', help='where new archives keep similarity links: embedded arrays, or an edges collection', choices=['embedded', 'edges'])
+parser.add_argument('-q', '--compare_gate', help='hash compared first, other hashes compared just for media within the bound (in bits), e.g. image_dhash 8 24; media similar at other hashes but beyond the bound are missed', nargs=3, metavar=('METHOD', 'DIM', 'BOUND'))
+parser.add_argument('-o', '--compare_verify', help='run the full comparison along the gated one, logging media missed by the gate', action='store_true')
+parser.add_argument('-m', '--fetch_host_connections', help='count of concurrent media fetches from a single host (per web server process)', type=int)
+parser.add_argument('-t', '--fetch_host_rate', help='count of media fetches from a single host per second (per web server process), zero for no limit', type=float)
+parser.add_argument('-j', '--job_workers', help='count of threads (per web server process) running asynchronous inserts, zero for none', type=int)
+
 parser.add_argument('-s', '--install_dir', help='installation directory', default='/opt/mediasearch/')
 
 args = parser.parse_args()
@@ -59,6 +85,10 @@ if args.web_user:
     WEB_USER = args.web_user
 if args.web_group:
     WEB_GROUP = args.web_group
+if args.web_workers:
+    WEB_WORKERS = int(args.web_workers)
+if args.max_requests is not None:
+    WEB_MAX_REQUESTS = int(args.max_requests)
 
 if args.verbose:
     LOG_LEVEL = logging.INFO
@@ -72,6 +102,27 @@ if args.log_path:
 if args.lock_path:
     LOCK_PATH = args.lock_path
 
+if args.index_engine:
+    INDEX_ENGINE = args.index_engine
+if args.index_whole:
+    INDEX_WHOLE = True
+if args.hash_workers:
+    HASH_WORKERS = int(args.hash_workers)
+if args.hash_cache is not None:
+    HASH_CACHE_SIZE = int(args.hash_cache)
+if args.links_layout:
+    LINKS_LAYOUT = args.links_layout
+if args.compare_gate:
+    COMPARE_GATE = args.compare_gate
+if args.compare_verify:
+    COMPARE_VERIFY = True
+if args.job_workers is not None:
+    JOB_WORKERS = int(args.job_workers)
+if args.fetch_host_connections is not None:
+    FETCH_HOST_CONNECTIONS = int(args.fetch_host_connections)
+if args.fetch_host_rate is not None:
+    FETCH_HOST_RATE = float(args.fetch_host_rate)
+
 install_dir = '/'
 if args.install_dir:
     install_dir = args.install_dir
@@ -174,6 +225,13 @@ def cleanup():
 
     logging.info('stopping the ' + LOG_SERVER_NAME + ' web server')
 
+    # insert jobs run by this process are finished before the exit
+    try:
+        from mediasearch.plugin.jobs import insert_jobs
+        insert_jobs.stop()
+    except Exception:
+        pass
+
     pid_path = PID_PATH
     if pid_path:
         try:
@@ -196,12 +254,18 @@ def exit_handler(signum, frame):
 
     cleanup()
 
-def run_server(dbname, web_address, web_port, lock_file, to_debug):
+def run_server(dbname, web_address, web_port, lock_file, to_debug, web_workers=0, max_requests=WEB_MAX_REQUESTS, **setup_options):
 
     logging.info('starting the ' + LOG_SERVER_NAME + ' web server')
 
+    if web_workers:
+        from mediasearch.app.run import run_prefork
+        # the pre-fork master takes SIGTERM/SIGINT/SIGHUP, and returns after stopping its workers
+        run_prefork(dbname, web_address, web_port, lock_file, web_workers, max_requests, **setup_options)
+        return
+
     from mediasearch.app.run import run_flask
-    run_flask(dbname, web_address, web_port, lock_file, to_debug)
+    run_flask(dbname, web_address, web_port, lock_file, to_debug, **setup_options)
 
 if __name__ == "__main__":
     atexit.register(cleanup)
@@ -238,7 +302,19 @@ if __name__ == "__main__":
             sys.path.insert(0, imp_dir)
 
     try:
-        run_server(MEDIASEARCH_DBNAME, WEB_ADDRESS, WEB_PORT, LOCK_PATH, MEDIASEARCH_DEBUG)
+        setup_options = {
+            'index_engine': INDEX_ENGINE,
+            'index_whole': INDEX_WHOLE,
+            'hash_worker_count': HASH_WORKERS,
+            'hash_cache_size': HASH_CACHE_SIZE,
+            'links_layout': LINKS_LAYOUT,
+            'job_worker_count': JOB_WORKERS,
+            'compare_gate': COMPARE_GATE,
+            'compare_verify': COMPARE_VERIFY,
+            'fetch_host_connections': FETCH_HOST_CONNECTIONS,
+            'fetch_host_rate': FETCH_HOST_RATE
+        }
+        run_server(MEDIASEARCH_DBNAME, WEB_ADDRESS, WEB_PORT, LOCK_PATH, MEDIASEARCH_DEBUG, WEB_WORKERS, WEB_MAX_REQUESTS, **setup_options)
     except Exception as exc:
         logging.error('can not start the ' + LOG_SERVER_NAME + ' web server: ' + str(exc))
         sys.exit(1)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Resident index of packed media hashes, for the insert-time comparisons
+#
+
+import bisect, binascii, threading, time
+import numpy
+from mediasearch.algs.mihash import MultiIndexHash, chunk_bounds_for, candidate_share
+
+ENGINE_LINEAR = 'linear'
+ENGINE_MIH = 'mih'
+INDEX_ENGINES = [ENGINE_LINEAR, ENGINE_MIH]
+WORD_BYTES = 8
+INITIAL_CAPACITY = 64
+COMPACT_DEAD_SHARE = 4
+MIH_MAX_SHARE = 0.02
+POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+def packed_from_hex(hexstr):
+    try:
+        return binascii.unhexlify(str(hexstr))
+    except:
+        return None
+
+def packed_to_key(packed):
+    if not packed:
+        return None
+    return int(binascii.hexlify(packed), 16)
+
+def packed_to_words(packed):
+    if not packed:
+        return None
+    pad = (-len(packed)) % WORD_BYTES
+    if pad:
+        packed = packed + (b'\x00' * pad)
+    return numpy.frombuffer(packed, dtype=numpy.uint64).copy()
+
+def words_distances(block, words):
+    '''
+    Hamming distances of the query words against every row of the block:
+    xor over the whole block, popcount by a byte lookup table
+    '''
+    if not len(block):
+        return numpy.zeros(0, dtype=numpy.intp)
+    xored = numpy.bitwise_xor(block, words)
+    xored_bytes = xored.view(numpy.uint8).reshape((xored.shape[0], -1))
+    return POPCOUNT_TABLE[xored_bytes].sum(axis=1, dtype=numpy.intp)
+
+def hash_key(method, dim):
+    return str(method) + '-' + str(dim)
+
+class FeedHashes(object):
+    '''
+    Hashes of a single feed of an archive, rows kept in the created_on order;
+    a contiguous uint64 block per (method, dim), with the validity mask
+    for media that lack the respective hash;
+    with the mih engine, a multi-index per (method, dim) serves the range queries, made at the first query
+    for its radius; radii with more than MIH_MAX_SHARE of the rows expected as candidates are served
+    by the linear scan, as the default lims of a quarter of the hash bits, where the multi-index is slower;
+    depth of None means the whole feed is held;
+    synced_on is the created_on the db was read up to, removed_count the archive removals known then;
+    removed rows are just marked dead, and rows appended out of the created_on order
+    are put at the end; both are settled by a compaction before the next read
+    '''
+    def __init__(self, depth, engine=ENGINE_LINEAR):
+        self.lock = threading.RLock()
+        self.depth = depth
+        self.engine = engine
+        self.searchers = {}
+        self.complete = False
+        self.loaded_on = time.time()
+        self.synced_on = None
+        self.removed_count = None
+        self.outdated = False
+        self.refs = []
+        self.times = []
+        self.positions = {}
+        self.blocks = {}
+        self.valid = {}
+        self.live = numpy.zeros(0, dtype=bool)
+        self.capacity = 0
+        self.dead_count = 0
+        self.disordered = False
+
+    def size(self):
+        return len(self.positions)
+
+    def has_ref(self, ref):
+        return ref in self.positions
+
+    def is_short(self, depth):
+        # holding less than the depth asks for, thus to be reloaded before use
+        if (self.depth is not None) and ((depth is None) or (depth > self.depth)):
+            return True
+        if (not self.complete) and (depth is not None) and (self.size() < depth):
+            return True
+        return False
+
+    def is_stale(self, max_age):
+        return (time.time() - self.loaded_on) > max_age
+
+    def _grow(self, need):
+        if need <= self.capacity:
+            return
+        capacity = max(INITIAL_CAPACITY, self.capacity)
+        while capacity < need:
+            capacity *= 2
+        rows = len(self.refs)
+        for key in self.blocks:
+            block = numpy.zeros((capacity, self.blocks[key].shape[1]), dtype=numpy.uint64)
+            block[:rows] = self.blocks[key][:rows]
+            self.blocks[key] = block
+            valid = numpy.zeros(capacity, dtype=bool)
+            valid[:rows] = self.valid[key][:rows]
+            self.valid[key] = valid
+        live = numpy.zeros(capacity, dtype=bool)
+        live[:rows] = self.live[:rows]
+        self.live = live
+        self.capacity = capacity
+
+    def _compact(self, keep=None):
+        # live rows put into the created_on order, dead rows dropped; just the keep latest rows held if set
+        rows = len(self.refs)
+        kept_rows = numpy.nonzero(self.live[:rows])[0]
+        if self.disordered:
+            order = sorted(range(len(kept_rows)), key=lambda rank: self.times[kept_rows[rank]])
+            kept_rows = kept_rows[numpy.array(order, dtype=numpy.intp)]
+        if (keep is not None) and (len(kept_rows) > keep):
+            for row in kept_rows[:len(kept_rows) - keep]:
+                del(self.positions[self.refs[row]])
+                for key in self.searchers:
+                    self.searchers[key].remove(self.refs[row])
+            kept_rows = kept_rows[len(kept_rows) - keep:]
+
+        count = len(kept_rows)
+        for key in self.blocks:
+            self.blocks[key][:count] = self.blocks[key][kept_rows]
+            self.valid[key][:count] = self.valid[key][kept_rows]
+            self.valid[key][count:rows] = False
+        self.live[:count] = True
+        self.live[count:rows] = False
+
+        self.refs = [self.refs[row] for row in kept_rows]
+        self.times = [self.times[row] for row in kept_rows]
+        self.positions = dict(zip(self.refs, range(count)))
+        self.dead_count = 0
+        self.disordered = False
+
+    def _settle(self):
+        if self.disordered or (self.dead_count > max(INITIAL_CAPACITY, len(self.refs) // COMPACT_DEAD_SHARE)):
+            self._compact()
+
+    def append(self, ref, timepoint, hashes):
+        # hashes: list of {method, dim, packed}
+        with self.lock:
+            if ref in self.positions:
+                return False
+
+            row_words = {}
+            for one_hash in hashes:
+                key = hash_key(one_hash['method'], one_hash['dim'])
+                if key in row_words:
+                    continue
+                words = packed_to_words(one_hash['packed'])
+                if words is None:
+                    continue
+                if (key in self.blocks) and (self.blocks[key].shape[1] != len(words)):
+                    continue
+                row_words[key] = words
+
+            row = len(self.refs)
+            self._grow(row + 1)
+            for key in row_words:
+                if key not in self.blocks:
+                    self.blocks[key] = numpy.zeros((self.capacity, len(row_words[key])), dtype=numpy.uint64)
+                    self.valid[key] = numpy.zeros(self.capacity, dtype=bool)
+
+            for key in self.blocks:
+                if key in row_words:
+                    self.blocks[key][row] = row_words[key]
+                    self.valid[key][row] = True
+                else:
+                    self.blocks[key][row] = 0
+                    self.valid[key][row] = False
+
+            for key in row_words:
+                if key in self.searchers:
+                    self.searchers[key].add(packed_to_key(row_words[key].tobytes()), ref)
+
+            if self.times and (timepoint < self.times[-1]):
+                self.disordered = True
+            self.live[row] = True
+            self.refs.append(ref)
+            self.times.append(timepoint)
+            self.positions[ref] = row
+
+            return True
+
+    def remove(self, ref):
+        with self.lock:
+            if ref not in self.positions:
+                return False
+
+            row = self.positions[ref]
+            for key in self.blocks:
+                self.valid[key][row] = False
+            self.live[row] = False
+            self.refs[row] = None
+            self.dead_count += 1
+            del(self.positions[ref])
+
+            for key in self.searchers:
+                self.searchers[key].remove(ref)
+
+            return True
+
+    def trim(self, keep):
+        # drops the oldest rows, to hold at most keep rows
+        with self.lock:
+            drop = self.size() - keep
+            if drop <= 0:
+                return 0
+
+            self._compact(keep)
+            self.complete = False
+
+            return drop
+
+    def window(self, upto_timepoint, depth):
+        # rows of the (depth) latest media created up to the timepoint; dead rows within are not valid for any hash
+        with self.lock:
+            self._settle()
+            stop = len(self.refs)
+            if upto_timepoint is not None:
+                stop = bisect.bisect_right(self.times, upto_timepoint)
+            start = 0
+            if depth:
+                start = max(0, stop - depth)
+                if self.dead_count:
+                    live_rows = numpy.nonzero(self.live[:stop])[0]
+                    start = 0
+                    if len(live_rows) > depth:
+                        start = int(live_rows[-depth])
+            return (start, stop)
+
+    def _searcher(self, key, radius):
+        # the multi-index of the (method, dim) hash, None when the linear scan is to be used for the radius
+        if (ENGINE_LINEAR == self.engine) or (key not in self.blocks):
+            return None
+        searcher = self.searchers.get(key)
+        if searcher is not None:
+            if searcher.candidate_share(radius) > MIH_MAX_SHARE:
+                return None
+            return searcher
+
+        bits = self.blocks[key].shape[1] * WORD_BYTES * 8
+        if candidate_share(chunk_bounds_for(bits, radius), radius) > MIH_MAX_SHARE:
+            return None
+        searcher = MultiIndexHash(bits, radius)
+        for row in numpy.nonzero(self.valid[key][:len(self.refs)])[0]:
+            searcher.add(packed_to_key(self.blocks[key][row].tobytes()), self.refs[row])
+        self.searchers[key] = searcher
+        return searcher
+
+    def _scan_rows(self, key, words, start, stop):
+        if (key not in self.blocks) or (words is None) or (self.blocks[key].shape[1] != len(words)):
+            return (None, None)
+        valid = self.valid[key][start:stop]
+        if valid.all():
+            rows = numpy.arange(start, stop)
+            distances = words_distances(self.blocks[key][start:stop], words)
+        else:
+            rows = numpy.nonzero(valid)[0] + start
+            distances = words_distances(self.blocks[key][rows], words)
+        return (rows, distances)
+
+    def scan(self, method, dim, words, start, stop):
+        '''
+        Hamming distances of the query against the window rows that hold the (method, dim) hash
+        returns (refs, distances), empty for unknown hashes or different hash sizes
+        '''
+        with self.lock:
+            rows, distances = self._scan_rows(hash_key(method, dim), words, start, stop)
+            if (rows is None) or (not len(rows)):
+                return ([], [])
+            return ([self.refs[row] for row in rows], distances)
+
+    def search(self, method, dim, words, threshold, start, stop):
+        '''
+        Window rows with the (method, dim) hash within the threshold from the query
+        returns (refs, distances)
+        '''
+        with self.lock:
+            key = hash_key(method, dim)
+            searcher = self._searcher(key, threshold)
+            if searcher is None:
+                rows, distances = self._scan_rows(key, words, start, stop)
+                if (rows is None) or (not len(rows)):
+                    return ([], [])
+                hits = numpy.nonzero(distances <= threshold)[0]
+                return ([self.refs[rows[hit]] for hit in hits], distances[hits])
+
+            if (words is None) or (self.blocks[key].shape[1] != len(words)):
+                return ([], [])
+
+            # the multi-index candidates are checked at the block rows
+            rows = [self.positions[one_ref] for one_ref in searcher.candidates(packed_to_key(words.tobytes()), threshold)]
+            rows = numpy.array(sorted([row for row in rows if start <= row < stop]), dtype=numpy.intp)
+            if not len(rows):
+                return ([], [])
+            distances = words_distances(self.blocks[key][rows], words)
+            hits = numpy.nonzero(distances <= threshold)[0]
+            return ([self.refs[rows[hit]] for hit in hits], distances[hits])
+
+    def nearest(self, queries, count, start, stop):
+        '''
+        The count of window rows closest to the query, by the least relative distance over the query hashes,
+        the most recent first on equal distances
+        queries: list of (method, dim, words, bits), bits for relating the distances to the hash sizes
+        returns list of (ref, least relative distance, [distance per query, None for rows lacking the hash])
+        '''
+        with self.lock:
+            size = stop - start
+            if (size <= 0) or (count <= 0):
+                return []
+
+            least = numpy.empty(size)
+            least.fill(numpy.inf)
+            part_distances = []
+            for method, dim, words, bits in queries:
+                part = numpy.empty(size, dtype=numpy.intp)
+                part.fill(-1)
+                rows, distances = self._scan_rows(hash_key(method, dim), words, start, stop)
+                if (rows is not None) and len(rows):
+                    part[rows - start] = distances
+                    least[rows - start] = numpy.minimum(least[rows - start], distances / float(bits))
+                part_distances.append(part)
+
+            hits = numpy.nonzero(numpy.isfinite(least))[0]
+            if len(hits) > count:
+                bound = numpy.partition(least[hits], count - 1)[count - 1]
+                hits = hits[least[hits] <= bound]
+            hits = hits[numpy.lexsort((-hits, least[hits]))][:count]
+
+            found = []
+            for hit in hits:
+                hit_distances = [(int(part[hit]) if (part[hit] >= 0) else None) for part in part_distances]
+                found.append((self.refs[start + hit], float(least[hit]), hit_distances))
+            return found
+
+    def gate(self, method, dim, words, bound, start, stop):
+        '''
+        Window rows passing a comparison cascade gate: within the bound at the (method, dim) hash,
+        or lacking that hash, thus not to be excluded by it
+        returns sorted rows, None when the gate hash is not comparable
+        '''
+        with self.lock:
+            key = hash_key(method, dim)
+            if (key not in self.blocks) or (words is None) or (self.blocks[key].shape[1] != len(words)):
+                return None
+            refs, distances = self.search(method, dim, words, bound, start, stop)
+            rows = [self.positions[one_ref] for one_ref in refs]
+            valid = self.valid[key][start:stop]
+            if not valid.all():
+                rows.extend(numpy.nonzero(numpy.logical_and(numpy.logical_not(valid), self.live[start:stop]))[0] + start)
+            return numpy.array(sorted(rows), dtype=numpy.intp)
+
+    def search_rows(self, method, dim, words, threshold, rows):
+        '''
+        As search, just over the given (sorted) rows, e.g. those passed through a gate
+        returns (refs, distances)
+        '''
+        with self.lock:
+            key = hash_key(method, dim)
+            if (key not in self.blocks) or (words is None) or (self.blocks[key].shape[1] != len(words)):
+                return ([], [])
+            rows = rows[self.valid[key][rows]]
+            if not len(rows):
+                return ([], [])
+            distances = words_distances(self.blocks[key][rows], words)
+            hits = numpy.nonzero(distances <= threshold)[0]
+            return ([self.refs[rows[hit]] for hit in hits], distances[hits])
+
+class HashIndex(object):
+    def __init__(self, engine=ENGINE_LINEAR):
+        self.lock = threading.RLock()
+        self.engine = engine
+        self.whole_feeds = False
+        self.cascade = None
+        self.cascade_verify = False
+        self.feeds = {}
+        self.reloading = set()
+
+    def set_whole_feeds(self, whole_feeds):
+        # to compare against whole feeds, instead of the latest limit_count media
+        with self.lock:
+            if bool(whole_feeds) != self.whole_feeds:
+                self.whole_feeds = bool(whole_feeds)
+                self.feeds = {}
+        return True
+
+    def set_cascade(self, method, dim, bound):
+        # the cheap (method, dim) hash is compared first, the other hashes just for media within the bound;
+        # media more distant at the gate hash are not found even if similar at other hashes; the bound is
+        # taken as at least the gate lims, and a bound of the whole gate hash finds all that the full comparison does;
+        # as of bench cascade (2000 random media, 40 queries, default lims), an image_dhash 8 gate
+        # misses 4 of the 27 similar media at bounds 16 to 24, 2 at 32 and none from 40 on
+        if method is None:
+            self.cascade = None
+            return True
+        try:
+            self.cascade = (str(method), int(dim), int(bound))
+        except:
+            return False
+        return True
+
+    def get_cascade(self):
+        return self.cascade
+
+    def set_cascade_verify(self, verify):
+        # to run the full comparison along the cascade, counting and logging their differences
+        self.cascade_verify = bool(verify)
+        return True
+
+    def get_cascade_verify(self):
+        return self.cascade_verify
+
+    def get_depth(self, limit_count):
+        if self.whole_feeds:
+            return None
+        return limit_count + 1
+
+    def set_engine(self, engine):
+        if engine not in INDEX_ENGINES:
+            return False
+        with self.lock:
+            if engine != self.engine:
+                self.engine = engine
+                self.feeds = {}
+        return True
+
+    def get_engine(self):
+        return self.engine
+
+    def create_feed(self, depth):
+        return FeedHashes(depth, self.engine)
+
+    def get_feed(self, collection, feed):
+        with self.lock:
+            return self.feeds.get((collection, feed))
+
+    def set_feed(self, collection, feed, feed_hashes):
+        with self.lock:
+            self.feeds[(collection, feed)] = feed_hashes
+
+    def start_reload(self, collection, feed):
+        # just a single reload of a feed at a time
+        with self.lock:
+            if (collection, feed) in self.reloading:
+                return False
+            self.reloading.add((collection, feed))
+            return True
+
+    def finish_reload(self, collection, feed):
+        with self.lock:
+            self.reloading.discard((collection, feed))
+
+    def add_media(self, collection, feed, ref, timepoint, hashes):
+        feed_hashes = self.get_feed(collection, feed)
+        if feed_hashes is None:
+            return False
+        return feed_hashes.append(ref, timepoint, hashes)
+
+    def remove_media(self, collection, feed, ref):
+        feed_hashes = self.get_feed(collection, feed)
+        if feed_hashes is None:
+            return False
+        return feed_hashes.remove(ref)
+
+    def note_removal(self, collection):
+        # a removal made by this process, already applied, is not to reload the feeds of the archive
+        with self.lock:
+            for key in self.feeds:
+                if (key[0] == collection) and (self.feeds[key].removed_count is not None):
+                    self.feeds[key].removed_count += 1
+
+    def drop_collection(self, collection):
+        with self.lock:
+            for key in list(self.feeds.keys()):
+                if key[0] == collection:
+                    del(self.feeds[key])
+
+hash_index = HashIndex()
@@ -3,23 +3,30 @@
 # fork of https://github.com/JohannesBuchner/imagehash
 #
 
-import logging
+import logging, binascii
 import Image
 import numpy
 import scipy.fftpack
 
+def _packbits_lsb(bits):
+    # numpy.packbits with the least significant bit first, as bitorder='little' of numpy 1.17+;
+    # bits of shape (N, 8 * K) into bytes of shape (N, K)
+    return numpy.packbits(bits.reshape((bits.shape[0], -1, 8))[:, :, ::-1], axis=-1).reshape((bits.shape[0], -1))
+
+def _unpackbits_lsb(packed):
+    # bytes of shape (N, K) into bits of shape (N, 8 * K), the least significant bit first
+    return numpy.unpackbits(packed.reshape((packed.shape[0], -1, 1)), axis=-1)[:, :, ::-1].reshape((packed.shape[0], -1))
+
 def binary_array_to_hex(arr):
-    h = 0
-    s = []
-    for i,v in enumerate(arr.flatten()):
-        if v: h += 2**(i % 8)
-        if (i % 8) == 7:
-            s.append(hex(h)[2:].rjust(2, '0'))
-            h = 0
-    return "".join(s)
+    # bit i of byte k is the (8 * k + i)-th flattened value; a trailing partial byte is dropped
+    bits = numpy.asarray(arr, dtype=bool).reshape((1, -1))
+    return str(packed_to_hex(_packbits_lsb(bits[:, :(bits.shape[1] // 8 * 8)])))
 
 def binary_array_to_int(arr):
-    return sum([2**(i % 8) for i,v in enumerate(arr.flatten()) if v])
+    # sum of the byte values, a trailing partial byte included
+    bits = numpy.asarray(arr, dtype=bool).reshape((1, -1))
+    padding = numpy.zeros((1, -bits.shape[1] % 8), dtype=bool)
+    return int(_packbits_lsb(numpy.concatenate([bits, padding], axis=1)).sum(dtype=numpy.int64))
 
 """
 Hash encapsulation. Can be used for dictionary keys and comparisons.
@@ -27,6 +34,8 @@ Hash encapsulation. Can be used for dictionary keys and comparisons.
 class ImageHash(object):
     def __init__(self, binary_array):
         self.hash = binary_array
+        self.hash_bits = None
+        self.hash_value = None
 
     def __str__(self):
         return binary_array_to_hex(self.hash)
@@ -48,17 +57,16 @@ class ImageHash(object):
         return not numpy.array_equal(self.hash, other.hash)
 
     def __hash__(self):
-        return binary_array_to_int(self.hash)
+        # cached along with the bits it was taken of, thus kept right when the array is changed or replaced
+        hash_bits = numpy.asarray(self.hash).tobytes()
+        if hash_bits != self.hash_bits:
+            self.hash_value = binary_array_to_int(self.hash)
+            self.hash_bits = hash_bits
+        return self.hash_value
 
 def hex_to_hash(hexstr):
-    l = []
-    for i in range(len(hexstr) / 2):
-        #for h in hexstr[::2]:
-        h = hexstr[i*2:i*2+2]
-        v = int("0x" + h, 16)
-        for i in range(8):
-            l.append(v & 2**i > 0)
-    return ImageHash(numpy.array(l))
+    packed = numpy.frombuffer(binascii.unhexlify(hexstr[:(len(hexstr) // 2 * 2)]), dtype=numpy.uint8)
+    return ImageHash(_unpackbits_lsb(packed.reshape((1, -1)))[0].astype(bool))
 
 
 """
@@ -102,5 +110,62 @@ def phash(image, hash_size=8):
     except:
         return None
 
-__dir__ = [dhash, phash, ImageHash]
+"""
+Packing of boolean hashes into bytes, in the bit order of binary_array_to_hex:
+bit i of byte k is the (8 * k + i)-th flattened value; a trailing partial byte is dropped.
+@bits is an array of shape (N, ...), for N hashes.
+"""
+def pack_bits(bits):
+    bits = numpy.asarray(bits, dtype=bool).reshape((len(bits), -1))
+    return _packbits_lsb(bits[:, :(bits.shape[1] // 8 * 8)])
+
+def packed_to_hex(packed):
+    return binascii.hexlify(numpy.asarray(packed, dtype=numpy.uint8).tobytes()).decode('ascii')
+
+def _stack_pixels(images, width, height):
+    stack = numpy.empty((len(images), width * height), dtype=numpy.float)
+    for rank, image in enumerate(images):
+        stack[rank] = numpy.array(image.convert("L").resize((width, height), Image.ANTIALIAS).getdata(), dtype=numpy.float)
+    return stack
+
+"""
+Difference Hash computation over a batch of images.
+Gives the same bits as dhash, returns packed hashes as an array of shape (N, hash_size * hash_size / 8).
+@images must be a list of PIL instances.
+"""
+def dhash_batch(images, hash_size=8):
+    if type(hash_size) is not int:
+        return None
+    if hash_size < 2:
+        return None
+    try:
+        pixels = _stack_pixels(images, hash_size + 1, hash_size).reshape((len(images), hash_size + 1, hash_size))
+        diff = pixels[:,1:,:] > pixels[:,:-1,:]
+        return pack_bits(diff)
+    except:
+        return None
+
+"""
+Perceptual Hash computation over a batch of images.
+Gives the same bits as phash, returns packed hashes as an array of shape (N, hash_size * hash_size / 8).
+@images must be a list of PIL instances.
+"""
+def phash_batch(images, hash_size=8):
+    if type(hash_size) is not int:
+        return None
+    if hash_size < 2:
+        return None
+    double_size = 2 * hash_size
+    try:
+        pixels = _stack_pixels(images, double_size, double_size).reshape((len(images), double_size, double_size))
+        dct = scipy.fftpack.dct(pixels)
+        dctlowfreq = dct[:, :hash_size, 1:(1+hash_size)]
+        # per-hash means, summed just as in phash, to give the same bits
+        avg = numpy.array([one_lowfreq.mean() for one_lowfreq in dctlowfreq])
+        diff = dctlowfreq > avg.reshape((len(images), 1, 1))
+        return pack_bits(diff)
+    except:
+        return None
+
+__dir__ = [dhash, phash, dhash_batch, phash_batch, ImageHash]
 
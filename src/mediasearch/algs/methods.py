@@ -4,16 +4,35 @@
 # Performs media hashing, hash storage and (perceptual) similarity search
 #
 
-import sys, os, logging
+import sys, os, logging, binascii, hashlib
 import Image
 from mediasearch.algs import imagehash
 
+HASH_MEDIA_TYPE = 'image'
+
+# JPEG files can be decoded at reduced scale (the DCT scaling of the decoder),
+# down to the nearest scale not smaller than this size; it speeds up decoding of large photos,
+# while the hashes may differ at a few bits (up to 2 of 64 or 256 at our test photos);
+# None means full-scale decoding, exactly matching the hashes of the full images
+JPEG_DRAFT_SIZE = None
+
+# to be raised on changes of how the hashes are computed, for the cached hashes not to be taken then
+HASH_METHODS_VERSION = 1
+HASH_FINGERPRINT_SIZE = 8
+
+def open_gray_image(image_source, draft_size=JPEG_DRAFT_SIZE):
+    image = Image.open(image_source)
+    if draft_size:
+        image.draft('L', (draft_size, draft_size))
+    return image.convert('L')
+
 class MediaHashMethods(object):
     def __init__(self):
         self.hash_methods = {
             'image_phash': {
                 'media': ['image'],
                 'method': lambda x, y, z: imagehash.phash(Image.open(y), z),
+                'hash': lambda x, y: imagehash.phash(x, y),
                 'dist': lambda x, y: (float(x) / (y * y)),
                 'dims': [8, 16],
                 'repr': lambda x: str(imagehash.binary_array_to_hex(x.hash)),
@@ -25,6 +44,7 @@ class MediaHashMethods(object):
             'image_dhash': {
                 'media': ['image'],
                 'method': lambda x, y, z: imagehash.dhash(Image.open(y), z),
+                'hash': lambda x, y: imagehash.dhash(x, y),
                 'dist': lambda x, y: (float(x) / (y * y)),
                 'dims': [8, 16],
                 'repr': lambda x: str(imagehash.binary_array_to_hex(x.hash)),
@@ -38,3 +58,51 @@ class MediaHashMethods(object):
     def get_methods(self):
         return self.hash_methods
 
+    def get_fingerprint(self):
+        '''
+        Short digest of what the hashes are made by: the (method, dim) pairs, the decoding scale and the version
+        '''
+        parts = []
+        for cur_name in sorted(self.hash_methods):
+            for cur_dim in sorted(self.hash_methods[cur_name]['dims']):
+                parts.append(cur_name + '-' + str(cur_dim))
+        parts.append('draft-' + str(JPEG_DRAFT_SIZE))
+        parts.append('version-' + str(HASH_METHODS_VERSION))
+
+        return hashlib.sha1(','.join(parts).encode('ascii')).hexdigest()[:HASH_FINGERPRINT_SIZE]
+
+    def create_hashes(self, image_source, media_class=HASH_MEDIA_TYPE):
+        '''
+        All hashes of the image (a file path or a file object), decoded and turned into grayscale once
+        returns list of {method, dim, packed}, with the hash bytes in the hex representation order
+        '''
+        packed_hashes = []
+
+        try:
+            gray_image = open_gray_image(image_source)
+        except:
+            logging.warning('can not open media file: ' + str(image_source))
+            return packed_hashes
+
+        for cur_name in self.hash_methods:
+            cur_info = self.hash_methods[cur_name]
+            if not media_class in cur_info['media']:
+                continue
+
+            cur_meth = cur_info['hash']
+            cur_flatten = cur_info['repr']
+            for cur_dim in cur_info['dims']:
+                try:
+                    cur_hash = cur_meth(gray_image, cur_dim)
+                    if cur_hash is None:
+                        continue
+                    cur_repr = cur_flatten(cur_hash)
+                    if cur_repr is None:
+                        continue
+                    packed_hashes.append({'method': cur_name, 'dim': cur_dim, 'packed': binascii.unhexlify(cur_repr)})
+                except:
+                    logging.warning('can not create media hash: ' + str(cur_name) + ', dimension: ' + str(cur_dim) + ', on: ' + str(image_source))
+                    continue
+
+        return packed_hashes
+
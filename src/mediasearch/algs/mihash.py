@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Multi-index hashing for Hamming range queries on media hashes
+# following Norouzi, Punjani, Fleet: Fast Search in Hamming Space with Multi-Index Hashing
+#
+
+import itertools
+
+# substrings of up to this size, and as many of them that a query probes them within this radius
+MAX_CHUNK_BITS = 16
+MAX_CHUNK_RADIUS = 2
+
+def chunk_neighbours_count(chunk_bits, radius):
+    count = 0
+    term = 1
+    for flips in range(radius + 1):
+        if flips > chunk_bits:
+            break
+        if flips:
+            term = term * (chunk_bits - flips + 1) // flips
+        count += term
+    return count
+
+def chunk_bounds_for(bits, radius):
+    '''
+    (start, bits) of the substrings; floor(radius / count) is kept within MAX_CHUNK_RADIUS,
+    so that the substring probes stay few
+    '''
+    count = max(bits // MAX_CHUNK_BITS, (radius // (MAX_CHUNK_RADIUS + 1)) + 1)
+    count = max(1, min(bits, count))
+    bounds = []
+    for chunk_rank in range(count):
+        chunk_start = (bits * chunk_rank) // count
+        chunk_stop = (bits * (chunk_rank + 1)) // count
+        bounds.append((chunk_start, chunk_stop - chunk_start))
+    return bounds
+
+def candidate_share(chunk_bounds, radius):
+    '''
+    Expected share of the items taken as candidates, for uniformly spread codes;
+    near to 1 when the radius is too large against the code size to be pruned by substrings
+    '''
+    chunk_radius = radius // len(chunk_bounds)
+    share = 0.0
+    for chunk_start, chunk_bits in chunk_bounds:
+        share += chunk_neighbours_count(chunk_bits, chunk_radius) / float(2 ** chunk_bits)
+    return min(1.0, share)
+
+class MultiIndexHash(object):
+    '''
+    The codes are split into substrings, with a hash table per substring.
+    By the pigeonhole principle, a code within radius r from the query
+    has at least one substring within floor(r / m) from the query substring,
+    for m substrings; the candidates are then checked by the caller.
+    The substring count is set by the radius the index is made for.
+    '''
+    def __init__(self, bits, radius):
+        self.bits = bits
+        self.chunk_bounds = chunk_bounds_for(bits, radius)
+        self.chunk_count = len(self.chunk_bounds)
+        self.tables = [{} for chunk_rank in range(self.chunk_count)]
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidate_share(self, radius):
+        return candidate_share(self.chunk_bounds, radius)
+
+    def _split(self, key):
+        chunks = []
+        for chunk_start, chunk_bits in self.chunk_bounds:
+            chunks.append((key >> chunk_start) & ((1 << chunk_bits) - 1))
+        return chunks
+
+    def add(self, key, item):
+        if key is None:
+            return False
+        if item in self.keys:
+            self.remove(item)
+
+        self.keys[item] = key
+        for table, chunk in zip(self.tables, self._split(key)):
+            if chunk not in table:
+                table[chunk] = set()
+            table[chunk].add(item)
+
+        return True
+
+    def remove(self, item):
+        if item not in self.keys:
+            return False
+
+        key = self.keys[item]
+        del(self.keys[item])
+        for table, chunk in zip(self.tables, self._split(key)):
+            bucket = table.get(chunk)
+            if bucket is None:
+                continue
+            bucket.discard(item)
+            if not bucket:
+                del(table[chunk])
+
+        return True
+
+    def _chunk_candidates(self, table, chunk, chunk_bits, radius, candidates):
+        # either probing all the chunk values within the radius, or going through the occupied buckets
+        if chunk_neighbours_count(chunk_bits, radius) <= len(table):
+            for flips in range(radius + 1):
+                for flip_bits in itertools.combinations(range(chunk_bits), flips):
+                    probe = chunk
+                    for one_bit in flip_bits:
+                        probe ^= (1 << one_bit)
+                    bucket = table.get(probe)
+                    if bucket:
+                        candidates.update(bucket)
+        else:
+            for bucket_chunk, bucket in table.items():
+                if bin(bucket_chunk ^ chunk).count('1') <= radius:
+                    candidates.update(bucket)
+
+    def candidates(self, key, radius):
+        '''
+        returns a superset of the items within the radius from the key
+        '''
+        candidates = set()
+        if key is None:
+            return candidates
+
+        chunk_radius = radius // self.chunk_count
+        for table, chunk, chunk_bound in zip(self.tables, self._split(key), self.chunk_bounds):
+            self._chunk_candidates(table, chunk, chunk_bound[1], chunk_radius, candidates)
+
+        return candidates
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Pre-forking WSGI server for the production use
+#
+# the master process binds the socket and keeps the workers running;
+# workers accept on the shared socket, one request at a time,
+# and are replaced after max_requests served;
+# SIGHUP replaces all workers gracefully, SIGTERM/SIGINT stop the server;
+# a stopping worker finishes its current request and its background work first;
+# the master runs no threads, as it keeps forking, its own background work is polled by its loop
+#
+
+import os, time, errno, fcntl, signal, logging
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+PREFORK_WORKERS = 4
+PREFORK_MAX_REQUESTS = 10000
+PREFORK_LISTEN_QUEUE = 128
+WORKER_POLL = 1.0
+MASTER_POLL = 0.2
+STOP_TIMEOUT = 30
+
+class PreforkRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.info('%s - %s' % (self.address_string(), format % args))
+
+class PreforkWSGIServer(WSGIServer):
+    request_queue_size = PREFORK_LISTEN_QUEUE
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        # workers wait in select; the one that gets the connection accepts it, the others return;
+        # set on the descriptor, since a socket timeout would turn the select waits into polling
+        flags = fcntl.fcntl(self.socket.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(self.socket.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.served = 0
+
+    def get_request(self):
+        conn, client_address = WSGIServer.get_request(self)
+        conn.setblocking(True)
+        return (conn, client_address)
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        WSGIServer.process_request(self, request, client_address)
+
+class PreforkServer(object):
+    def __init__(self, app, host='localhost', port=9020, worker_count=PREFORK_WORKERS, max_requests=PREFORK_MAX_REQUESTS, prepare_worker=None, finish_worker=None, poll_master=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.worker_count = max(1, int(worker_count))
+        self.max_requests = max(0, int(max_requests or 0))
+        self.prepare_worker = prepare_worker
+        self.finish_worker = finish_worker
+        self.poll_master = poll_master
+        self.server = None
+        self.workers = {}
+        self.generation = 0
+        self.running = False
+        self.restarting = False
+        self.stopping = False
+
+    def get_port(self):
+        if self.server is None:
+            return self.port
+        return self.server.server_address[1]
+
+    def bind(self):
+        if self.server is None:
+            self.server = make_server(self.host, self.port, self.app, server_class=PreforkWSGIServer, handler_class=PreforkRequestHandler)
+            self.server.timeout = WORKER_POLL
+        return self.get_port()
+
+    def _on_stop(self, signum, frame):
+        self.running = False
+
+    def _on_restart(self, signum, frame):
+        self.restarting = True
+
+    def _on_worker_stop(self, signum, frame):
+        self.stopping = True
+
+    def _run_worker(self):
+        # the current request is finished on SIGTERM, without interrupted socket calls
+        signal.signal(signal.SIGTERM, self._on_worker_stop)
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        try:
+            if self.prepare_worker:
+                self.prepare_worker()
+        except Exception as exc:
+            logging.error('can not prepare server worker: ' + str(exc))
+            return 1
+
+        while not self.stopping:
+            try:
+                self.server.handle_request()
+            except Exception as exc:
+                logging.warning('server worker request failed: ' + str(exc))
+            if self.max_requests and (self.server.served >= self.max_requests):
+                break
+
+        # background work of the worker, e.g. the running insert jobs, is finished before the exit
+        try:
+            if self.finish_worker:
+                self.finish_worker()
+        except Exception as exc:
+            logging.warning('can not finish server worker: ' + str(exc))
+
+        return 0
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return pid
+
+        # worker exits right here, not to run the master's exit handlers
+        exit_code = 1
+        try:
+            exit_code = self._run_worker()
+        finally:
+            os._exit(exit_code)
+
+    def _spawn_missing(self):
+        current = len([pid for pid in self.workers if self.workers[pid] == self.generation])
+        while current < self.worker_count:
+            try:
+                self._spawn_worker()
+            except OSError as exc:
+                logging.error('can not fork server worker: ' + str(exc))
+                return False
+            current += 1
+        return True
+
+    def _reap_workers(self):
+        # just the server workers, other children of the master (e.g. the hash workers) are waited for by their owners
+        for worker_pid in list(self.workers.keys()):
+            while True:
+                try:
+                    pid, status = os.waitpid(worker_pid, os.WNOHANG)
+                except OSError as exc:
+                    if errno.EINTR == exc.errno:
+                        continue
+                    pid = worker_pid
+                break
+            if pid:
+                self.workers.pop(worker_pid, None)
+
+    def _poll_master(self):
+        try:
+            if self.poll_master:
+                self.poll_master()
+        except Exception as exc:
+            logging.warning('server master poll failed: ' + str(exc))
+
+    def _signal_workers(self, signum, pids=None):
+        if pids is None:
+            pids = list(self.workers.keys())
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _stop_workers(self):
+        self._signal_workers(signal.SIGTERM)
+        stop_till = time.time() + STOP_TIMEOUT
+        while self.workers and (time.time() < stop_till):
+            self._reap_workers()
+            time.sleep(MASTER_POLL)
+        if self.workers:
+            self._signal_workers(signal.SIGKILL)
+            for worker_pid in list(self.workers.keys()):
+                try:
+                    os.waitpid(worker_pid, 0)
+                except OSError:
+                    pass
+                self.workers.pop(worker_pid, None)
+
+    def serve(self):
+        '''
+        Runs the master loop, till SIGTERM/SIGINT
+        '''
+        self.bind()
+        self.running = True
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+
+        logging.info('serving at ' + str(self.host) + ':' + str(self.get_port()) + ' with ' + str(self.worker_count) + ' workers')
+        self._spawn_missing()
+
+        while self.running:
+            if self.restarting:
+                # new workers are started first, the old ones finish their current requests
+                self.restarting = False
+                logging.info('restarting server workers')
+                old_pids = list(self.workers.keys())
+                self.generation += 1
+                self._spawn_missing()
+                self._signal_workers(signal.SIGTERM, old_pids)
+
+            self._reap_workers()
+            self._spawn_missing()
+            self._poll_master()
+            time.sleep(MASTER_POLL)
+
+        logging.info('stopping server workers')
+        self._stop_workers()
+        self.server.server_close()
+        self.server = None
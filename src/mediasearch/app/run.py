@@ -22,18 +22,59 @@ except:
     os._exit(1)
 from mediasearch.utils.dbs import mongo_dbs
 from mediasearch.utils.sync import synchronizer, sync_clean
+from mediasearch.algs.hashindex import hash_index
+from mediasearch.utils.workers import hash_workers
+from mediasearch.utils.fetch import media_fetcher
+from mediasearch.plugin.hashcache import hash_cache, HASH_CACHE_MEMORY_ITEMS
+from mediasearch.plugin.storage import storage_layouts
+from mediasearch.plugin.jobs import insert_jobs
+from mediasearch.plugin.process import run_insert_job
 from mediasearch.plugin.connect import mediasearch_plugin
+from mediasearch.utils.indexes import storage_indexes
+from mediasearch.app.prefork import PreforkServer, PREFORK_WORKERS, PREFORK_MAX_REQUESTS
 
 app = Flask(__name__)
 
-def setup_mediasearch(dbname, lockfile):
-    mongo_dbs.set_dbname(dbname)
+def connect_mongo():
+    # MongoClient is not fork-safe, thus a new one is made in each forked server worker
     DbHolder = namedtuple('DbHolder', 'db')
     mongo_dbs.set_db(DbHolder(db=MongoClient(MONGODB_SERVER_HOST, MONGODB_SERVER_PORT)[mongo_dbs.get_dbname()]))
 
+def setup_mediasearch(dbname, lockfile, index_engine=None, index_whole=False, hash_worker_count=0, hash_cache_size=None, links_layout=None, job_worker_count=None, compare_gate=None, compare_verify=False, fetch_host_connections=None, fetch_host_rate=None):
+    # hash workers are forked first, before the db client threads, and shared by forked server processes
+    if hash_worker_count:
+        hash_workers.set_count(hash_worker_count)
+        hash_workers.start()
+
+    mongo_dbs.set_dbname(dbname)
+    connect_mongo()
+
     synchronizer.prepare(lockfile)
     atexit.register(sync_clean)
 
+    if index_engine:
+        if not hash_index.set_engine(index_engine):
+            logging.warning('unknown hash index engine: ' + str(index_engine))
+    hash_index.set_whole_feeds(index_whole)
+
+    if compare_gate:
+        if not hash_index.set_cascade(*compare_gate):
+            logging.warning('wrong comparison gate: ' + str(compare_gate))
+    hash_index.set_cascade_verify(compare_verify)
+
+    if hash_cache_size is not None:
+        hash_cache.set_sizes(min(HASH_CACHE_MEMORY_ITEMS, hash_cache_size), hash_cache_size)
+
+    if links_layout:
+        if not storage_layouts.set_new_layout(links_layout):
+            logging.warning('unknown links layout: ' + str(links_layout))
+
+    if job_worker_count is not None:
+        insert_jobs.set_count(job_worker_count)
+
+    if not media_fetcher.set_host_limits(fetch_host_connections, fetch_host_rate):
+        logging.warning('wrong fetch limits per host: ' + str(fetch_host_connections) + ', ' + str(fetch_host_rate))
+
     app.register_blueprint(mediasearch_plugin)
 
 @app.errorhandler(404)
@@ -50,10 +91,36 @@ def page_not_found(error):
 
     return (json.dumps({'_message': 'page not found'}), 404, {'Content-Type': 'application/json'})
 
-def run_flask(dbname, host='localhost', port=9020, lockfile='', debug=False):
-    setup_mediasearch(dbname, lockfile)
+def prepare_worker():
+    # queued inserts are run by threads of each server process
+    connect_mongo()
+    insert_jobs.prepare(run_insert_job)
+
+def finish_worker():
+    # running insert jobs are finished, not to be cut by the exit of a recycled or replaced worker
+    insert_jobs.stop()
+
+def poll_master():
+    # the master replaces the broken hash workers itself, with no supervising thread
+    hash_workers.supervise()
+
+def run_flask(dbname, host='localhost', port=9020, lockfile='', debug=False, **setup_options):
+    # setup_options are the keyword arguments of setup_mediasearch
+    setup_mediasearch(dbname, lockfile, **setup_options)
+    insert_jobs.prepare(run_insert_job)
+    storage_indexes.prepare()
     app.run(host=host, port=port, debug=debug)
 
+def run_prefork(dbname, host='localhost', port=9020, lockfile='', worker_count=PREFORK_WORKERS, max_requests=PREFORK_MAX_REQUESTS, **setup_options):
+    # setup_options are the keyword arguments of setup_mediasearch;
+    # the master starts no threads, since a thread holding a lock at a fork would leave it locked in the worker
+    hash_workers.set_supervised(False)
+    setup_mediasearch(dbname, lockfile, **setup_options)
+    # missing indexes are built in the background by a forked process, the already built ones are just passed
+    storage_indexes.prepare_forked(connect_mongo)
+    server = PreforkServer(app, host, port, worker_count, max_requests, prepare_worker, finish_worker, poll_master)
+    server.serve()
+
 if __name__ == '__main__':
     run_flask('mediasearch', host='localhost', port=9020, lockfile='', debug=True)
 
@@ -14,22 +14,29 @@
 
 GET:
 http://localhost:9020/
-returns list of entry points; by now, the only used is "media"
+returns list of entry points; "media" for the archives, "_stats" for the server counters
 http://localhost:9020/media/
 returns list of providers
 http://localhost:9020/media/provider_name/
 returns list of archives
 http://localhost:9020/media/provider_name/archive_name/
 returns list of actions
+http://localhost:9020/_stats/
+returns list of the server process counters, like hash cache hits and misses: {name, value}
+http://localhost:9020/media/provider_name/archive_name/_jobs/
+returns list of insert jobs of the archive, the most recent first
+http://localhost:9020/media/provider_name/archive_name/_jobs/job_id/
+returns the insert job: {job, ref, state: queued|running|done|failed, stage: queued|check|fetch|hash|store|done, reason, attempts, ...}
 
 POST:
 http://localhost:9020/media/provider_name/archive_name/?pass=boolean&limit=integer
 http://localhost:9020/media/provider_name/archive_name/_drop?pass=boolean&force=boolean
 ... simple addition and removal of an archive
 
-http://localhost:9020/media/provider_name/archive_name/_action?pass=boolean&mode=tag_setting&limit=integer
-_action: _insert, _update, _delete
+http://localhost:9020/media/provider_name/archive_name/_action?pass=boolean&mode=tag_setting&limit=integer&async=boolean
+_action: _insert, _insert_batch, _update, _delete
 data: {ref,feed,url,mime,tags} for _insert, {ref,tags} for _update, {ref} for _delete
+data: [{ref,feed,url,mime,tags}, ...] or {items: [{ref,feed,url,mime,tags}, ...]} for _insert_batch
 {
     ref ... reference to client-wise media id, unique, mandatory,
     feed ... for slicing the image sets (usually to high vs. low throughput feeds)
@@ -39,13 +46,16 @@ data: {ref,feed,url,mime,tags} for _insert, {ref,tags} for _update, {ref} for _d
 }
 pass: default false
 _insert: whether to overwrite, if ref already exists, otherwise error returned
+_insert_batch: as for _insert, per-item status returned: {ref, status: inserted|failed, reason}
 _update: whether to ignore non-existent ref, otherwise error returned
 _delete: whether to ignore non-existent ref, otherwise error returned
 limit: the count of images (per feed) to use to similarity comparisons
+async: default false
+_insert: whether to only queue the insert, 202 returned with {job, ref, state, path}; path is for getting the job state
 
 GET:
 http://localhost:9020/media/provider_name/archive_name/_action?par1=val1&...
-_action: _select, _search
+_action: _select, _search, _nearest, _search_hash
 parN:
 ref ... case for _search, mandatory for _search: listing similar items; several values used as similar to any of them
 ref ... case for _select (ref or feed mandatory for _select)
@@ -57,6 +67,32 @@ threshold ... distance limit, 0...1, _search only
 order ... ref(default)|created|updated|reliked; similarity is the first sort criterion for _search
 offset ... offset for listing
 limit ... (maximal) count of items returned
+group ... boolean, _search only: similar items grouped per the asked refs, [{ref, items, total}], with offset and limit per group
+after ... continuation token, as returned at _meta.next when more items follow; the listing goes on past the last listed item,
+          for the same order, unlike offset not slowing down deep pages; not for the grouped _search
+total ... exact(default)|approx|skip, how the _meta.total count is taken; approx counts up to 10000 items, skip gives null
+
+GET/POST:
+http://localhost:9020/media/provider_name/archive_name/_nearest?url=media_url&mime=mime_type&feed=feed&limit=integer&threshold=float
+... the closest stored media, per feed, to the given media; nothing is stored
+for POST, {url,mime,feed} data as for _insert, or the raw image as the request body, with its image/* content type
+feed ... image set slice, all feeds by default
+limit ... count of items returned per feed, default 10
+threshold ... distance limit, 0...1
+returned: [{ref, feed, evals: [{method, dim, diff, dist, similar}]}, ...], the closest first;
+compared against the media that inserts compare against (the latest limit count per feed, unless whole feeds are indexed)
+
+GET:
+http://localhost:9020/media/provider_name/archive_name/_search_hash?method=image_phash&dim=8&hex=hash_hex&feed=feed&threshold=float
+... stored media similar to the given hash, without any media download
+method ... hash method, like image_phash, image_dhash
+dim ... hash dimension, like 8, 16
+hex ... hash value, as the hex representation of the hash
+int ... hash value, as an integer; the little-endian value of the hash bytes, as stored for 64 bit hashes
+feed ... image set slice, all feeds by default
+threshold ... distance limit, 0...1; the method limits apply in any case
+offset, limit ... for listing
+returned: [{ref, feed, method, dim, diff, dist}, ...], the closest first; compared against the media as for _nearest
 '''
 
 import os, sys, datetime, json, logging
@@ -71,18 +107,27 @@ from mediasearch.plugin.storage import HashStorage
 
 DATA_PARAM = 'data'
 PASS_PARAM = 'pass'
+ASYNC_PARAM = 'async'
 LIMIT_PARAM = 'limit'
+THRESHOLD_PARAM = 'threshold'
+FEED_PARAM = 'feed'
 FORCE_PARAM = 'force'
 BOOL_PARAM_TRUE = ['1', 't', 'T']
-GET_PARAM_SIMPLE = ['feed', 'threshold', 'limit', 'offset']
+GET_PARAM_SIMPLE = ['feed', 'threshold', 'limit', 'offset', 'url', 'mime', 'method', 'dim', 'hex', 'int', 'group', 'after', 'total']
 GET_PARAM_LIST = ['ref', 'order']
 GET_PARAM_LIST_DOUBLE = ['with', 'without']
 GET_PARAM_SPLIT = ','
 POST_PARAM_STRING = ['ref', 'feed', 'url', 'mime']
 POST_PARAM_LIST = ['tags']
 TAGS_MODE_PARAM = 'mode'
-GET_NAT_INTEGER = ['limit', 'offset']
+BATCH_ACTION = '_insert_batch'
+BATCH_ITEMS_KEY = 'items'
+NEAREST_ACTION = '_nearest'
+UPLOAD_MEDIA_CLASS = 'image/'
+UPLOAD_MAX_SIZE = 32 * 1024 * 1024
+GET_NAT_INTEGER = ['limit', 'offset', 'dim']
 GET_FLOAT = ['threshold']
+GET_BOOL = ['group']
 
 def _put_to_str(value):
     if value is None:
@@ -106,14 +151,41 @@ def _put_to_str(value):
 
     return output
 
+def _take_media_info(media_data):
+    media_info = {}
+
+    for cur_par in POST_PARAM_STRING:
+        media_info[cur_par] = None
+        if cur_par in media_data:
+            cur_val_set = media_data[cur_par]
+            if cur_val_set:
+                media_info[cur_par] = _put_to_str(cur_val_set)
+
+    for cur_par in POST_PARAM_LIST:
+        media_info[cur_par] = None
+        if cur_par in media_data:
+            cur_val_set = media_data[cur_par]
+            if cur_val_set:
+                cur_list = []
+                if type(cur_val_set) == list:
+                    for cur_val in cur_val_set:
+                        cur_list.append(_put_to_str(cur_val))
+                else:
+                    cur_list = [_put_to_str(cur_val_set)]
+                if cur_list:
+                    media_info[cur_par] = cur_list
+
+    return media_info
+
 mediasearch_plugin = Blueprint('mediasearch_plugin', __name__)
 
 @mediasearch_plugin.route('/', defaults={'entry': None, 'provider': None, 'archive': None, 'action': None}, methods=['GET'], strict_slashes=False)
 @mediasearch_plugin.route('/<entry>/', defaults={'provider': None, 'archive': None, 'action': None}, methods=['GET'], strict_slashes=False)
 @mediasearch_plugin.route('/<entry>/<provider>/', defaults={'archive': None, 'action': None}, methods=['GET'], strict_slashes=False)
 @mediasearch_plugin.route('/<entry>/<provider>/<archive>/', defaults={'action': None}, methods=['GET'], strict_slashes=False)
-@mediasearch_plugin.route('/<entry>/<provider>/<archive>/<action>/', defaults={}, methods=['GET'], strict_slashes=False)
-def mediasearch_get(entry, provider, archive, action):
+@mediasearch_plugin.route('/<entry>/<provider>/<archive>/<action>/', defaults={'job': None}, methods=['GET'], strict_slashes=False)
+@mediasearch_plugin.route('/<entry>/<provider>/<archive>/<action>/<job>/', defaults={}, methods=['GET'], strict_slashes=False)
+def mediasearch_get(entry, provider, archive, action, job=None):
     '''
     Connector for GET requests
     '''
@@ -126,6 +198,7 @@ def mediasearch_get(entry, provider, archive, action):
     media_storage = HashStorage(mongo_dbs.get_db())
 
     media_params = {}
+    media_params['job'] = _put_to_str(job)
 
     for cur_par in GET_PARAM_SIMPLE:
         media_params[cur_par] = None
@@ -145,6 +218,8 @@ def mediasearch_get(entry, provider, archive, action):
                         cur_val_set = float(cur_val_set)
                     except:
                         cur_val_set = None
+                if cur_par in GET_BOOL:
+                    cur_val_set = cur_val_set[:1] in BOOL_PARAM_TRUE
                 media_params[cur_par] = cur_val_set
 
     for cur_par in GET_PARAM_LIST:
@@ -202,6 +277,15 @@ def mediasearch_post(entry, provider, archive, action):
                     pass_value = True
                     break
 
+    async_value = False
+    if ASYNC_PARAM in request.args:
+        async_value_got = _put_to_str(request.args[ASYNC_PARAM])
+        if async_value_got:
+            for test_start in BOOL_PARAM_TRUE:
+                if async_value_got.startswith(test_start):
+                    async_value = True
+                    break
+
     force_value = False
     if FORCE_PARAM in request.args:
         force_value_got = _put_to_str(request.args[FORCE_PARAM])
@@ -224,14 +308,30 @@ def mediasearch_post(entry, provider, archive, action):
         if limit_value_got:
             limit_value = limit_value_got
 
+    threshold_value = None
+    if THRESHOLD_PARAM in request.args:
+        try:
+            threshold_value = float(_put_to_str(request.args[THRESHOLD_PARAM]))
+        except:
+            threshold_value = None
+
     tags_mode = None
     if TAGS_MODE_PARAM in request.args:
         tags_mode_got = _put_to_str(request.args[TAGS_MODE_PARAM])
         if tags_mode_got:
             tags_mode = tags_mode_got
 
+    upload_data = None
+    if (NEAREST_ACTION == action) and request.mimetype and request.mimetype.startswith(UPLOAD_MEDIA_CLASS):
+        # raw media upload, instead of the media url
+        if request.content_length and (request.content_length > UPLOAD_MAX_SIZE):
+            return (json.dumps({'_message': 'uploaded media too large'}), 413, {'Content-Type': 'application/json'})
+        upload_data = request.get_data()
+
     try:
-        media_data = request.get_json(True, False, False)
+        media_data = None
+        if upload_data is None:
+            media_data = request.get_json(True, False, False)
     except:
         media_data = None
 
@@ -247,35 +347,29 @@ def mediasearch_post(entry, provider, archive, action):
     if not media_data:
         media_data = {}
 
-    if type(media_data) != dict:
-        media_data = {}
-
-    media_info = {}
-
-    for cur_par in POST_PARAM_STRING:
-        media_info[cur_par] = None
-        if cur_par in media_data:
-            cur_val_set = media_data[cur_par]
-            if cur_val_set:
-                media_info[cur_par] = _put_to_str(cur_val_set)
-
-    for cur_par in POST_PARAM_LIST:
-        media_info[cur_par] = None
-        if cur_par in media_data:
-            cur_val_set = media_data[cur_par]
-            if cur_val_set:
-                cur_list = []
-                if type(cur_val_set) == list:
-                    for cur_val in cur_val_set:
-                        cur_list.append(_put_to_str(cur_val))
-                else:
-                    cur_list = [_put_to_str(cur_val_set)]
-                if cur_list:
-                    media_info[cur_par] = cur_list
+    if BATCH_ACTION == action:
+        if (type(media_data) == dict) and (BATCH_ITEMS_KEY in media_data):
+            media_data = media_data[BATCH_ITEMS_KEY]
+        if type(media_data) != list:
+            media_data = []
+        media_info = []
+        for one_media_data in media_data:
+            if type(one_media_data) != dict:
+                one_media_data = {}
+            media_info.append(_take_media_info(one_media_data))
+    else:
+        if type(media_data) != dict:
+            media_data = {}
+        media_info = _take_media_info(media_data)
+        if upload_data:
+            media_info['data'] = upload_data
+            media_info['mime'] = _put_to_str(request.mimetype)
+            if FEED_PARAM in request.args:
+                media_info['feed'] = _put_to_str(request.args[FEED_PARAM])
 
     try:
         search = MediaSearch()
-        rv = search.do_post(media_storage, entry, provider, archive, action, media_info, tags_mode, pass_value, force_value, limit_value)
+        rv = search.do_post(media_storage, entry, provider, archive, action, media_info, tags_mode, pass_value, force_value, limit_value, async_value, threshold_value)
         return rv
     except:
         logging.error('POST request: uncaught exception')
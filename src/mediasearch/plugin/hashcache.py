@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Content-addressed cache of computed media hashes
+#
+# media hashes are keyed by sha1 digest of the media bytes, along with a fingerprint
+# of the hash methods, not to take hashes made by other methods or dimensions;
+# remote urls can keep their ETag/Last-Modified validators, for conditional re-downloads;
+# the most recently used entries are held in memory, the rest in a db collection
+#
+
+'''
+cache data: collection "hash_cache"
+{
+    _id: String <= "media:" + fingerprint of the hash methods + ":" + sha1 of media bytes,
+    hashes: [{method: String(dhash|phash|...), dim: Integer(8|16|32|64), packed: BinData}],
+    used_on: Datetime, sets on saves and on hits
+}
+{
+    _id: String <= "url:" + sha1 of media url,
+    digest: String <= sha1 of media bytes,
+    etag: String, as got from the remote server,
+    modified: String, Last-Modified as got from the remote server,
+    used_on: Datetime, sets on saves
+}
+'''
+
+import logging, datetime, hashlib, threading
+from collections import OrderedDict
+try:
+    from bson.binary import Binary
+except:
+    Binary = None
+from mediasearch.utils.dbs import mongo_dbs
+from mediasearch.utils.stats import media_stats
+
+COLLECTION_HASH_CACHE = 'hash_cache'
+MEDIA_KEY_PREFIX = 'media:'
+URL_KEY_PREFIX = 'url:'
+HASH_CACHE_MEMORY_ITEMS = 10000
+HASH_CACHE_STORED_ITEMS = 100000
+HASH_CACHE_EVICT_EVERY = 100
+HASH_CACHE_EVICT_SHARE = 10
+DIGEST_BLOCK_SIZE = 65536
+HASH_CACHE_INDEXES = [[('used_on', 1)]]
+
+def digest_data(data):
+    return hashlib.sha1(data).hexdigest()
+
+def digest_file(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fh:
+            while True:
+                read_buffer = fh.read(DIGEST_BLOCK_SIZE)
+                if not read_buffer:
+                    break
+                digest.update(read_buffer)
+    except:
+        return None
+
+    return digest.hexdigest()
+
+class HashCache(object):
+    def __init__(self, memory_items=HASH_CACHE_MEMORY_ITEMS, stored_items=HASH_CACHE_STORED_ITEMS):
+        self.memory_items = memory_items
+        self.stored_items = stored_items
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.puts = 0
+        self.fingerprint = None
+        media_stats.add_gauge('hash_cache_memory_items', self.get_memory_size)
+
+    def set_sizes(self, memory_items, stored_items):
+        try:
+            memory_items = max(0, int(memory_items))
+            stored_items = max(0, int(stored_items))
+        except:
+            return False
+
+        with self.lock:
+            self.memory_items = memory_items
+            self.stored_items = stored_items
+            while len(self.items) > self.memory_items:
+                self.items.popitem(False)
+
+        return True
+
+    def set_fingerprint(self, fingerprint):
+        # None to take the one of the hash methods
+        with self.lock:
+            if fingerprint != self.fingerprint:
+                self.fingerprint = fingerprint
+                self.items = OrderedDict()
+        return True
+
+    def get_fingerprint(self):
+        if self.fingerprint is None:
+            # imported here, not to load the image libraries for the users of the cache collection
+            from mediasearch.algs.methods import MediaHashMethods
+            self.fingerprint = MediaHashMethods().get_fingerprint()
+        return self.fingerprint
+
+    def _media_key(self, digest):
+        return MEDIA_KEY_PREFIX + self.get_fingerprint() + ':' + digest
+
+    def is_active(self):
+        return bool(self.memory_items or self.stored_items)
+
+    def get_memory_size(self):
+        return len(self.items)
+
+    def _get_collection(self):
+        if not self.stored_items:
+            return None
+        db_holder = mongo_dbs.get_db()
+        if not db_holder:
+            return None
+        return db_holder.db[COLLECTION_HASH_CACHE]
+
+    def _remember(self, digest, packed_hashes):
+        if not self.memory_items:
+            return
+        with self.lock:
+            self.items.pop(digest, None)
+            self.items[digest] = packed_hashes
+            while len(self.items) > self.memory_items:
+                self.items.popitem(False)
+
+    def _recall(self, digest):
+        with self.lock:
+            if digest not in self.items:
+                return None
+            packed_hashes = self.items.pop(digest)
+            self.items[digest] = packed_hashes
+            return packed_hashes
+
+    def _load(self, digest, touch):
+        collection = self._get_collection()
+        if collection is None:
+            return None
+
+        try:
+            item = collection.find_one({'_id': self._media_key(digest)})
+            if not item:
+                return None
+            packed_hashes = []
+            for one_hash in item['hashes']:
+                packed_hashes.append({'method': one_hash['method'], 'dim': one_hash['dim'], 'packed': bytes(one_hash['packed'])})
+            if touch:
+                collection.update({'_id': self._media_key(digest)}, {'$set': {'used_on': datetime.datetime.utcnow()}})
+        except:
+            logging.warning('can not load cached media hashes: ' + str(digest))
+            return None
+
+        return packed_hashes
+
+    def contains(self, digest):
+        '''
+        Whether hashes of the digest are cached, not counted into hits/misses
+        '''
+        if not digest:
+            return False
+        if self._recall(digest) is not None:
+            return True
+        packed_hashes = self._load(digest, False)
+        if packed_hashes is None:
+            return False
+
+        self._remember(digest, packed_hashes)
+        return True
+
+    def get(self, digest):
+        '''
+        Cached hashes of the digest, as list of {method, dim, packed}, None on misses
+        '''
+        if (not digest) or (not self.is_active()):
+            return None
+
+        packed_hashes = self._recall(digest)
+        if packed_hashes is not None:
+            media_stats.incr('hash_cache_memory_hits')
+            return packed_hashes
+
+        packed_hashes = self._load(digest, True)
+        if packed_hashes is not None:
+            self._remember(digest, packed_hashes)
+            media_stats.incr('hash_cache_stored_hits')
+            return packed_hashes
+
+        media_stats.incr('hash_cache_misses')
+        return None
+
+    def put(self, digest, packed_hashes):
+        if (not digest) or (not packed_hashes) or (not self.is_active()):
+            return False
+
+        self._remember(digest, packed_hashes)
+
+        collection = self._get_collection()
+        if collection is None:
+            return True
+
+        stored_hashes = []
+        for one_hash in packed_hashes:
+            packed = one_hash['packed']
+            if Binary is not None:
+                packed = Binary(packed)
+            stored_hashes.append({'method': one_hash['method'], 'dim': one_hash['dim'], 'packed': packed})
+
+        try:
+            collection.update({'_id': self._media_key(digest)}, {'$set': {'hashes': stored_hashes, 'used_on': datetime.datetime.utcnow()}}, upsert=True)
+        except:
+            logging.warning('can not store cached media hashes: ' + str(digest))
+            return False
+
+        self._evict_stored(collection)
+        return True
+
+    def get_url(self, media_url):
+        '''
+        Validators of the url: {digest, etag, modified}, if its media hashes are still cached
+        '''
+        collection = self._get_collection()
+        if collection is None:
+            return None
+
+        try:
+            item = collection.find_one({'_id': URL_KEY_PREFIX + digest_data(media_url)})
+        except:
+            return None
+        if (not item) or (not item.get('digest')):
+            return None
+        if (not item.get('etag')) and (not item.get('modified')):
+            return None
+
+        if not self.contains(item['digest']):
+            return None
+
+        return {'digest': item['digest'], 'etag': item.get('etag'), 'modified': item.get('modified')}
+
+    def put_url(self, media_url, digest, etag, modified):
+        if (not etag) and (not modified):
+            return False
+        collection = self._get_collection()
+        if collection is None:
+            return False
+
+        try:
+            collection.update({'_id': URL_KEY_PREFIX + digest_data(media_url)}, {'$set': {'digest': digest, 'etag': etag, 'modified': modified, 'used_on': datetime.datetime.utcnow()}}, upsert=True)
+        except:
+            logging.warning('can not store cached url validators: ' + str(media_url))
+            return False
+
+        return True
+
+    def _count_stored(self, collection):
+        # taken from the collection metadata, without a scan
+        if hasattr(collection, 'estimated_document_count'):
+            return collection.estimated_document_count()
+        return collection.count()
+
+    def _evict_stored(self, collection):
+        # the least recently used entries are removed once the collection grows over the limit,
+        # with a share more removed, not to walk the used_on index on every check near the limit
+        with self.lock:
+            self.puts += 1
+            if self.puts % HASH_CACHE_EVICT_EVERY:
+                return
+
+        try:
+            excess = self._count_stored(collection) - self.stored_items
+            if excess <= 0:
+                return
+            excess += self.stored_items // HASH_CACHE_EVICT_SHARE
+            remove_ids = []
+            for item in collection.find({}, {'_id': 1}).sort([('used_on', 1)]).limit(excess):
+                remove_ids.append(item['_id'])
+            if remove_ids:
+                collection.remove({'_id': {'$in': remove_ids}})
+                media_stats.incr('hash_cache_evicted', len(remove_ids))
+        except:
+            logging.warning('can not evict cached media hashes')
+
+hash_cache = HashCache()
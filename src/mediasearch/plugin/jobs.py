@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Queue of asynchronous media inserts
+#
+# jobs are kept in a db collection, thus surviving restarts; worker threads of any
+# of the server processes claim them atomically; a claim is a lease renewed on each
+# stage change, jobs of a lease not renewed in time (e.g. of a process that died) are
+# taken again, before the queued ones; a worker whose lease was taken over can neither
+# renew it nor finish the job, and drops the job; stopping processes wait for their running jobs
+#
+
+'''
+job data: collection "insert_jobs"
+{
+    _id: String(hex) <= job id,
+    provider: String(a-zA-Z0-9_-) <= provider_name,
+    archive: String(a-zA-Z0-9_-) <= archive_name,
+    media: {ref, feed, url, mime, tags}, as for _insert,
+    pass: Boolean, as for _insert,
+    limit: Integer|null, as for _insert,
+    state: String(queued|running|done|failed),
+    stage: String(queued|check|fetch|hash|store|done),
+    reason: String(exists|fetch|hash|store|lease|...), on failures,
+    attempts: Integer, count of claims,
+    worker: String <= host:pid of the claiming process,
+    created_on: Datetime, sets on queueing,
+    claimed_on: Datetime, sets on claims and on stage changes, as the lease renewal,
+    updated_on: Datetime, sets on stage changes,
+    finished_on: Datetime, sets on done or failed
+}
+'''
+
+import os, time, socket, uuid, logging, datetime, threading
+try:
+    from pymongo import ReturnDocument
+except:
+    ReturnDocument = None
+from mediasearch.utils.dbs import mongo_dbs
+from mediasearch.utils.stats import media_stats
+
+COLLECTION_JOBS = 'insert_jobs'
+JOB_WORKERS = 2
+JOB_POLL_INTERVAL = 1.0
+JOB_CLAIM_TIMEOUT = 600
+JOB_STOP_TIMEOUT = 20
+JOB_MAX_ATTEMPTS = 3
+JOB_KEEP_SECONDS = 86400
+JOB_CLEAN_INTERVAL = 600
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STAGE_QUEUED = 'queued'
+STAGE_DONE = 'done'
+REASON_LEASE = 'lease'
+
+JOB_INDEXES = [[('state', 1), ('created_on', 1)], [('provider', 1), ('archive', 1), ('created_on', -1)], [('state', 1), ('claimed_on', 1)]]
+JOB_OUTPUT_FIELDS = ['provider', 'archive', 'state', 'stage', 'reason', 'attempts', 'created_on', 'claimed_on', 'updated_on', 'finished_on']
+
+class InsertJobs(object):
+    def __init__(self, count=JOB_WORKERS):
+        self.count = count
+        self.lock = threading.Lock()
+        self.threads = []
+        self.owner_pid = None
+        self.stopping = threading.Event()
+        self.cleaned_on = 0
+        media_stats.add_gauge('insert_jobs_queued', self.get_queue_depth)
+
+    def set_count(self, count):
+        try:
+            count = int(count)
+        except:
+            count = 0
+        self.count = max(0, count)
+        return True
+
+    def get_count(self):
+        return self.count
+
+    def _get_collection(self):
+        db_holder = mongo_dbs.get_db()
+        if not db_holder:
+            return None
+        return db_holder.db[COLLECTION_JOBS]
+
+    def _find_and_modify(self, collection, query, update, sort):
+        if (ReturnDocument is not None) and hasattr(collection, 'find_one_and_update'):
+            return collection.find_one_and_update(query, update, sort=sort, return_document=ReturnDocument.AFTER)
+        return collection.find_and_modify(query, update, sort=sort, new=True)
+
+    def _lease_time(self):
+        # as stored by the db, to the milliseconds, for the lease to be matched later
+        timepoint = datetime.datetime.utcnow()
+        return timepoint.replace(microsecond=(timepoint.microsecond // 1000 * 1000))
+
+    def _update_leased(self, collection, job, update):
+        # matched only while the job is held by the lease the job was claimed, or last renewed, with;
+        # returns count of the matched jobs
+        lease_spec = {'_id': job['_id'], 'worker': job['worker'], 'claimed_on': job['claimed_on']}
+        if hasattr(collection, 'update_one'):
+            return collection.update_one(lease_spec, update).matched_count
+        return collection.update(lease_spec, update).get('n', 0)
+
+    def queue_job(self, provider, archive, media_fields, pass_mode, limit_count):
+        '''
+        Stores a new insert job, returns the job, None on failures
+        '''
+        collection = self._get_collection()
+        if collection is None:
+            return None
+
+        timepoint = datetime.datetime.utcnow()
+        job = {
+            '_id': uuid.uuid4().hex,
+            'provider': provider,
+            'archive': archive,
+            'media': media_fields,
+            'pass': bool(pass_mode),
+            'limit': limit_count,
+            'state': STATE_QUEUED,
+            'stage': STAGE_QUEUED,
+            'reason': None,
+            'attempts': 0,
+            'worker': None,
+            'created_on': timepoint,
+            'claimed_on': None,
+            'updated_on': timepoint,
+            'finished_on': None
+        }
+
+        try:
+            collection.insert_one(job) if hasattr(collection, 'insert_one') else collection.insert(job)
+        except:
+            logging.warning('can not queue insert job: ' + str(media_fields.get('ref')))
+            return None
+
+        media_stats.incr('insert_jobs_created')
+        return job
+
+    def claim_job(self):
+        '''
+        Atomically takes the job of the longest expired lease, or else the oldest queued job
+        '''
+        collection = self._get_collection()
+        if collection is None:
+            return None
+
+        timepoint = self._lease_time()
+        stuck_time = timepoint - datetime.timedelta(seconds=JOB_CLAIM_TIMEOUT)
+        claim_set = {'state': STATE_RUNNING, 'worker': socket.gethostname() + ':' + str(os.getpid()), 'claimed_on': timepoint, 'updated_on': timepoint}
+        claim_update = {'$set': claim_set, '$inc': {'attempts': 1}}
+
+        try:
+            job = self._find_and_modify(collection, {'state': STATE_RUNNING, 'claimed_on': {'$lt': stuck_time}}, claim_update, [('claimed_on', 1)])
+            if job:
+                logging.info('insert job taken over from an expired claim: ' + str(job['_id']))
+            else:
+                job = self._find_and_modify(collection, {'state': STATE_QUEUED}, claim_update, [('created_on', 1)])
+        except:
+            logging.warning('can not claim insert job')
+            return None
+
+        if job and (job['attempts'] > JOB_MAX_ATTEMPTS):
+            self.finish_job(job, STATE_FAILED, 'attempts')
+            return None
+
+        return job
+
+    def set_stage(self, job, stage):
+        '''
+        Notes the stage, renewing the claim lease of the job; returns False when the lease
+        was taken over by another worker, or can not be renewed, thus the job is to be dropped
+        '''
+        collection = self._get_collection()
+        if collection is None:
+            return False
+        timepoint = self._lease_time()
+        try:
+            matched = self._update_leased(collection, job, {'$set': {'stage': stage, 'claimed_on': timepoint, 'updated_on': timepoint}})
+        except:
+            logging.warning('can not renew insert job claim: ' + str(job['_id']))
+            return False
+        if not matched:
+            logging.warning('insert job claim taken over: ' + str(job['_id']))
+            return False
+        job['stage'] = stage
+        job['claimed_on'] = timepoint
+        return True
+
+    def finish_job(self, job, state, reason=None):
+        collection = self._get_collection()
+        if collection is None:
+            return False
+        timepoint = datetime.datetime.utcnow()
+        finish_set = {'state': state, 'reason': reason, 'updated_on': timepoint, 'finished_on': timepoint}
+        if STATE_DONE == state:
+            finish_set['stage'] = STAGE_DONE
+        try:
+            matched = self._update_leased(collection, job, {'$set': finish_set})
+        except:
+            return False
+        if not matched:
+            logging.warning('insert job claim taken over, not finished here: ' + str(job['_id']))
+            return False
+        media_stats.incr('insert_jobs_' + str(state))
+        return True
+
+    def _output_job(self, job):
+        output = {'job': job['_id'], 'ref': job['media'].get('ref')}
+        for one_field in JOB_OUTPUT_FIELDS:
+            output[one_field] = job.get(one_field)
+        return output
+
+    def get_job(self, provider, archive, job_id):
+        collection = self._get_collection()
+        if collection is None:
+            return None
+        try:
+            job = collection.find_one({'_id': job_id, 'provider': provider, 'archive': archive})
+        except:
+            return None
+        if not job:
+            return None
+        return self._output_job(job)
+
+    def list_jobs(self, provider, archive, offset=None, limit=None):
+        no_res = {'items': [], 'total': 0}
+        collection = self._get_collection()
+        if collection is None:
+            return no_res
+        try:
+            cursor = collection.find({'provider': provider, 'archive': archive}).sort([('created_on', -1)])
+            total = cursor.count()
+            if offset is not None:
+                cursor = cursor.skip(offset)
+            if limit is not None:
+                cursor = cursor.limit(limit)
+            items = [self._output_job(job) for job in cursor]
+        except:
+            return no_res
+        return {'items': items, 'total': total}
+
+    def get_queue_depth(self):
+        collection = self._get_collection()
+        if collection is None:
+            return None
+        return collection.find({'state': STATE_QUEUED}).count()
+
+    def _clean_finished(self):
+        if time.time() < self.cleaned_on + JOB_CLEAN_INTERVAL:
+            return
+        self.cleaned_on = time.time()
+        collection = self._get_collection()
+        if collection is None:
+            return
+        keep_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=JOB_KEEP_SECONDS)
+        try:
+            collection.remove({'state': {'$in': [STATE_DONE, STATE_FAILED]}, 'finished_on': {'$lt': keep_time}})
+        except:
+            logging.warning('can not clean finished insert jobs')
+
+    def _work_loop(self, run_job):
+        while not self.stopping.is_set():
+            self._clean_finished()
+            job = self.claim_job()
+            if not job:
+                self.stopping.wait(JOB_POLL_INTERVAL)
+                continue
+
+            media_stats.timing('insert_jobs_wait', (datetime.datetime.utcnow() - job['created_on']).total_seconds())
+            try:
+                state, reason = run_job(job)
+            except Exception as exc:
+                logging.warning('insert job failed: ' + str(job['_id']) + ', ' + str(exc))
+                state, reason = STATE_FAILED, 'error'
+            self.finish_job(job, state, reason)
+
+    def prepare(self, run_job):
+        '''
+        Starts the worker threads, lazily, and anew in forked server processes
+        run_job(job) does the insert, returns (state, reason)
+        '''
+        with self.lock:
+            if self.threads and (self.owner_pid == os.getpid()):
+                return True
+            self.owner_pid = os.getpid()
+            self.stopping = threading.Event()
+            self.threads = []
+            for rank in range(self.count):
+                worker = threading.Thread(target=self._work_loop, args=(run_job,))
+                worker.daemon = True
+                worker.start()
+                self.threads.append(worker)
+
+        return bool(self.threads)
+
+    def stop(self, timeout=JOB_STOP_TIMEOUT):
+        '''
+        Stops claiming new jobs and waits for the running ones, before the process exits;
+        returns whether all the worker threads finished, jobs left running are taken again
+        after their lease expires
+        '''
+        with self.lock:
+            if (not self.threads) or (self.owner_pid != os.getpid()):
+                return True
+            threads = self.threads
+            self.threads = []
+            self.stopping.set()
+
+        stop_till = time.time() + timeout
+        for worker in threads:
+            worker.join(max(0, stop_till - time.time()))
+
+        running = len([worker for worker in threads if worker.is_alive()])
+        if running:
+            logging.warning('insert jobs left running at stop: ' + str(running))
+        return not running
+
+insert_jobs = InsertJobs()
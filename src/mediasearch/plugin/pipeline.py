@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Staged insertion of media batches
+#
+# downloads and hashing run in worker threads, db writes and comparisons
+# run in the request thread, so that the stages overlap across the batch items
+#
+
+import logging, threading
+try:
+    import Queue as queue
+except:
+    import queue
+
+FETCH_WORKERS = 4
+HASH_WORKERS = 2
+HASH_QUEUE_SIZE = 16
+
+STATUS_INSERTED = 'inserted'
+STATUS_FAILED = 'failed'
+REASON_EXISTS = 'exists'
+REASON_FETCH = 'fetch'
+REASON_HASH = 'hash'
+REASON_STORE = 'store'
+
+class InsertPipeline(object):
+    def __init__(self, search, media_storage, pass_mode, limit_count, fetch_workers=FETCH_WORKERS, hash_workers=HASH_WORKERS):
+        self.search = search
+        self.media_storage = media_storage
+        self.pass_mode = pass_mode
+        self.limit_count = limit_count
+        self.fetch_workers = max(1, fetch_workers)
+        self.hash_workers = max(1, hash_workers)
+        self.fetch_queue = queue.Queue()
+        self.hash_queue = queue.Queue(HASH_QUEUE_SIZE)
+        self.store_queue = queue.Queue()
+
+    def _fetch_stage(self):
+        while True:
+            task = self.fetch_queue.get()
+            if task is None:
+                break
+            rank, media_fields = task
+            try:
+                fetched_media = self.search._proc_fetch_media(media_fields['url'], media_fields['mime'])
+            except:
+                fetched_media = None
+            if not fetched_media:
+                self.store_queue.put((rank, media_fields, None, REASON_FETCH))
+                continue
+            self.hash_queue.put((rank, media_fields, fetched_media))
+
+    def _hash_stage(self):
+        while True:
+            task = self.hash_queue.get()
+            if task is None:
+                break
+            rank, media_fields, fetched_media = task
+            try:
+                hashes = self.search._proc_hash_fetched_media(fetched_media)
+            except:
+                hashes = None
+            if (not hashes) or (not hashes['evals']):
+                self.store_queue.put((rank, media_fields, None, REASON_HASH))
+                continue
+            self.store_queue.put((rank, media_fields, hashes, None))
+
+    def _start_workers(self, target, count):
+        workers = []
+        for rank in range(count):
+            worker = threading.Thread(target=target)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def run(self, media_list):
+        '''
+        Inserts the media of the list, returns per-item statuses in the list order
+        '''
+        results = []
+        for media_fields in media_list:
+            results.append({'ref': media_fields['ref'], 'status': STATUS_FAILED})
+
+        present_refs = set()
+        if not self.pass_mode:
+            present_refs = self.media_storage.get_present_refs([media_fields['ref'] for media_fields in media_list])
+
+        task_count = 0
+        for rank, media_fields in enumerate(media_list):
+            if media_fields['ref'] in present_refs:
+                results[rank]['reason'] = REASON_EXISTS
+                continue
+            self.fetch_queue.put((rank, media_fields))
+            task_count += 1
+
+        if not task_count:
+            return results
+
+        fetch_workers = self._start_workers(self._fetch_stage, min(self.fetch_workers, task_count))
+        hash_workers = self._start_workers(self._hash_stage, min(self.hash_workers, task_count))
+
+        for task_rank in range(task_count):
+            rank, media_fields, hashes, reason = self.store_queue.get()
+            if reason:
+                results[rank]['reason'] = reason
+                continue
+
+            try:
+                if not self.search._proc_check_new_media(self.media_storage, media_fields, self.pass_mode):
+                    results[rank]['reason'] = REASON_EXISTS
+                    continue
+                stored = self.search._proc_store_media_hash(self.media_storage, media_fields, hashes, self.pass_mode, self.limit_count)
+            except:
+                logging.warning('can not store media hash: ' + str(media_fields['ref']))
+                stored = None
+            if not stored:
+                results[rank]['reason'] = REASON_STORE
+                continue
+
+            results[rank]['status'] = STATUS_INSERTED
+
+        for worker in fetch_workers:
+            self.fetch_queue.put(None)
+        for worker in hash_workers:
+            self.hash_queue.put(None)
+
+        return results
@@ -4,21 +4,38 @@
 # Performs media hashing, hash storage and (perceptual) similarity search
 #
 
-import sys, os, logging, datetime
-import json, tempfile, urllib2
+import sys, os, time, logging, datetime, threading
+import io, json, binascii, struct
 import re, operator
 from mediasearch.algs.methods import MediaHashMethods
+from mediasearch.algs.hashindex import hash_index, packed_from_hex, packed_to_words
+from mediasearch.plugin.storage import HashStorage, NO_LIMIT_COUNT, TOTAL_MODES, CREATED_FIELD
+from mediasearch.plugin.pipeline import InsertPipeline, HASH_WORKERS, STATUS_FAILED, REASON_EXISTS, REASON_FETCH, REASON_HASH, REASON_STORE
+from mediasearch.plugin.jobs import insert_jobs, STATE_DONE, STATE_FAILED, REASON_LEASE
+from mediasearch.utils.dbs import mongo_dbs
 from mediasearch.utils.sync import synchronizer
+from mediasearch.utils.workers import hash_workers
+from mediasearch.utils.fetch import media_fetcher
+from mediasearch.utils.stats import media_stats
+from mediasearch.plugin.hashcache import hash_cache, digest_data, digest_file
 
 try:
     unicode()
 except:
     unicode = str
 
-BLOCK_SIZE_GET_REMOTE = 8192
 ALLOWED_SPEC = re.compile('^[\d\w_,.-]+$')
 MEDIA_ENTRY_NAME = 'media'
-HASH_MEDIA_TYPE = 'image'
+STATS_ENTRY_NAME = '_stats'
+JOBS_ACTION_NAME = '_jobs'
+NEAREST_ACTION_NAME = '_nearest'
+NEAREST_COUNT = 10
+SEARCH_HASH_ACTION_NAME = '_search_hash'
+MAX_BATCH_ITEMS = 1000
+INDEX_RELOAD_INTERVAL = 600
+INDEX_SYNC_OVERLAP = 2
+SCAN_BATCH_SIZE = 10000
+REMOVE_FIELDS = ['feed', 'alike.ref']
 
 class MediaSearch(object):
     known_media_types = {'image' : ['png', 'jpg', 'jpeg', 'pjpeg', 'gif', 'bmp', 'x-ms-bmp', 'tiff']}
@@ -30,62 +47,84 @@ class MediaSearch(object):
         self.hash_methods_holder = MediaHashMethods()
         self.hash_methods = self.hash_methods_holder.get_methods()
 
-    def _ext_download_media_file(self, media_url):
-        local_file = tempfile.NamedTemporaryFile('w+b', -1, '', 'media', self.tmp_dir, False)
-
-        try:
-            block_size = BLOCK_SIZE_GET_REMOTE
-            url_conn = urllib2.urlopen(media_url)
-            while True:
-                read_buffer = url_conn.read(block_size)
-                if not read_buffer:
-                    break
-                local_file.write(read_buffer)
-            url_conn.close()
-            local_file.close()
-        except:
-            local_file.close()
+    def _ext_download_media_file(self, media_url, cached_url=None):
+        # small files are kept in memory, larger ones are spilled into a local file
+        headers = None
+        if cached_url:
+            headers = {}
+            if cached_url['etag']:
+                headers['If-None-Match'] = cached_url['etag']
+            if cached_url['modified']:
+                headers['If-Modified-Since'] = cached_url['modified']
+
+        fetched = media_fetcher.fetch(media_url, headers, self.tmp_dir)
+        if fetched and (304 == fetched.status) and (not cached_url):
+            fetched = None
+        if (not fetched) or (fetched.status not in [200, 304]):
+            if fetched:
+                fetched.discard()
             logging.warning('can not get remote media file: ' + str(media_url))
             return None
 
-        local_path = local_file.name
-        local_file.close()
-        return local_path
+        return fetched
+
+    def _alg_create_packed_hashes(self, local_path, media_data=None):
+        # hashed in a worker process when the pool is set, otherwise right here
+        if hash_workers.is_active():
+            return hash_workers.create_hashes(local_path, media_data)
+        if media_data is not None:
+            return self.hash_methods_holder.create_hashes(io.BytesIO(media_data))
+        return self.hash_methods_holder.create_hashes(local_path)
+
+    def _alg_create_hashes(self, local_path, media_type, media_data=None):
+
+        packed_hashes = self._alg_create_packed_hashes(local_path, media_data)
+        return self._alg_prepare_hashes(packed_hashes, local_path)
 
-    def _alg_create_hashes(self, local_path, media_type):
+    def _alg_prepare_hashes(self, packed_hashes, local_path=None):
         prepared_hashes = []
 
-        for cur_name in self.hash_methods:
-            cur_info = self.hash_methods[cur_name]
-            if not HASH_MEDIA_TYPE in cur_info['media']:
-                continue
+        if not packed_hashes:
+            return {'evals': prepared_hashes}
 
-            cur_meth = cur_info['method']
-            cur_flatten = cur_info['repr']
-            cur_obj = cur_info['obj']
-            for cur_dim in cur_info['dims']:
-                try:
-                    cur_hash = cur_meth(media_type, local_path, cur_dim)
-                    if cur_hash is None:
-                        continue
-                    cur_repr = cur_flatten(cur_hash)
-                    if cur_repr is None:
-                        continue
-                    cur_hash = cur_obj(cur_repr)
-                    if cur_hash is None:
-                        continue
-                    prepared_hashes.append({'method': cur_name, 'dim': cur_dim, 'obj': cur_hash, 'repr': cur_repr})
-                except:
-                    logging.warning('can not create media hash: ' + str(cur_name) + ', dimension: ' + str(cur_dim) + ', on: ' + str(local_path))
+        for one_hash in packed_hashes:
+            cur_name = one_hash['method']
+            if not cur_name in self.hash_methods:
+                continue
+            try:
+                cur_repr = str(binascii.hexlify(one_hash['packed']).decode('ascii'))
+                cur_hash = self.hash_methods[cur_name]['obj'](cur_repr)
+                if cur_hash is None:
                     continue
+                prepared_hashes.append({'method': cur_name, 'dim': one_hash['dim'], 'obj': cur_hash, 'repr': cur_repr})
+            except:
+                logging.warning('can not create media hash: ' + str(cur_name) + ', dimension: ' + str(one_hash['dim']) + ', on: ' + str(local_path))
+                continue
 
         return {'evals': prepared_hashes}
 
+    def _alg_get_threshold(self, method_name, dimension):
+        if not method_name in self.hash_methods:
+            return None
+        difference_threshold = self.hash_methods[method_name]['lims']
+
+        threshold = 0
+        if dimension in difference_threshold:
+            threshold = difference_threshold[dimension]
+        else:
+            test_dim = dimension - 1
+            while test_dim >= 0:
+                if test_dim in difference_threshold:
+                    threshold = difference_threshold[test_dim]
+                    break
+                test_dim -= 1
+
+        return threshold
+
     def _alg_compare_hashes(self, method_name, dimension, cmp1, cmp2):
         if not method_name in self.hash_methods:
             return None
         method_info = self.hash_methods[method_name]
-        difference_threshold = method_info['lims']
         try:
             if (type(cmp1) is str) or (type(cmp1) is unicode):
                 cmp1 = method_info['obj'](cmp1)
@@ -99,16 +138,7 @@ class MediaSearch(object):
             logging.warning('can not compare media hashes: ' + str(method_name))
             return None
 
-        threshold = 0
-        if dimension in difference_threshold:
-            threshold = difference_threshold[dimension]
-        else:
-            test_dim = dimension - 1
-            while test_dim >= 0:
-                if test_dim in difference_threshold:
-                    threshold = difference_threshold[test_dim]
-                    break
-                test_dim -= 1
+        threshold = self._alg_get_threshold(method_name, dimension)
 
         return {'diff': diff, 'dist': dist, 'similar': (diff <= threshold)}
 
@@ -118,25 +148,36 @@ class MediaSearch(object):
         if not rv:
             return False
 
+        hash_index.remove_media(media_storage.get_collection_name(), media_data['feed'], media_data['ref'])
+        hash_index.note_removal(media_storage.get_collection_name())
+
+        # links kept in the edges layout are found by the storage itself
         timepoint = datetime.datetime.utcnow()
-        if media_data['alike']:
-            for one_link in media_data['alike']:
-                rv = media_storage.excise_alike_media(one_link['ref'], media_data['ref'], True, timepoint)
-                if not rv:
-                    return False
+        linked_refs = list(set([one_link['ref'] for one_link in (media_data.get('alike') or [])]))
+        rv = media_storage.excise_alike_links(linked_refs, media_data['ref'], timepoint)
+        if rv is None:
+            logging.warning('can not unlink similar media of: ' + str(media_data['ref']))
 
         return True
 
-    def _proc_make_media_hash(self, media_url, media_type):
+    def _proc_check_media_type(self, media_type):
 
         media_type_parts = str(media_type).strip().split('/')
         if 2 != len(media_type_parts):
-            return False
+            return None
         if not media_type_parts[0] in self.known_media_types:
             logging.warning('unknown media class: ' + str(media_type_parts[0]))
-            return False
+            return None
         if not media_type_parts[1] in self.known_media_types[media_type_parts[0]]:
             logging.warning('unknown media type: ' + str(media_type))
+            return None
+
+        return media_type_parts
+
+    def _proc_fetch_media(self, media_url, media_type):
+
+        media_type_parts = self._proc_check_media_type(media_type)
+        if not media_type_parts:
             return False
 
         url_type = None
@@ -149,12 +190,31 @@ class MediaSearch(object):
             logging.warning('unknown type of media url: ' + str(media_url))
             return False
 
-        remove_img = False
         if 'file' != url_type:
-            local_img_path = self._ext_download_media_file(media_url)
-            if not local_img_path:
+            cached_url = None
+            if hash_cache.is_active():
+                cached_url = hash_cache.get_url(media_url)
+            fetched = self._ext_download_media_file(media_url, cached_url)
+            if not fetched:
                 return None
-            remove_img = True
+            if 304 == fetched.status:
+                # not modified since its hashes were cached; taken right now, since the entry can be evicted meanwhile
+                packed_hashes = hash_cache.get(cached_url['digest'])
+                if packed_hashes is not None:
+                    return {'path': None, 'data': None, 'digest': cached_url['digest'], 'hashes': packed_hashes, 'type': media_type_parts[1], 'remove': False}
+                logging.info('cached media hashes evicted, downloading again: ' + str(media_url))
+                fetched = self._ext_download_media_file(media_url)
+                if not fetched:
+                    return None
+
+            media_digest = None
+            if hash_cache.is_active():
+                if fetched.data is not None:
+                    media_digest = digest_data(fetched.data)
+                else:
+                    media_digest = digest_file(fetched.path)
+                hash_cache.put_url(media_url, media_digest, fetched.get_header('etag'), fetched.get_header('last-modified'))
+            return {'path': fetched.path, 'data': fetched.data, 'digest': media_digest, 'type': media_type_parts[1], 'remove': bool(fetched.path)}
         else:
             local_img_path = media_url[len('file:'):]
             if local_img_path.startswith('//'):
@@ -163,65 +223,323 @@ class MediaSearch(object):
         if not local_img_path.startswith('/'):
             local_img_path = os.path.join(self.base_media_path, local_img_path)
 
-        media_hash = self._alg_create_hashes(local_img_path, media_type_parts[1])
+        media_digest = None
+        if hash_cache.is_active():
+            media_digest = digest_file(local_img_path)
+
+        return {'path': local_img_path, 'data': None, 'digest': media_digest, 'type': media_type_parts[1], 'remove': False}
+
+    def _proc_hash_fetched_media(self, fetched_media):
 
-        if remove_img:
+        # identical media bytes are not decoded and hashed again
+        packed_hashes = fetched_media.get('hashes')
+        if packed_hashes is None:
+            packed_hashes = hash_cache.get(fetched_media['digest'])
+        if packed_hashes is None:
+            if (fetched_media['path'] is None) and (fetched_media['data'] is None):
+                logging.warning('cached media hashes not available anymore')
+                return {'evals': []}
+            packed_hashes = self._alg_create_packed_hashes(fetched_media['path'], fetched_media['data'])
+            if packed_hashes:
+                hash_cache.put(fetched_media['digest'], packed_hashes)
+
+        media_hash = self._alg_prepare_hashes(packed_hashes, fetched_media['path'])
+
+        if fetched_media['remove']:
             try:
-                os.unlink(local_img_path)
+                os.unlink(fetched_media['path'])
             except:
                 pass
 
         return media_hash
 
+    def _proc_make_media_hash(self, media_url, media_type):
+
+        fetched_media = self._proc_fetch_media(media_url, media_type)
+        if not fetched_media:
+            return fetched_media
+
+        return self._proc_hash_fetched_media(fetched_media)
+
+    def _proc_make_data_hash(self, media_data, media_type):
+
+        media_type_parts = self._proc_check_media_type(media_type)
+        if not media_type_parts:
+            return False
+
+        media_digest = None
+        if hash_cache.is_active():
+            media_digest = digest_data(media_data)
+
+        return self._proc_hash_fetched_media({'path': None, 'data': media_data, 'digest': media_digest, 'type': media_type_parts[1], 'remove': False})
+
+    def _proc_read_feed_hashes(self, media_storage, media_feed, load_count, since_timepoint):
+        if not media_storage.load_feed_hashes(media_feed, None, load_count, since_timepoint):
+            return None
+
+        loaded = []
+        while True:
+            oth_hash = media_storage.get_loaded_hash()
+            if oth_hash is None:
+                break
+            loaded.append(oth_hash)
+
+        return loaded
+
+    def _proc_build_feed(self, media_storage, media_feed, depth):
+        # a whole load of the feed, not set into the index
+        removed_count = media_storage.get_removed_count()
+        load_count = NO_LIMIT_COUNT
+        if depth is not None:
+            load_count = depth - 1
+        sync_timepoint = datetime.datetime.utcnow() - datetime.timedelta(seconds=INDEX_SYNC_OVERLAP)
+
+        loaded = self._proc_read_feed_hashes(media_storage, media_feed, load_count, None)
+        if loaded is None:
+            return None
+
+        feed_hashes = hash_index.create_feed(depth)
+        feed_hashes.complete = (depth is None) or (len(loaded) < depth)
+        for oth_hash in reversed(loaded):
+            feed_hashes.append(oth_hash['ref'], oth_hash['created_on'], oth_hash['hashes'])
+
+        feed_hashes.synced_on = sync_timepoint
+        feed_hashes.removed_count = removed_count
+        return feed_hashes
+
+    def _proc_run_reload(self, media_storage, media_feed, depth):
+        collection_name = media_storage.get_collection_name()
+        try:
+            start = time.time()
+            feed_hashes = self._proc_build_feed(media_storage, media_feed, depth)
+            if feed_hashes is not None:
+                hash_index.set_feed(collection_name, media_feed, feed_hashes)
+                media_stats.timing('index_reload', time.time() - start)
+            else:
+                logging.warning('can not reload hash index of feed: ' + str(media_feed) + ', at: ' + str(collection_name))
+        finally:
+            hash_index.finish_reload(collection_name, media_feed)
+
+    def _proc_reload_feed(self, media_storage, media_feed, depth):
+        # the reload runs in a thread, with its own storage connector; the current feed serves until swapped
+        if not hash_index.start_reload(media_storage.get_collection_name(), media_feed):
+            return False
+
+        reload_storage = HashStorage(media_storage.storage)
+        if not reload_storage.set_storage(media_storage.provider, media_storage.archive, False):
+            hash_index.finish_reload(media_storage.get_collection_name(), media_feed)
+            return False
+
+        reloader = threading.Thread(target=self._proc_run_reload, args=(reload_storage, media_feed, depth))
+        reloader.daemon = True
+        reloader.start()
+        return True
+
+    def _proc_load_feed_hashes(self, media_storage, media_feed, depth, hash_part=None):
+        collection_name = media_storage.get_collection_name()
+        feed_hashes = hash_index.get_feed(collection_name, media_feed)
+        if (feed_hashes is not None) and feed_hashes.is_short(depth):
+            feed_hashes = None
+
+        # lookups on a single hash do not make the feed resident, just that hash is loaded for them
+        if (feed_hashes is None) and hash_part:
+            return self._proc_load_feed_part(media_storage, media_feed, depth, hash_part)
+
+        if feed_hashes is None:
+            feed_hashes = self._proc_build_feed(media_storage, media_feed, depth)
+            if feed_hashes is None:
+                return None
+            hash_index.set_feed(collection_name, media_feed, feed_hashes)
+            return feed_hashes
+
+        # removals (incl. the pass-mode replacements) by other processes make the resident feed reloaded,
+        # in the background; it is marked outdated until then, for its results to be checked
+        removed_count = media_storage.get_removed_count()
+        if (removed_count is None) or (removed_count != feed_hashes.removed_count):
+            feed_hashes.outdated = True
+        if feed_hashes.outdated or feed_hashes.is_stale(INDEX_RELOAD_INTERVAL):
+            self._proc_reload_feed(media_storage, media_feed, depth)
+
+        load_count = NO_LIMIT_COUNT
+        if depth is not None:
+            load_count = depth - 1
+        sync_timepoint = datetime.datetime.utcnow() - datetime.timedelta(seconds=INDEX_SYNC_OVERLAP)
+
+        # a resident feed is just brought up to date, by media saved meanwhile by other processes;
+        # the overlap takes the media timed before, yet saved after the previous read
+        loaded = self._proc_read_feed_hashes(media_storage, media_feed, load_count, feed_hashes.synced_on)
+        if loaded is None:
+            return None
+        # with at least depth new media, there may be a gap before them; they alone are then the latest media
+        if (depth is not None) and (len(loaded) >= depth):
+            old_hashes = feed_hashes
+            feed_hashes = hash_index.create_feed(depth)
+            feed_hashes.removed_count = old_hashes.removed_count
+            feed_hashes.outdated = old_hashes.outdated
+            hash_index.set_feed(collection_name, media_feed, feed_hashes)
+
+        for oth_hash in reversed(loaded):
+            if feed_hashes.has_ref(oth_hash['ref']):
+                continue
+            feed_hashes.append(oth_hash['ref'], oth_hash['created_on'], oth_hash['hashes'])
+
+        if depth is not None:
+            feed_hashes.trim(2 * depth)
+        feed_hashes.synced_on = sync_timepoint
+
+        return feed_hashes
+
+    def _proc_drop_removed(self, media_storage, feed_hashes, found, ref_field='ref'):
+        # an outdated feed may hold media removed by other processes
+        if (not found) or (not feed_hashes.outdated):
+            return found
+        present_refs = media_storage.get_present_refs([one_found[ref_field] for one_found in found])
+        return [one_found for one_found in found if one_found[ref_field] in present_refs]
+
+    def _proc_load_feed_part(self, media_storage, media_feed, depth, hash_part):
+        load_count = NO_LIMIT_COUNT
+        if depth is not None:
+            load_count = depth - 1
+        if not media_storage.load_feed_hashes(media_feed, None, load_count, None, hash_part):
+            return None
+
+        loaded = []
+        while True:
+            oth_hash = media_storage.get_loaded_hash()
+            if oth_hash is None:
+                break
+            loaded.append(oth_hash)
+
+        feed_hashes = hash_index.create_feed(depth)
+        for oth_hash in reversed(loaded):
+            feed_hashes.append(oth_hash['ref'], oth_hash['created_on'], oth_hash['hashes'])
+
+        return feed_hashes
+
+    def _proc_scan_feed(self, media_storage, media_feed, depth, hash_part=None):
+        # all the feed media for the lookups, yielded as feed hashes, the most recent first:
+        # resident whole feeds as they are, otherwise streamed from the db in batches
+        if depth is None:
+            feed_hashes = self._proc_load_feed_hashes(media_storage, media_feed, None, hash_part)
+            if feed_hashes is not None:
+                yield feed_hashes
+            return
+
+        if not media_storage.load_feed_hashes(media_feed, None, NO_LIMIT_COUNT, None, hash_part):
+            return
+        while True:
+            loaded = []
+            while len(loaded) < SCAN_BATCH_SIZE:
+                oth_hash = media_storage.get_loaded_hash()
+                if oth_hash is None:
+                    break
+                loaded.append(oth_hash)
+            if not loaded:
+                return
+
+            feed_hashes = hash_index.create_feed(None)
+            for oth_hash in reversed(loaded):
+                feed_hashes.append(oth_hash['ref'], oth_hash['created_on'], oth_hash['hashes'])
+            yield feed_hashes
+
+            if len(loaded) < SCAN_BATCH_SIZE:
+                return
+
+    def _proc_collect_diffs(self, feed_diffs, media_ref, cmp_method, cmp_dim, cur_refs, cur_distances):
+        for oth_hash_ref, diff in zip(cur_refs, cur_distances):
+            if oth_hash_ref == media_ref:
+                continue
+            if not oth_hash_ref in feed_diffs:
+                feed_diffs[oth_hash_ref] = []
+            dist = self.hash_methods[cmp_method]['dist'](int(diff), cmp_dim)
+            feed_diffs[oth_hash_ref].append({'method': cmp_method, 'dim': cmp_dim, 'diff': str(int(diff)), 'dist': dist})
+
+    def _proc_compare_feed(self, feed_hashes, media_ref, cmp_parts, start, stop):
+        # the whole window of the feed is compared at once, per (method, dim)
+        feed_diffs = {}
+        for cmp_method, cmp_dim, cmp_words, cmp_threshold in cmp_parts:
+            cur_refs, cur_distances = feed_hashes.search(cmp_method, cmp_dim, cmp_words, cmp_threshold, start, stop)
+            self._proc_collect_diffs(feed_diffs, media_ref, cmp_method, cmp_dim, cur_refs, cur_distances)
+
+        return feed_diffs
+
+    def _proc_compare_feed_cascade(self, feed_hashes, media_ref, cmp_parts, cascade, start, stop):
+        # the gate hash is compared over the window, the other hashes just over the rows within the gate bound;
+        # None when the gate hash is not available for the compared media
+        gate_method, gate_dim, gate_bound = cascade
+        gate_part = None
+        for cmp_part in cmp_parts:
+            if (cmp_part[0] == gate_method) and (cmp_part[1] == gate_dim):
+                gate_part = cmp_part
+                break
+        if gate_part is None:
+            return None
+
+        rows = feed_hashes.gate(gate_method, gate_dim, gate_part[2], max(gate_bound, gate_part[3]), start, stop)
+        if rows is None:
+            return None
+        media_stats.incr('compare_cascade_rows', stop - start)
+        media_stats.incr('compare_cascade_passed', len(rows))
+
+        feed_diffs = {}
+        if not len(rows):
+            return feed_diffs
+        for cmp_method, cmp_dim, cmp_words, cmp_threshold in cmp_parts:
+            cur_refs, cur_distances = feed_hashes.search_rows(cmp_method, cmp_dim, cmp_words, cmp_threshold, rows)
+            self._proc_collect_diffs(feed_diffs, media_ref, cmp_method, cmp_dim, cur_refs, cur_distances)
+
+        return feed_diffs
+
     def _proc_compare_media_hash(self, media_storage, media_ref, cmp_hash, timepoint, limit_count):
         found_similar = []
 
         feeds = media_storage.get_feeds()
         if not feeds:
             return found_similar
-        feed_rank = 0
-        is_loaded = False
-
-        while True:
-            oth_hash = None
-            if is_loaded:
-                oth_hash = media_storage.get_loaded_hash()
-                if oth_hash is None:
-                    is_loaded = False
 
-            if not is_loaded:
-                if feed_rank >= len(feeds):
-                    break
-                media_storage.load_feed_hashes(feeds[feed_rank], timepoint, limit_count)
-                is_loaded = True
-                feed_rank += 1
+        if not limit_count:
+            limit_count = media_storage.get_limit()
+        depth = hash_index.get_depth(limit_count)
 
-            if oth_hash is None:
+        cmp_parts = []
+        for cmp_hash_part in cmp_hash:
+            cmp_method = cmp_hash_part['method']
+            if not cmp_method in self.hash_methods:
+                continue
+            cmp_words = packed_to_words(packed_from_hex(cmp_hash_part['repr']))
+            if cmp_words is None:
                 continue
+            cmp_threshold = self._alg_get_threshold(cmp_method, cmp_hash_part['dim'])
+            cmp_parts.append((cmp_method, cmp_hash_part['dim'], cmp_words, cmp_threshold))
 
-            oth_hash_ref = oth_hash['ref']
-            if oth_hash_ref == media_ref:
+        cascade = hash_index.get_cascade()
+
+        for one_feed in feeds:
+            feed_hashes = self._proc_load_feed_hashes(media_storage, one_feed, depth)
+            if feed_hashes is None:
                 continue
 
-            oth_hash_evals = {}
-            for oth_hash_part in oth_hash['hashes']:
-                oth_hash_key = str(oth_hash_part['method']) + '-' + str(oth_hash_part['dim'])
-                if not oth_hash_key in oth_hash_evals:
-                    oth_hash_evals[oth_hash_key] = []
-                oth_hash_evals[oth_hash_key].append(oth_hash_part)
-
-            cur_diffs = []
-            for cmp_hash_part in cmp_hash:
-                cmp_hash_key = str(cmp_hash_part['method']) + '-' + str(cmp_hash_part['dim'])
-                if not cmp_hash_key in oth_hash_evals:
-                    continue
-                for oth_hash_part in oth_hash_evals[cmp_hash_key]:
-                    cur_compared = self._alg_compare_hashes(cmp_hash_part['method'], cmp_hash_part['dim'], cmp_hash_part['obj'], oth_hash_part['repr'])
-                    if (not cur_compared) or (not cur_compared['similar']):
-                        continue
-                    cur_diffs.append({'method': cmp_hash_part['method'], 'dim': cmp_hash_part['dim'], 'diff': str(cur_compared['diff']), 'dist': cur_compared['dist']})
-            if cur_diffs:
-                found_similar.append({'ref': oth_hash_ref, 'evals': cur_diffs})
+            start, stop = feed_hashes.window(timepoint, depth)
+            feed_diffs = None
+            if cascade is not None:
+                feed_diffs = self._proc_compare_feed_cascade(feed_hashes, media_ref, cmp_parts, cascade, start, stop)
+            if feed_diffs is None:
+                feed_diffs = self._proc_compare_feed(feed_hashes, media_ref, cmp_parts, start, stop)
+            elif hash_index.get_cascade_verify():
+                full_diffs = self._proc_compare_feed(feed_hashes, media_ref, cmp_parts, start, stop)
+                missed = [oth_hash_ref for oth_hash_ref in full_diffs if full_diffs[oth_hash_ref] != feed_diffs.get(oth_hash_ref)]
+                media_stats.incr('compare_cascade_verified')
+                if missed:
+                    media_stats.incr('compare_cascade_missed', len(missed))
+                    logging.warning('comparison cascade missed similar media of ' + str(media_ref) + ': ' + ', '.join([str(one_ref) for one_ref in missed]))
+                feed_diffs = full_diffs
+
+            # taking the most recent media first, as when read from the db
+            feed_similar = []
+            for oth_hash_ref in reversed(feed_hashes.refs[start:stop]):
+                if oth_hash_ref in feed_diffs:
+                    feed_similar.append({'ref': oth_hash_ref, 'evals': feed_diffs[oth_hash_ref]})
+            found_similar.extend(self._proc_drop_removed(media_storage, feed_hashes, feed_similar))
 
         return found_similar
 
@@ -245,6 +563,7 @@ class MediaSearch(object):
 
     def _action_list_entries(self, storage, params):
         links = [{'entry': MEDIA_ENTRY_NAME, 'path': self._out_get_base_path(MEDIA_ENTRY_NAME)}]
+        links.append({'entry': STATS_ENTRY_NAME, 'path': self._out_get_base_path(STATS_ENTRY_NAME)})
 
         total = len(links)
         if params['offset'] is not None:
@@ -254,6 +573,21 @@ class MediaSearch(object):
 
         return {'items': links, 'total': total}
 
+    def _action_list_stats(self, params):
+        values = media_stats.get_values()
+
+        items = []
+        for name in sorted(values.keys()):
+            items.append({'name': name, 'value': values[name]})
+
+        total = len(items)
+        if params['offset'] is not None:
+            items = items[params['offset']:]
+        if params['limit'] is not None:
+            items = items[:params['limit']]
+
+        return {'items': items, 'total': total}
+
     def _action_list_providers(self, storage, entry, params):
         providers = storage.list_providers()
 
@@ -303,14 +637,19 @@ class MediaSearch(object):
         action_list = {
             'GET': [
                 {'name': 'select', 'action': '_select'},
-                {'name': 'search', 'action': '_search'}
+                {'name': 'search', 'action': '_search'},
+                {'name': 'jobs', 'action': JOBS_ACTION_NAME},
+                {'name': 'nearest', 'action': NEAREST_ACTION_NAME},
+                {'name': 'search_hash', 'action': SEARCH_HASH_ACTION_NAME}
             ],
             'POST': [
                 {'name': 'create', 'action': None},
                 {'name': 'drop', 'action': '_drop'},
                 {'name': 'insert', 'action': '_insert'},
+                {'name': 'insert_batch', 'action': '_insert_batch'},
                 {'name': 'update', 'action': '_update'},
-                {'name': 'delete', 'action': '_delete'}
+                {'name': 'delete', 'action': '_delete'},
+                {'name': 'nearest', 'action': NEAREST_ACTION_NAME}
             ],
         }
 
@@ -327,12 +666,156 @@ class MediaSearch(object):
 
         return {'items': links, 'total': total}
 
+    def _action_nearest_media(self, media_storage, hashes, params):
+        # over all the feed media, not just those the inserts compare against
+        found_nearest = []
+
+        feeds = media_storage.get_feeds()
+        if not feeds:
+            return found_nearest
+        if params['feed']:
+            feeds = [one_feed for one_feed in feeds if one_feed == params['feed']]
+
+        depth = hash_index.get_depth(media_storage.get_limit())
+        count = params['limit']
+        if count is None:
+            count = NEAREST_COUNT
+
+        queries = []
+        for one_hash in hashes['evals']:
+            if not one_hash['method'] in self.hash_methods:
+                continue
+            cmp_words = packed_to_words(packed_from_hex(one_hash['repr']))
+            if cmp_words is None:
+                continue
+            queries.append((one_hash['method'], one_hash['dim'], cmp_words, one_hash['dim'] * one_hash['dim']))
+
+        for one_feed in feeds:
+            # the closest of each batch, the most recent first on equal distances, as the batches come
+            feed_closest = []
+            for feed_hashes in self._proc_scan_feed(media_storage, one_feed, depth):
+                start, stop = feed_hashes.window(None, None)
+                batch_closest = feed_hashes.nearest(queries, count, start, stop)
+                batch_refs = [one_closest[0] for one_closest in batch_closest]
+                present_refs = set([one_found['ref'] for one_found in self._proc_drop_removed(media_storage, feed_hashes, [{'ref': one_ref} for one_ref in batch_refs])])
+                feed_closest.extend([one_closest for one_closest in batch_closest if one_closest[0] in present_refs])
+            feed_closest.sort(key=lambda one_closest: one_closest[1])
+
+            feed_nearest = []
+            for oth_hash_ref, least_dist, diffs in feed_closest[:count]:
+                evals = []
+                for query, diff in zip(queries, diffs):
+                    if diff is None:
+                        continue
+                    cmp_method, cmp_dim = query[0], query[1]
+                    dist = self.hash_methods[cmp_method]['dist'](diff, cmp_dim)
+                    evals.append({'method': cmp_method, 'dim': cmp_dim, 'diff': str(diff), 'dist': dist, 'similar': (diff <= self._alg_get_threshold(cmp_method, cmp_dim))})
+                if (params['threshold'] is not None) and (min([one_eval['dist'] for one_eval in evals]) > params['threshold']):
+                    continue
+                feed_nearest.append({'ref': oth_hash_ref, 'feed': one_feed, 'evals': evals})
+            found_nearest.extend(feed_nearest)
+
+        return found_nearest
+
+    def _proc_parse_hash_value(self, hash_hex, hash_int, dimension):
+        # hex as in the hash repr, or integer as stored for 64 bit hashes: little-endian, signed or not
+        hash_bits = dimension * dimension
+        if hash_hex:
+            packed = packed_from_hex(hash_hex)
+            if (packed is None) or ((len(packed) * 8) != hash_bits):
+                return None
+            return packed
+
+        if hash_int:
+            try:
+                value = int(hash_int)
+            except:
+                return None
+            if value < 0:
+                value += 2 ** hash_bits
+            if (value < 0) or (value >= 2 ** hash_bits):
+                return None
+            packed = []
+            for rank in range(hash_bits // 8):
+                packed.append(struct.pack('<B', value & 0xff))
+                value >>= 8
+            return b''.join(packed)
+
+        return None
+
+    def _action_search_hash(self, media_storage, params):
+        # over all the feed media, as for _nearest
+        found_media = []
+
+        method_name = params['method']
+        dimension = params['dim']
+        cmp_words = packed_to_words(self._proc_parse_hash_value(params['hex'], params['int'], dimension))
+        threshold = self._alg_get_threshold(method_name, dimension)
+
+        feeds = media_storage.get_feeds()
+        if not feeds:
+            return {'items': found_media, 'total': 0}
+        if params['feed']:
+            feeds = [one_feed for one_feed in feeds if one_feed == params['feed']]
+
+        depth = hash_index.get_depth(media_storage.get_limit())
+
+        for one_feed in feeds:
+            for feed_hashes in self._proc_scan_feed(media_storage, one_feed, depth, (method_name, dimension)):
+                start, stop = feed_hashes.window(None, None)
+                cur_refs, cur_distances = feed_hashes.search(method_name, dimension, cmp_words, threshold, start, stop)
+                # taking the most recent media first on equal distances
+                feed_media = []
+                for oth_hash_ref, diff in reversed(list(zip(cur_refs, cur_distances))):
+                    dist = self.hash_methods[method_name]['dist'](int(diff), dimension)
+                    if (params['threshold'] is not None) and (dist > params['threshold']):
+                        continue
+                    feed_media.append({'ref': oth_hash_ref, 'feed': one_feed, 'method': method_name, 'dim': dimension, 'diff': str(int(diff)), 'dist': dist})
+                found_media.extend(self._proc_drop_removed(media_storage, feed_hashes, feed_media))
+
+        found_media.sort(key=lambda one_media: one_media['dist'])
+
+        total = len(found_media)
+        if params['offset'] is not None:
+            found_media = found_media[params['offset']:]
+        if params['limit'] is not None:
+            found_media = found_media[:params['limit']]
+
+        return {'items': found_media, 'total': total}
+
+    def _do_nearest(self, storage, provider, archive, media, params):
+        # GET and POST alike; nothing is stored, the media is just hashed and compared
+        if media.get('data'):
+            hashes = self._proc_make_data_hash(media['data'], media['mime'])
+        else:
+            for one_part in ['url', 'mime']:
+                if not media.get(one_part):
+                    logging.warning('nearest media: not passed through checks: ' + str(one_part))
+                    return self._answer_on_wrong(404, 'nearest media: not passed through checks: ' + str(one_part))
+            hashes = self._proc_make_media_hash(media['url'], media['mime'])
+
+        if (not hashes) or (not hashes['evals']):
+            return self._answer_on_wrong(404, 'nearest media: can not hash the media')
+
+        meta = {'base': self._out_get_base_path(MEDIA_ENTRY_NAME, provider, archive)}
+
+        res = []
+        storage.set_storage(provider, archive, False)
+        if not storage.is_correct():
+            return self._answer_on_wrong(500)
+        if storage.storage_set():
+            res = self._action_nearest_media(storage, hashes, params)
+
+        return self._answer_on_items(200, meta, res)
+
     def _action_select_media(self, storage, params):
-        res = storage.get_feed_media(params['ref'], params['feed'], params['with'], params['without'], params['order'], params['offset'], params['limit'])
+        res = storage.get_feed_media(params['ref'], params['feed'], params['with'], params['without'], params['order'], params['offset'], params['limit'], params['after'], params['total'])
         return res
 
     def _action_search_media(self, storage, params):
-        res = storage.get_alike_media(params['ref'], params['feed'], params['with'], params['without'], params['threshold'], params['order'], params['offset'], params['limit'])
+        if params['group']:
+            return storage.get_alike_groups(params['ref'], params['feed'], params['with'], params['without'], params['threshold'], params['order'], params['offset'], params['limit'])
+        res = storage.get_alike_media(params['ref'], params['feed'], params['with'], params['without'], params['threshold'], params['order'], params['offset'], params['limit'], params['after'], params['total'])
         return res
 
     def _action_set_limit(self, media_storage, limit_count):
@@ -340,27 +823,30 @@ class MediaSearch(object):
         return bool(rv)
 
     def _action_drop_provider_archive(self, media_storage, force_mode):
+        collection_name = media_storage.get_collection_name()
         rv = media_storage.drop_provider_archive(force_mode)
+        if rv:
+            hash_index.drop_collection(collection_name)
         return bool(rv)
 
-    def _action_insert_media_hash(self, media_storage, media_fields, pass_mode, limit_count):
+    def _proc_check_new_media(self, media_storage, media_fields, pass_mode):
 
-        check_media = media_storage.get_ref_media(media_fields['ref'])
+        check_media = media_storage.get_ref_media(media_fields['ref'], REMOVE_FIELDS)
         if check_media:
             if not pass_mode:
                 return False
             else:
                 self._proc_remove_media(media_storage, check_media, True)
 
+        return True
+
+    def _proc_store_media_hash(self, media_storage, media_fields, hashes, pass_mode, limit_count):
+
         store_fields = {}
         store_fields['ref'] = media_fields['ref']
         store_fields['feed'] = media_fields['feed']
         store_fields['tags'] = media_fields['tags']
 
-        hashes = self._proc_make_media_hash(media_fields['url'], media_fields['mime'])
-        if (not hashes) or (not hashes['evals']):
-            return False
-
         store_hashes = []
         for one_hash in hashes['evals']:
             store_hashes.append({'method': one_hash['method'], 'dim': one_hash['dim'], 'repr': one_hash['repr']})
@@ -380,22 +866,119 @@ class MediaSearch(object):
         if media_ref is None:
             return False
 
+        index_hashes = []
+        for one_hash in store_hashes:
+            index_hashes.append({'method': one_hash['method'], 'dim': one_hash['dim'], 'packed': packed_from_hex(one_hash['repr'])})
+        hash_index.add_media(media_storage.get_collection_name(), store_fields['feed'], media_ref, timepoint, index_hashes)
+
         similar = self._proc_compare_media_hash(media_storage, media_ref, hashes['evals'], timepoint, limit_count)
         if not similar:
             similar = []
 
         if similar:
             timepoint = datetime.datetime.utcnow()
-            media_storage.append_alike_media(media_ref, similar, timepoint)
-            for similar_item in similar:
-                media_storage.append_alike_media(similar_item['ref'], {'ref': media_ref, 'evals': similar_item['evals']}, timepoint)
+            written_count = media_storage.append_alike_links(media_ref, similar, timepoint)
+            if written_count is None:
+                logging.warning('can not link similar media of: ' + str(media_ref))
+            else:
+                media_stats.incr('alike_docs_written', written_count)
+                logging.info('documents modified by alike links of ' + str(media_ref) + ': ' + str(written_count))
 
         return [{'ref': media_ref}]
 
+    def _action_insert_media_hash(self, media_storage, media_fields, pass_mode, limit_count):
+
+        if not self._proc_check_new_media(media_storage, media_fields, pass_mode):
+            return False
+
+        hashes = self._proc_make_media_hash(media_fields['url'], media_fields['mime'])
+        if (not hashes) or (not hashes['evals']):
+            return False
+
+        return self._proc_store_media_hash(media_storage, media_fields, hashes, pass_mode, limit_count)
+
+    def _action_queue_media_hash(self, provider, archive, media_fields, pass_mode, limit_count):
+
+        job = insert_jobs.queue_job(provider, archive, media_fields, pass_mode, limit_count)
+        if not job:
+            return None
+
+        # workers of this process start on the first use, if not started by the server
+        insert_jobs.prepare(run_insert_job)
+
+        job_path = self._out_get_base_path(MEDIA_ENTRY_NAME, job['provider'], job['archive'], JOBS_ACTION_NAME) + '/' + job['_id']
+        return [{'job': job['_id'], 'ref': media_fields['ref'], 'state': job['state'], 'path': job_path}]
+
+    def _run_insert_job(self, media_storage, job):
+        # as _action_insert_media_hash, with stages noted at the job, and timed
+        job_id = job['_id']
+        media_fields = job['media']
+
+        media_storage.set_storage(job['provider'], job['archive'], False)
+        if (not media_storage.is_correct()) or (not media_storage.storage_set()):
+            return (STATE_FAILED, 'storage')
+
+        # a previous attempt stopped while storing may have left the media without its links;
+        # the media stored after the job was queued is its own, replaced with all its links again
+        pass_mode = job['pass']
+        if 'store' == job.get('stage'):
+            stored_media = media_storage.get_ref_media(media_fields['ref'], [CREATED_FIELD])
+            if stored_media and (stored_media.get(CREATED_FIELD) is not None) and (stored_media[CREATED_FIELD] >= job['created_on']):
+                logging.info('insert job resumed after its store stage, storing again: ' + str(job_id))
+                pass_mode = True
+
+        if not insert_jobs.set_stage(job, 'check'):
+            return (STATE_FAILED, REASON_LEASE)
+        stage_start = time.time()
+        checked = self._proc_check_new_media(media_storage, media_fields, pass_mode)
+        media_stats.timing('insert_jobs_check', time.time() - stage_start)
+        if not checked:
+            return (STATE_FAILED, REASON_EXISTS)
+
+        if not insert_jobs.set_stage(job, 'fetch'):
+            return (STATE_FAILED, REASON_LEASE)
+        stage_start = time.time()
+        fetched_media = self._proc_fetch_media(media_fields['url'], media_fields['mime'])
+        media_stats.timing('insert_jobs_fetch', time.time() - stage_start)
+        if not fetched_media:
+            return (STATE_FAILED, REASON_FETCH)
+
+        if not insert_jobs.set_stage(job, 'hash'):
+            return (STATE_FAILED, REASON_LEASE)
+        stage_start = time.time()
+        hashes = self._proc_hash_fetched_media(fetched_media)
+        media_stats.timing('insert_jobs_hash', time.time() - stage_start)
+        if (not hashes) or (not hashes['evals']):
+            return (STATE_FAILED, REASON_HASH)
+
+        if not insert_jobs.set_stage(job, 'store'):
+            return (STATE_FAILED, REASON_LEASE)
+        stage_start = time.time()
+        stored = self._proc_store_media_hash(media_storage, media_fields, hashes, job['pass'], job['limit'])
+        media_stats.timing('insert_jobs_store', time.time() - stage_start)
+        if not stored:
+            return (STATE_FAILED, REASON_STORE)
+
+        return (STATE_DONE, None)
+
+    def _action_get_job(self, provider, archive, job_id):
+        job = insert_jobs.get_job(provider, archive, job_id)
+        if not job:
+            return None
+        return [job]
+
+    def _action_list_jobs(self, provider, archive, params):
+        return insert_jobs.list_jobs(provider, archive, params['offset'], params['limit'])
+
+    def _action_insert_media_batch(self, media_storage, media_list, pass_mode, limit_count):
+
+        pipeline = InsertPipeline(self, media_storage, pass_mode, limit_count, hash_workers=max(HASH_WORKERS, hash_workers.get_count()))
+        return pipeline.run(media_list)
+
     def _action_update_media_hash(self, media_storage, media_fields, tags_mode, pass_mode):
 
         if not pass_mode:
-            check_media = media_storage.get_ref_media(media_fields['ref'])
+            check_media = media_storage.get_ref_media(media_fields['ref'], ['_id'])
             if not check_media:
                 return False
 
@@ -408,7 +991,7 @@ class MediaSearch(object):
 
     def _action_delete_media_hash(self, media_storage, media_fields, pass_mode):
 
-        check_media = media_storage.get_ref_media(media_fields['ref'])
+        check_media = media_storage.get_ref_media(media_fields['ref'], REMOVE_FIELDS)
         if not check_media:
             return bool(pass_mode)
 
@@ -475,6 +1058,11 @@ class MediaSearch(object):
 
             if entry is None:
                 res = self._action_list_entries(storage, params_use)
+            elif STATS_ENTRY_NAME == entry:
+                if provider is not None:
+                    logging.warning('GET request: unknown stats part')
+                    return self._answer_on_wrong(404, 'unknown stats part')
+                res = self._action_list_stats(params_use)
             else:
                 if MEDIA_ENTRY_NAME != entry:
                     logging.warning('GET request: unknown entry')
@@ -496,16 +1084,30 @@ class MediaSearch(object):
             if (not provider) or (not archive):
                 logging.warning('GET request: provider and archive have to be specified')
                 return self._answer_on_wrong(404, 'provider and archive have to be specified')
-            if action not in ['_select', '_search']:
+            if action not in ['_select', '_search', JOBS_ACTION_NAME, NEAREST_ACTION_NAME, SEARCH_HASH_ACTION_NAME]:
                 logging.warning('GET request: unknown action')
                 return self._answer_on_wrong(404, 'unknown action')
 
+            if action in [NEAREST_ACTION_NAME]:
+                params_use = {}
+                for one_key in ['feed', 'threshold', 'limit']:
+                    params_use[one_key] = params[one_key]
+                return self._do_nearest(storage, provider, archive, {'url': params['url'], 'mime': params['mime']}, params_use)
+
             storage.set_storage(provider, archive, False)
             if not storage.is_correct():
                 return self._answer_on_wrong(500)
 
-            select_keys = ['ref', 'feed', 'with', 'without', 'order', 'offset', 'limit']
-            search_keys = ['ref', 'feed', 'with', 'without', 'threshold', 'order', 'offset', 'limit']
+            select_keys = ['ref', 'feed', 'with', 'without', 'order', 'offset', 'limit', 'after', 'total']
+            search_keys = ['ref', 'feed', 'with', 'without', 'threshold', 'order', 'offset', 'limit', 'after', 'total', 'group']
+
+            if action in ['_select', '_search']:
+                if (params['total'] is not None) and (params['total'] not in TOTAL_MODES):
+                    logging.warning('GET request: unknown total mode')
+                    return self._answer_on_wrong(404, 'total has to be one of: ' + ', '.join(TOTAL_MODES))
+                if params['after'] and params['group']:
+                    logging.warning('search media: after token used for grouped search')
+                    return self._answer_on_wrong(404, 'search media: after token not available for grouped search')
 
             if action in ['_select']:
                 if (not params['ref']) and (not params['feed']):
@@ -518,6 +1120,9 @@ class MediaSearch(object):
                     for one_key in select_keys:
                         params_use[one_key] = params[one_key]
                     res = self._action_select_media(storage, params_use)
+                    if res is None:
+                        logging.warning('select media: wrong after token')
+                        return self._answer_on_wrong(404, 'select media: wrong after token')
 
             if action in ['_search']:
                 if not params['ref']:
@@ -530,17 +1135,53 @@ class MediaSearch(object):
                     for one_key in search_keys:
                         params_use[one_key] = params[one_key]
                     res = self._action_search_media(storage, params_use)
+                    if res is None:
+                        logging.warning('search media: wrong after token')
+                        return self._answer_on_wrong(404, 'search media: wrong after token')
+
+            if action in [SEARCH_HASH_ACTION_NAME]:
+                if (params['method'] not in self.hash_methods) or (params['dim'] not in self.hash_methods[params['method']]['dims']):
+                    logging.warning('search hash: unknown hash method or dimension')
+                    return self._answer_on_wrong(404, 'search hash: unknown hash method or dimension')
+                if self._proc_parse_hash_value(params['hex'], params['int'], params['dim']) is None:
+                    logging.warning('search hash: hex or int hash value of the dimension not provided')
+                    return self._answer_on_wrong(404, 'search hash: hex or int hash value of the dimension not provided')
+
+                res = []
+                if storage.storage_set():
+                    params_use = {}
+                    for one_key in ['method', 'dim', 'hex', 'int', 'feed', 'threshold', 'offset', 'limit']:
+                        params_use[one_key] = params[one_key]
+                    res = self._action_search_hash(storage, params_use)
+
+            if action in [JOBS_ACTION_NAME]:
+                res = []
+                if params.get('job'):
+                    if not ALLOWED_SPEC.match(str(params['job'])):
+                        logging.warning('GET request: bad job id')
+                        return self._answer_on_wrong(404, 'job id has to be a-zA-Z_-')
+                    res = None
+                    if storage.storage_set():
+                        res = self._action_get_job(provider, archive, params['job'])
+                elif storage.storage_set():
+                    params_use = {}
+                    for one_key in ['offset', 'limit']:
+                        params_use[one_key] = params[one_key]
+                    res = self._action_list_jobs(provider, archive, params_use)
 
         if res is None:
             return self._answer_on_wrong(404)
         else:
-            if 'total' in res:
-                meta['total'] = res['total']
-            if 'items' in res:
-                res = res['items']
+            # listings come as {items, total, next}, single items and unset archives as plain lists
+            if type(res) is dict:
+                if 'total' in res:
+                    meta['total'] = res['total']
+                if res.get('next'):
+                    meta['next'] = res['next']
+                res = res.get('items', [])
             return self._answer_on_items(200, meta, res)
 
-    def do_post(self, storage, entry, provider, archive, action, media, tags_mode, pass_mode, force_mode, limit):
+    def do_post(self, storage, entry, provider, archive, action, media, tags_mode, pass_mode, force_mode, limit, async_mode=False, threshold=None):
         # ref: reference, id string from client media archive, possibly concatenated with archive id, etc.
         # feed: for feeds od different throughputs, like 'default', 'tweets', ...
         # url: local or remote path, like file:///tmp/image.png or http://some.domain.tld/dir/image.jpg
@@ -557,14 +1198,20 @@ class MediaSearch(object):
             logging.warning('POST request: provider and archive have to be specified')
             return self._answer_on_wrong(404, 'provider and archive have to be specified')
 
-        if not action in [None, '_drop', '_insert', '_update', '_delete']:
+        if not action in [None, '_drop', '_insert', '_insert_batch', '_update', '_delete', NEAREST_ACTION_NAME]:
             logging.warning('POST request: unknown action')
             return self._answer_on_wrong(404, 'unknown action')
 
+        if action in [NEAREST_ACTION_NAME]:
+            if type(media) is not dict:
+                logging.warning('POST request: single media expected')
+                return self._answer_on_wrong(404, 'single media expected')
+            return self._do_nearest(storage, provider, archive, media, {'feed': media.get('feed'), 'threshold': threshold, 'limit': limit})
+
         # to only force the storage creation on _insert
         # end immediately if storage is not set
         to_force_storage = False
-        storage_necessary = [None, '_insert']
+        storage_necessary = [None, '_insert', '_insert_batch']
         if action in storage_necessary:
             to_force_storage = True
 
@@ -586,6 +1233,9 @@ class MediaSearch(object):
         res = None
 
         if action in ['_insert', '_update', '_delete']:
+            if type(media) is not dict:
+                logging.warning('POST request: single media expected')
+                return self._answer_on_wrong(404, 'single media expected')
             if ('ref' in media) and media['ref']:
                 if not ALLOWED_SPEC.match(str(media['ref'])):
                     logging.warning('POST request: bad ref parameter')
@@ -606,10 +1256,47 @@ class MediaSearch(object):
                     logging.warning('insert media hash, not passed through checks: ' + str(one_part))
                     return self._answer_on_wrong(404, 'insert media hash, not passed through checks: ' + str(one_part))
                 media_use[one_part] = media[one_part]
+            if async_mode:
+                res = self._action_queue_media_hash(provider, archive, media_use, pass_mode, limit)
+                if res is None:
+                    return self._answer_on_wrong(500, 'can not queue insert job')
+                return self._answer_on_action(202, meta, res)
             res = self._action_insert_media_hash(storage, media_use, pass_mode, limit)
             if not res:
                 res = None
 
+        if action in ['_insert_batch']:
+            if (type(media) is not list) or (not media):
+                logging.warning('insert media batch, no media list provided')
+                return self._answer_on_wrong(404, 'insert media batch, no media list provided')
+            if len(media) > MAX_BATCH_ITEMS:
+                logging.warning('insert media batch, too many media: ' + str(len(media)))
+                return self._answer_on_wrong(404, 'insert media batch, too many media, max: ' + str(MAX_BATCH_ITEMS))
+
+            res = []
+            media_list = []
+            media_ranks = []
+            for one_media in media:
+                res.append({'ref': one_media['ref'], 'status': STATUS_FAILED})
+                media_use = {'tags': one_media['tags']}
+                for one_part in ['ref', 'feed', 'url', 'mime']:
+                    if not one_media[one_part]:
+                        res[-1]['reason'] = 'checks: ' + str(one_part)
+                        break
+                    media_use[one_part] = one_media[one_part]
+                if 'reason' in res[-1]:
+                    continue
+                if not ALLOWED_SPEC.match(str(one_media['ref'])):
+                    res[-1]['reason'] = 'checks: ref'
+                    continue
+                media_list.append(media_use)
+                media_ranks.append(len(res) - 1)
+
+            if media_list:
+                done = self._action_insert_media_batch(storage, media_list, pass_mode, limit)
+                for one_rank, one_done in zip(media_ranks, done):
+                    res[one_rank] = one_done
+
         if action in ['_update']:
             media_use = {'tags': media['tags']}
             for one_part in ['ref']:
@@ -645,3 +1332,10 @@ class MediaSearch(object):
             return self._answer_on_wrong(404)
         else:
             return self._answer_on_action(200, meta, res)
+
+def run_insert_job(job):
+    '''
+    Runs a queued insert job, in a worker thread of insert_jobs
+    '''
+    media_storage = HashStorage(mongo_dbs.get_db())
+    return MediaSearch()._run_insert_job(media_storage, job)
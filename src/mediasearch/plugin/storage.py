@@ -15,27 +15,87 @@ storage data: collection "storages"
     archive: String(a-zA-Z0-9_-) <= archive_name,
     created_on: Datetime, sets on creation,
     updated_on: Datetime, sets on changes,
-    limit_count: Integer, limiting the sets for similarity comparison
+    limit_count: Integer, limiting the sets for similarity comparison,
+    layout: String(embedded|edges), where the similarity links are kept, embedded if not set,
+    layout_switched_on: Datetime, sets when switched to the edges layout by a migration,
+    removed_count: Integer, bumped on each media removal, for resident hash indexes to notice them
+}
+
+storage rank sequence: collection "storage_ranks"
+ranks are not reused after an archive removal, since other processes may hold the rank cached
+{
+    _id: String <= "storages",
+    last_rank: Integer, the last rank given, not less than the ranks of the archives made before the sequence
 }
 
 media data: collections "storage_%N"
 {
     _id: String(a-zA-Z0-9_-) <= reference:unique index,
     feed: String(default|tweets|...)
-    hashes: [{method: String(dhash|phash|...), dim: Integer(8|16|32|64), repr: String(0x0-f)}],
+    hashes: [{method: String(dhash|phash|...), dim: Integer(8|16|32|64), repr: Int64(8x8)|BinData(larger)|String(0x0-f, legacy)}],
     alike: [{ref: String<=_id, evals:[{method: String(dhash|phash|...), dim: Integer(8|16|32|64), diff: Number, dist: Number}]}],
     tags: [String(a-zA-Z0-9_-)],
     created_on: Datetime, sets on new hash save, i.e. on _insert,
     updated_on: Datetime, sets on tags changes, i.e. on _update,
-    reliked_on: Datetime, sets when a similar media is added or removed
+    reliked_on: Datetime, sets when a similar media is added or removed,
+    schema_version: Integer, 2 since the Int64/BinData hash forms, missing for the legacy hex strings
+}
+indexes: (feed, created_on, _id), (feed, tags, created_on, _id), (feed, _id), (feed, updated_on, _id), (feed, reliked_on, _id)
+
+similarity links for the edges layout: collections "storage_%N_edges"
+the alike arrays are not used then, each link is kept in both directions
+{
+    _id: String <= ref_a/ref_b/method/dim,
+    ref_a: String <= _id of media,
+    ref_b: String <= _id of similar media,
+    method: String(dhash|phash|...),
+    dim: Integer(8|16|32|64),
+    diff: Number,
+    dist: Number
 }
 '''
 
-import sys, os
-import logging, datetime
+import sys, os, time
+import logging, datetime, threading
+import struct, binascii, base64
+from collections import OrderedDict
+try:
+    from bson import BSON
+except:
+    BSON = None
+try:
+    from bson.binary import Binary
+except:
+    Binary = None
+try:
+    from bson.int64 import Int64
+except:
+    Int64 = int
+try:
+    from pymongo import UpdateOne
+except:
+    UpdateOne = None
+try:
+    from pymongo import ReturnDocument
+except:
+    ReturnDocument = None
+from mediasearch.utils.stats import media_stats
+
+try:
+    long
+except:
+    long = int
+
+try:
+    unicode()
+except:
+    unicode = str
 
 COLLECTION_GENERAL = 'storages'
 COLLECTION_PARTICULAR = 'storage_{rank}'
+COLLECTION_EDGES = 'storage_{rank}_edges'
+COLLECTION_RANKS = 'storage_ranks'
+LAST_RANK_FIELD = 'last_rank'
 PROVIDER_FIELD = 'provider'
 ARCHIVE_FIELD = 'archive'
 CREATED_FIELD = 'created_on'
@@ -44,8 +104,139 @@ RELIKED_FIELD = 'reliked_on'
 FEED_FIELD = 'feed'
 TAGS_FIELD = 'tags'
 LIMIT_COUNT_FIELD = 'limit_count'
+HASHES_FIELD = 'hashes'
+HASH_REPR_FIELD = 'repr'
+HASH_INT_BYTES = 8
+SCHEMA_VERSION_FIELD = 'schema_version'
+SCHEMA_VERSION = 2
+LAYOUT_FIELD = 'layout'
+LAYOUT_SWITCHED_FIELD = 'layout_switched_on'
+REMOVED_COUNT_FIELD = 'removed_count'
+LAYOUT_EMBEDDED = 'embedded'
+LAYOUT_EDGES = 'edges'
+LAYOUTS = [LAYOUT_EMBEDDED, LAYOUT_EDGES]
+EDGE_REF_A = 'ref_a'
+EDGE_REF_B = 'ref_b'
+EDGE_EVAL_FIELDS = ['method', 'dim', 'diff', 'dist']
 DEFAULT_LIMIT_COUNT = 1000
 MIN_LIMIT_COUNT = 100
+NO_LIMIT_COUNT = -1
+LISTED_FIELDS = [FEED_FIELD, TAGS_FIELD, CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD]
+LISTED_PROJECTION = dict([(one_field, 1) for one_field in LISTED_FIELDS])
+LOADED_PROJECTION = {HASHES_FIELD: 1, CREATED_FIELD: 1}
+EDGE_PROJECTION = dict([(one_field, 1) for one_field in [EDGE_REF_A, EDGE_REF_B] + EDGE_EVAL_FIELDS])
+TOTAL_EXACT = 'exact'
+TOTAL_APPROX = 'approx'
+TOTAL_SKIP = 'skip'
+TOTAL_MODES = [TOTAL_EXACT, TOTAL_APPROX, TOTAL_SKIP]
+APPROX_TOTAL_COUNT = 10000
+# feed slices, in the orders they are listed and loaded in, tag filters within feeds
+MEDIA_INDEXES = [
+    [(FEED_FIELD, 1), (CREATED_FIELD, -1), ('_id', 1)],
+    [(FEED_FIELD, 1), (TAGS_FIELD, 1), (CREATED_FIELD, -1), ('_id', 1)],
+    [(FEED_FIELD, 1), ('_id', 1)],
+    [(FEED_FIELD, 1), (UPDATED_FIELD, -1), ('_id', 1)],
+    [(FEED_FIELD, 1), (RELIKED_FIELD, -1), ('_id', 1)]
+]
+EDGE_INDEXES = [[(EDGE_REF_A, 1), ('dist', 1), (EDGE_REF_B, 1)], [(EDGE_REF_B, 1)]]
+GENERAL_INDEXES = [[(PROVIDER_FIELD, 1), (ARCHIVE_FIELD, 1)]]
+ARCHIVE_CACHE_TTL = 60
+# after a layout switch, the cached archives have expired and the requests started on them are done
+LAYOUT_SWITCH_TIME = 2 * ARCHIVE_CACHE_TTL
+# $lookup since 3.2, $facet since 3.4
+AGGREGATION_MIN_VERSION = [3, 4]
+
+class StorageLayouts(object):
+    def __init__(self, new_layout=LAYOUT_EMBEDDED):
+        self.new_layout = new_layout
+
+    def set_new_layout(self, layout):
+        if layout not in LAYOUTS:
+            return False
+        self.new_layout = layout
+        return True
+
+    def get_new_layout(self):
+        return self.new_layout
+
+storage_layouts = StorageLayouts()
+
+class ArchiveCache(object):
+    '''
+    Process-wide provider/archive resolution: {rank, limit_count, layout}
+    invalidated on changes made by this process, expiring for changes made by others
+    '''
+    def __init__(self, ttl=ARCHIVE_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = {}
+        media_stats.add_gauge('archive_cache_items', self.get_size)
+
+    def set_ttl(self, ttl):
+        with self.lock:
+            self.ttl = ttl
+            self.items = {}
+
+    def get_size(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if (item is not None) and (item[0] < time.time()):
+                del(self.items[key])
+                item = None
+        if item is None:
+            media_stats.incr('archive_cache_misses')
+            return None
+
+        media_stats.incr('archive_cache_hits')
+        return dict(item[1])
+
+    def put(self, key, resolved):
+        if not self.ttl:
+            return
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, dict(resolved))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items = {}
+
+archive_cache = ArchiveCache()
+
+class AggregationSupport(object):
+    '''
+    Whether the db runs the aggregation stages of the similar media listings,
+    detected once per process from the server version; None to detect again
+    '''
+    def __init__(self, supported=None):
+        self.lock = threading.Lock()
+        self.supported = supported
+
+    def set_supported(self, supported):
+        with self.lock:
+            self.supported = supported
+        return True
+
+    def is_supported(self, db):
+        with self.lock:
+            if self.supported is None:
+                try:
+                    version = [int(one_part) for one_part in db.client.server_info()['versionArray'][:2]]
+                except Exception as exc:
+                    logging.warning('can not detect the db version: ' + str(exc))
+                    return False
+                self.supported = (version >= AGGREGATION_MIN_VERSION)
+                if not self.supported:
+                    logging.info('db version ' + '.'.join([str(one_part) for one_part in version]) + ', the similar media are ranked out of the db')
+            return self.supported
+
+aggregation_support = AggregationSupport()
 
 class HashStorage(object):
 
@@ -59,6 +250,8 @@ class HashStorage(object):
         self.collection_name = ''
         self.collection_set = False
         self.limit_count = DEFAULT_LIMIT_COUNT
+        self.layout = LAYOUT_EMBEDDED
+        self.edges_name = ''
 
     def is_correct(self):
         return self.correct
@@ -92,6 +285,126 @@ class HashStorage(object):
     def storage_set(self):
         return self.collection_set
 
+    def get_collection_name(self):
+        return self.collection_name
+
+    def get_limit(self):
+        return self.limit_count
+
+    def get_layout(self):
+        return self.layout
+
+    def _edge_id(self, ref_a, ref_b, method, dim):
+        # refs, methods are restricted to a-zA-Z0-9_,.- thus the slash is a safe separator
+        return '/'.join([str(ref_a), str(ref_b), str(method), str(dim)])
+
+    def _write_bulk(self, collection, updates, upsert=False):
+        # unordered bulk of (spec, change) updates, on any of the driver versions
+        # returns count of modified and upserted documents
+        if (UpdateOne is not None) and hasattr(collection, 'bulk_write'):
+            result = collection.bulk_write([UpdateOne(spec, change, upsert=upsert) for spec, change in updates], ordered=False)
+            return (result.modified_count or 0) + result.upserted_count
+        if hasattr(collection, 'initialize_unordered_bulk_op'):
+            bulk = collection.initialize_unordered_bulk_op()
+            for spec, change in updates:
+                if upsert:
+                    bulk.find(spec).upsert().update_one(change)
+                else:
+                    bulk.find(spec).update_one(change)
+            result = bulk.execute()
+            return (result.get('nModified') or 0) + result['nUpserted']
+
+        updated = 0
+        for spec, change in updates:
+            result = collection.update(spec, change, upsert=upsert)
+            if not result:
+                continue
+            if result.get('upserted'):
+                updated += 1
+            else:
+                updated += result.get('nModified', result.get('n', 0))
+        return updated
+
+    def _prepare_edges(self):
+        try:
+            edges_collection = self.storage.db[self.edges_name]
+            for one_index in EDGE_INDEXES:
+                edges_collection.create_index(one_index)
+        except:
+            return False
+
+        return True
+
+    def _prepare_media(self):
+        # existing archives get their indexes built in the background, see mediasearch.utils.indexes
+        try:
+            db_collection = self.storage.db[self.collection_name]
+            for one_index in MEDIA_INDEXES:
+                db_collection.create_index(one_index)
+        except:
+            return False
+
+        return True
+
+    def _pack_hash_repr(self, hash_repr):
+        # hex representation into Int64 for 64 bit hashes, into BinData otherwise
+        if (Binary is not None) and isinstance(hash_repr, Binary):
+            return hash_repr
+        if not isinstance(hash_repr, (str, unicode)):
+            return hash_repr
+        try:
+            packed = binascii.unhexlify(str(hash_repr))
+        except:
+            return hash_repr
+
+        if HASH_INT_BYTES == len(packed):
+            return Int64(struct.unpack('<q', packed)[0])
+        if Binary is not None:
+            return Binary(packed)
+
+        return hash_repr
+
+    def _unpack_hash_repr(self, value):
+        # packed bytes out of any of the Int64, BinData, hex forms
+        try:
+            if (Binary is not None) and isinstance(value, Binary):
+                return bytes(value)
+            if isinstance(value, (int, long)) and (not isinstance(value, bool)):
+                if value < 0:
+                    return struct.pack('<q', value)
+                return struct.pack('<Q', value)
+            return binascii.unhexlify(str(value))
+        except:
+            return None
+
+    def _pack_hashes(self, hashes):
+        packed_hashes = []
+        for one_hash in hashes:
+            one_packed = dict(one_hash)
+            if HASH_REPR_FIELD in one_packed:
+                one_packed[HASH_REPR_FIELD] = self._pack_hash_repr(one_packed[HASH_REPR_FIELD])
+            packed_hashes.append(one_packed)
+        return packed_hashes
+
+    def _archive_key(self, provider=None, archive=None):
+        if provider is None:
+            provider = self.provider
+        if archive is None:
+            archive = self.archive
+        return (id(self.storage.db), provider, archive)
+
+    def _resolve_archive(self, doc):
+        resolved = {'rank': int(doc['_id']), 'limit_count': DEFAULT_LIMIT_COUNT, 'layout': LAYOUT_EMBEDDED}
+        if LIMIT_COUNT_FIELD in doc:
+            limit_count = int(doc[LIMIT_COUNT_FIELD])
+            if limit_count:
+                if limit_count < MIN_LIMIT_COUNT:
+                    limit_count = MIN_LIMIT_COUNT
+                resolved['limit_count'] = limit_count
+        if doc.get(LAYOUT_FIELD) in LAYOUTS:
+            resolved['layout'] = doc[LAYOUT_FIELD]
+        return resolved
+
     def set_storage(self, provider, archive, force):
         if not self.correct:
             return False
@@ -103,23 +416,31 @@ class HashStorage(object):
         self.collection_name = ''
         self.collection_set = False
         self.limit_count = DEFAULT_LIMIT_COUNT
+        self.layout = LAYOUT_EMBEDDED
+        self.edges_name = ''
         rank = None
         is_new = False
 
-        try:
-            collection = self.storage.db[COLLECTION_GENERAL]
-            doc = collection.find_one({PROVIDER_FIELD: provider, ARCHIVE_FIELD: archive})
-            if doc:
-                rank = int(doc['_id'])
-                if LIMIT_COUNT_FIELD in doc:
-                    limit_count = int(doc[LIMIT_COUNT_FIELD])
-                    if limit_count:
-                        if limit_count < MIN_LIMIT_COUNT:
-                            limit_count = MIN_LIMIT_COUNT
-                        self.limit_count = limit_count
-        except:
-            self.correct = False
-            return False
+        # the creating requests read the db, not to create an archive dropped by another process
+        resolved = None
+        if not force:
+            resolved = archive_cache.get(self._archive_key())
+
+        if resolved is None:
+            try:
+                collection = self.storage.db[COLLECTION_GENERAL]
+                doc = collection.find_one({PROVIDER_FIELD: provider, ARCHIVE_FIELD: archive})
+                if doc:
+                    resolved = self._resolve_archive(doc)
+                    archive_cache.put(self._archive_key(), resolved)
+            except:
+                self.correct = False
+                return False
+
+        if resolved is not None:
+            rank = resolved['rank']
+            self.limit_count = resolved['limit_count']
+            self.layout = resolved['layout']
 
         if rank is not None:
             self.collection_set = True
@@ -129,15 +450,12 @@ class HashStorage(object):
                 #prepare new rank
                 try:
                     collection = self.storage.db[COLLECTION_GENERAL]
-                    cursor = collection.find().sort([('_id', -1)]).limit(1)
-                    if not cursor.count():
-                        rank = 1
-                    else:
-                        doc = cursor.next()
-                        rank = int(doc['_id']) + 1
+                    rank = self._next_rank(collection)
                     timepoint = datetime.datetime.utcnow()
-                    collection.save({'_id': rank, PROVIDER_FIELD: provider, ARCHIVE_FIELD: archive, CREATED_FIELD: timepoint, UPDATED_FIELD: timepoint})
+                    self.layout = storage_layouts.get_new_layout()
+                    collection.save({'_id': rank, PROVIDER_FIELD: provider, ARCHIVE_FIELD: archive, CREATED_FIELD: timepoint, UPDATED_FIELD: timepoint, LAYOUT_FIELD: self.layout})
                     self.collection_set = True
+                    archive_cache.put(self._archive_key(), {'rank': rank, 'limit_count': self.limit_count, 'layout': self.layout})
                 except:
                     self.correct = False
                     self.collection_set = False
@@ -146,19 +464,41 @@ class HashStorage(object):
         if self.collection_set:
             self.collection_rank = rank
             self.collection_name = COLLECTION_PARTICULAR.format(rank=str(rank))
+            self.edges_name = COLLECTION_EDGES.format(rank=str(rank))
+
+            if is_new and (LAYOUT_EDGES == self.layout):
+                if not self._prepare_edges():
+                    return False
 
             if is_new:
-                try:
-                    db_collection = self.storage.db[self.collection_name]
-                    for one_field in [CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD]:
-                        db_collection.ensureIndex({one_field: -1})
-                    for one_field in [FEED_FIELD, TAGS_FIELD]:
-                        db_collection.ensureIndex({one_field: 1})
-                except:
+                if not self._prepare_media():
                     return False
 
         return True
 
+    def _next_rank(self, collection):
+        # a removed archive may be still cached by other processes, its rank is not to be given again
+        cursor = collection.find().sort([('_id', -1)]).limit(1)
+        top_rank = 0
+        if cursor.count():
+            top_rank = int(cursor.next()['_id'])
+
+        # the sequence starts above the archives made before it; a failed upsert is an existing sequence
+        ranks = self.storage.db[COLLECTION_RANKS]
+        try:
+            ranks.update({'_id': COLLECTION_GENERAL, LAST_RANK_FIELD: {'$lt': top_rank}}, {'$set': {LAST_RANK_FIELD: top_rank}}, upsert=True)
+        except:
+            pass
+
+        rank_spec = {'_id': COLLECTION_GENERAL}
+        rank_update = {'$inc': {LAST_RANK_FIELD: 1}}
+        if (ReturnDocument is not None) and hasattr(ranks, 'find_one_and_update'):
+            doc = ranks.find_one_and_update(rank_spec, rank_update, upsert=True, return_document=ReturnDocument.AFTER)
+        else:
+            doc = ranks.find_and_modify(rank_spec, rank_update, upsert=True, new=True)
+
+        return int(doc[LAST_RANK_FIELD])
+
     def set_limit(self, limit):
         if not self.correct:
             return False
@@ -169,6 +509,8 @@ class HashStorage(object):
         sel_spec = {PROVIDER_FIELD: self.provider, ARCHIVE_FIELD: self.archive}
         upd_spec = {LIMIT_COUNT_FIELD: limit, UPDATED_FIELD: timepoint}
 
+        archive_cache.invalidate(self._archive_key())
+
         try:
             collection = self.storage.db[COLLECTION_GENERAL]
             collection.update(sel_spec, {'$set': upd_spec}, upsert=False)
@@ -177,6 +519,8 @@ class HashStorage(object):
             self.collection_set = False
             return False
 
+        return True
+
     def drop_provider_archive(self, force):
         if not self.correct:
             return False
@@ -193,8 +537,11 @@ class HashStorage(object):
         if count and (not force):
             return False
 
+        archive_cache.invalidate(self._archive_key())
+
         try:
             collection.drop()
+            self.storage.db[self.edges_name].drop()
         except:
             self.correct = False
             return False
@@ -210,7 +557,10 @@ class HashStorage(object):
 
         return True
 
-    def get_ref_media(self, id_value):
+    def get_ref_media(self, id_value, fields=None):
+        '''
+        Takes the media of the ref, just the given fields if any, e.g. ['feed', 'alike.ref']
+        '''
 
         if not self.correct:
             return None
@@ -220,7 +570,10 @@ class HashStorage(object):
         item = None
         try:
             collection = self.storage.db[self.collection_name]
-            item = collection.find_one({'_id': id_value})
+            if fields:
+                item = collection.find_one({'_id': id_value}, dict([(one_field, 1) for one_field in fields]))
+            else:
+                item = collection.find_one({'_id': id_value})
             if item:
                 item['ref'] = item['_id']
                 del(item['_id'])
@@ -233,6 +586,26 @@ class HashStorage(object):
 
         return item
 
+    def get_present_refs(self, id_values):
+
+        present = set()
+        if not self.correct:
+            return present
+        if not self.collection_name:
+            return present
+        if not id_values:
+            return present
+
+        try:
+            collection = self.storage.db[self.collection_name]
+            for item in collection.find({'_id': {'$in': list(id_values)}}, {'_id': 1}):
+                present.add(item['_id'])
+        except:
+            self.correct = False
+            return set()
+
+        return present
+
     def _prepare_ref_ids(self, ref_ids=None):
 
         if not ref_ids:
@@ -261,7 +634,7 @@ class HashStorage(object):
 
         return search_part
 
-    def _prepare_tags_with(self, tags_with):
+    def _prepare_tags_with(self, tags_with, field_prefix=''):
 
         tags_with_use = []
 
@@ -279,7 +652,7 @@ class HashStorage(object):
             for one_tag_sub in one_tag_got:
                 if not one_tag_sub:
                     continue
-                one_tag_set.append({'tags': one_tag_sub})
+                one_tag_set.append({field_prefix + TAGS_FIELD: one_tag_sub})
             if not one_tag_set:
                 continue
             if 1 == len(one_tag_set):
@@ -295,7 +668,7 @@ class HashStorage(object):
 
         return rv
 
-    def _prepare_tags_without(self, tags_without):
+    def _prepare_tags_without(self, tags_without, field_prefix=''):
 
         tags_without_use = []
 
@@ -313,7 +686,7 @@ class HashStorage(object):
             for one_tag_sub in one_tag_got:
                 if not one_tag_sub:
                     continue
-                one_tag_set.append({'tags': {'$ne': one_tag_sub}})
+                one_tag_set.append({field_prefix + TAGS_FIELD: {'$ne': one_tag_sub}})
             if not one_tag_set:
                 continue
             if 1 == len(one_tag_set):
@@ -336,27 +709,117 @@ class HashStorage(object):
         if order is not None:
             if type(order) is not list:
                 order = [order]
-                for one_sort in order:
-                    one_sort = ''
-                    try:
-                        one_sort = str(one_sort).lower()
-                    except:
-                        continue
-                    if one_sort.startswith('ref'):
-                        order_list.append(('_id', 1))
-                    if one_sort.startswith('cre'):
-                        order_list.append((CREATED_FIELD, -1))
-                    if one_sort.startswith('upd'):
-                        order_list.append((UPDATED_FIELD, -1))
-                    if one_sort.startswith('rel'):
-                        order_list.append((RELIKED_FIELD, -1))
-
-        if not order_list:
-            order_list = [('_id', 1)]
+            for one_sort in order:
+                try:
+                    one_sort = str(one_sort).lower()
+                except:
+                    continue
+                one_part = None
+                if one_sort.startswith('ref'):
+                    one_part = ('_id', 1)
+                if one_sort.startswith('cre'):
+                    one_part = (CREATED_FIELD, -1)
+                if one_sort.startswith('upd'):
+                    one_part = (UPDATED_FIELD, -1)
+                if one_sort.startswith('rel'):
+                    one_part = (RELIKED_FIELD, -1)
+                if one_part and (one_part not in order_list):
+                    order_list.append(one_part)
+
+        # the ref as the last criterion, making the order total, as the continuation tokens need
+        if ('_id', 1) not in order_list:
+            order_list.append(('_id', 1))
 
         return order_list
 
-    def get_alike_media(self, ref_ids, media_feed=None, tags_with=None, tags_without=None, threshold=None, order=None, offset=None, limit=None):
+    def _take_key(self, entry, order_list):
+        # values of the (possibly dotted) sort fields
+        key_values = []
+        for one_field, one_dir in order_list:
+            cur_value = entry
+            for one_part in one_field.split('.'):
+                cur_value = cur_value.get(one_part) if type(cur_value) is dict else None
+            key_values.append(cur_value)
+        return key_values
+
+    def _make_after_token(self, order_list, key_values):
+        # opaque continuation: the sort key of the last listed item, with the sort it is for
+        if BSON is None:
+            return None
+        try:
+            token_data = BSON.encode({'order': [one_field for one_field, one_dir in order_list], 'key': key_values})
+            return base64.urlsafe_b64encode(token_data).decode('ascii').rstrip('=')
+        except:
+            return None
+
+    def _parse_after_token(self, after, order_list):
+        if BSON is None:
+            return None
+        try:
+            after = str(after)
+            token_data = BSON(base64.urlsafe_b64decode(after + ('=' * (-len(after) % 4)))).decode()
+        except:
+            return None
+        if token_data.get('order') != [one_field for one_field, one_dir in order_list]:
+            return None
+        if (type(token_data.get('key')) is not list) or (len(token_data['key']) != len(order_list)):
+            return None
+        return token_data['key']
+
+    def _prepare_after(self, order_list, key_values):
+        # items past the key: the same leading values, then beyond at the next sort field
+        after_parts = []
+        for rank in range(len(order_list)):
+            cur_part = {}
+            for one_sort, one_value in zip(order_list[:rank], key_values[:rank]):
+                cur_part[one_sort[0]] = one_value
+            one_field, one_dir = order_list[rank]
+            if 1 == one_dir:
+                cur_part[one_field] = {'$gt': key_values[rank]}
+            else:
+                cur_part[one_field] = {'$lt': key_values[rank]}
+            after_parts.append(cur_part)
+        return {'$or': after_parts}
+
+    def _is_after(self, order_list, key_values, after_key):
+        for one_sort, one_value, after_value in zip(order_list, key_values, after_key):
+            if one_value == after_value:
+                continue
+            if 1 == one_sort[1]:
+                return one_value > after_value
+            return one_value < after_value
+        return False
+
+    def _count_total(self, db_collection, search_struct, total_mode):
+        # None when skipped; when approximated, counted up to APPROX_TOTAL_COUNT only
+        if TOTAL_SKIP == total_mode:
+            return None
+        cursor = db_collection.find(search_struct, {'_id': 1})
+        if TOTAL_APPROX == total_mode:
+            cursor = cursor.limit(APPROX_TOTAL_COUNT)
+        return cursor.count(True)
+
+    def _take_alike_fields(self, entry):
+        cur_take = {}
+        cur_take[FEED_FIELD] = None
+        if FEED_FIELD in entry:
+            cur_take[FEED_FIELD] = entry[FEED_FIELD]
+        cur_tags = []
+        if ('tags' in entry) and entry['tags']:
+            cur_tags = entry['tags']
+            if type(cur_tags) is not list:
+                cur_tags = [cur_tags]
+        cur_take['tags'] = cur_tags
+        for one_field in [CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD]:
+            cur_take[one_field] = entry[one_field]
+        return cur_take
+
+    def get_alike_media(self, ref_ids, media_feed=None, tags_with=None, tags_without=None, threshold=None, order=None, offset=None, limit=None, after=None, total_mode=None):
+        '''
+        Lists the similar media, the closest first, with the next token when more of them follow; None on a wrong after token
+        '''
+        if total_mode not in TOTAL_MODES:
+            total_mode = TOTAL_EXACT
         total = 0
         no_res = {'items': [], 'total': 0}
 
@@ -382,16 +845,34 @@ class HashStorage(object):
         if not search_struct:
             return no_res
 
-        test_refs = []
-        test_evals = {}
         try:
             if threshold:
                 threshold = float(threshold)
+        except:
+            return no_res
+
+        key_order = self._get_alike_order(order)
+        after_key = None
+        if after:
+            after_key = self._parse_after_token(after, key_order)
+            if after_key is None:
+                return None
+
+        if LAYOUT_EDGES == self.layout:
+            return self._get_alike_edges(search_struct, media_feed, tags_with, tags_without, threshold, order, key_order, offset, limit, after_key, total_mode)
+
+        if aggregation_support.is_supported(self.storage.db):
+            return self._get_alike_aggregated(search_struct, media_feed, tags_with, tags_without, threshold, key_order, offset, limit, after_key, total_mode)
+
+        # without the aggregation support, the links are collected and sorted here
+        test_refs = []
+        test_evals = {}
+        try:
             db_collection = self.storage.db[self.collection_name]
-            cursor = db_collection.find(search_struct)
+            cursor = db_collection.find(search_struct, {'alike': 1})
             for entry in cursor:
                 if ('alike' not in entry) or (not entry['alike']):
-                    pass
+                    continue
                 cur_alikes = entry['alike']
                 if type(cur_alikes) is not list:
                     cur_alikes = [cur_alikes]
@@ -416,9 +897,8 @@ class HashStorage(object):
                         use_evals.append(one_eval)
                     if not use_evals:
                         continue
-                    if cur_ref not in test_refs:
-                        test_refs.append(cur_ref)
                     if cur_ref not in test_evals:
+                        test_refs.append(cur_ref)
                         test_evals[cur_ref] = use_evals
         except:
             self.correct = False
@@ -456,22 +936,10 @@ class HashStorage(object):
         take_alikes = {}
         try:
             db_collection = self.storage.db[self.collection_name]
-            cursor = db_collection.find(search_struct).sort(order_list)
+            cursor = db_collection.find(search_struct, LISTED_PROJECTION).sort(order_list)
             for entry in cursor:
                 take_refs.append(entry['_id'])
-                cur_take = {}
-                cur_take[FEED_FIELD] = None
-                if FEED_FIELD in entry:
-                    cur_take[FEED_FIELD] = entry[FEED_FIELD]
-                cur_tags = []
-                if ('tags' in entry) and entry['tags']:
-                    cur_tags = entry['tags']
-                    if type(cur_tags) is not list:
-                        cur_tags = [cur_tags]
-                cur_take['tags'] = cur_tags
-                for one_field in [CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD]:
-                    cur_take[one_field] = entry[one_field]
-                take_alikes[entry['_id']] = cur_take
+                take_alikes[entry['_id']] = self._take_alike_fields(entry)
         except:
             self.correct = False
             return no_res
@@ -510,10 +978,23 @@ class HashStorage(object):
 
         take_refs.sort(key=lambda ref: sort_values[ref])
         total = len(take_refs)
+        if TOTAL_SKIP == total_mode:
+            total = None
+
+        # the same sort key as of the aggregation, for the continuation tokens
+        take_keys = {}
+        for one_ref in take_refs:
+            take_keys[one_ref] = self._take_key({'_id': one_ref, 'min_dist': sort_values[one_ref], 'media': take_alikes[one_ref]}, key_order)
+
+        if after_key is not None:
+            take_refs = [one_ref for one_ref in take_refs if self._is_after(key_order, take_keys[one_ref], after_key)]
 
         if offset is not None:
             take_refs = take_refs[offset:]
+        next_token = None
         if limit is not None:
+            if (len(take_refs) > limit) and (0 < limit):
+                next_token = self._make_after_token(key_order, take_keys[take_refs[limit - 1]])
             take_refs = take_refs[:limit]
 
         output = []
@@ -534,9 +1015,525 @@ class HashStorage(object):
                 cur_item[one_part] = cur_entry[one_part]
             output.append(cur_item)
 
-        return {'items': output, 'total': total}
+        return {'items': output, 'total': total, 'next': next_token}
+
+    def _get_alike_order(self, order):
+        # the closest first, then as asked, the ref making it deterministic
+        sort_spec = OrderedDict([('min_dist', 1)])
+        for one_field, one_dir in self._prepare_order(order):
+            if '_id' != one_field:
+                one_field = 'media.' + one_field
+            if one_field not in sort_spec:
+                sort_spec[one_field] = one_dir
+        return list(sort_spec.items())
+
+    def _get_alike_media_parts(self, media_feed, tags_with, tags_without, field_prefix=''):
+        media_parts = []
+        if media_feed:
+            media_parts.append({field_prefix + FEED_FIELD: media_feed})
+
+        take_with = self._prepare_tags_with(tags_with, field_prefix)
+        if take_with:
+            media_parts.append(take_with)
+
+        take_without = self._prepare_tags_without(tags_without, field_prefix)
+        if take_without:
+            media_parts.append(take_without)
+
+        return media_parts
+
+    def _make_evals_expr(self, threshold):
+        # evals of the unwound links, just those within the threshold when given
+        if not threshold:
+            return '$alike.evals'
+        return {'$filter': {'input': '$alike.evals', 'as': 'eval', 'cond': {'$and': [{'$gt': ['$$eval.dist', None]}, {'$lte': ['$$eval.dist', threshold]}]}}}
+
+    def _make_page_facets(self, key_order, offset, limit, after_key, total_mode):
+        # the requested page of the ranked {_id, min_dist, media} entries, with their total when asked
+        page = [{'$sort': OrderedDict(key_order)}]
+        if after_key is not None:
+            page.insert(0, {'$match': self._prepare_after(key_order, after_key)})
+        if offset:
+            page.append({'$skip': offset})
+        if limit is not None:
+            page.append({'$limit': limit + 1})
+        if 0 == limit:
+            page = [{'$match': {'_id': {'$exists': False}}}]
+        facets_spec = {'page': page}
+        if TOTAL_EXACT == total_mode:
+            facets_spec['total'] = [{'$count': 'count'}]
+        if TOTAL_APPROX == total_mode:
+            facets_spec['total'] = [{'$limit': APPROX_TOTAL_COUNT}, {'$count': 'count'}]
+        return facets_spec
+
+    def _take_page_facets(self, facets, key_order, limit):
+        # (page entries, total, next token) of the page facets
+        total = None
+        if 'total' in facets:
+            total = 0
+            if facets['total']:
+                total = facets['total'][0]['count']
+
+        page_entries = facets['page']
+        next_token = None
+        if (limit is not None) and (len(page_entries) > limit):
+            page_entries = page_entries[:limit]
+            next_token = self._make_after_token(key_order, self._take_key(page_entries[-1], key_order))
+
+        return (page_entries, total, next_token)
+
+    def _get_alike_aggregated(self, search_struct, media_feed, tags_with, tags_without, threshold, key_order, offset, limit, after_key, total_mode):
+        # links are unwound, filtered, joined with the linked media, ranked and paged in the db,
+        # just the requested page is taken
+        media_parts = self._get_alike_media_parts(media_feed, tags_with, tags_without, 'media.')
+
+        pipeline = [
+            {'$match': search_struct},
+            {'$project': {'alike': 1}},
+            {'$unwind': '$alike'},
+            {'$project': {'ref': '$alike.ref', 'evals': self._make_evals_expr(threshold)}},
+            {'$match': {'ref': {'$nin': [None, '']}, 'evals.0': {'$exists': True}}},
+            {'$group': {'_id': '$ref', 'evals': {'$first': '$evals'}}},
+            {'$lookup': {'from': self.collection_name, 'localField': '_id', 'foreignField': '_id', 'as': 'media'}},
+            {'$unwind': '$media'}
+        ]
+        if media_parts:
+            pipeline.append({'$match': {'$and': media_parts}})
+
+        take_fields = {'evals': 1, 'min_dist': {'$ifNull': [{'$min': '$evals.dist'}, float('inf')]}}
+        for one_field in LISTED_FIELDS:
+            take_fields['media.' + one_field] = 1
+        pipeline.append({'$project': take_fields})
+        pipeline.append({'$facet': self._make_page_facets(key_order, offset, limit, after_key, total_mode)})
 
-    def get_feed_media(self, ref_ids=None, media_feed=None, tags_with=None, tags_without=None, order=None, offset=None, limit=None):
+        try:
+            db_collection = self.storage.db[self.collection_name]
+            facets = list(db_collection.aggregate(pipeline))
+        except:
+            self.correct = False
+            return {'items': [], 'total': 0}
+
+        if not facets:
+            return {'items': [], 'total': 0}
+
+        page_entries, total, next_token = self._take_page_facets(facets[0], key_order, limit)
+
+        output = []
+        for entry in page_entries:
+            cur_item = {'ref': entry['_id']}
+            use_evals = []
+            for one_eval in entry['evals']:
+                try:
+                    if ('diff' in one_eval) and (one_eval['diff'] is not None):
+                        one_eval['diff'] = int(one_eval['diff'])
+                except:
+                    pass
+                use_evals.append(one_eval)
+            cur_item['evals'] = use_evals
+            cur_entry = self._take_alike_fields(entry['media'])
+            for one_part in cur_entry:
+                cur_item[one_part] = cur_entry[one_part]
+            output.append(cur_item)
+
+        return {'items': output, 'total': total, 'next': next_token}
+
+    def _page_edges_aggregated(self, edges_collection, edge_spec, media_parts, key_order, offset, limit, after_key, total_mode):
+        # edges are grouped by the linked media, the closest one giving its rank, then joined with the media,
+        # filtered, ranked and paged in the db
+        pipeline = [
+            {'$match': edge_spec},
+            {'$group': {'_id': '$' + EDGE_REF_B, 'min_dist': {'$min': '$dist'}}},
+            {'$lookup': {'from': self.collection_name, 'localField': '_id', 'foreignField': '_id', 'as': 'media'}},
+            {'$unwind': '$media'}
+        ]
+        if media_parts:
+            pipeline.append({'$match': {'$and': media_parts}})
+
+        take_fields = {'min_dist': {'$ifNull': ['$min_dist', float('inf')]}}
+        for one_field in LISTED_FIELDS:
+            take_fields['media.' + one_field] = 1
+        pipeline.append({'$project': take_fields})
+        pipeline.append({'$facet': self._make_page_facets(key_order, offset, limit, after_key, total_mode)})
+
+        facets = list(edges_collection.aggregate(pipeline))
+        if not facets:
+            return ([], 0, None)
+
+        return self._take_page_facets(facets[0], key_order, limit)
+
+    def _take_closest_media(self, db_collection, min_dists, key_order, offset, limit, after_key):
+        # with no media filters, the default order and no total, the linked refs are ranked by (distance, ref)
+        # on their own, and just the media up to the end of the page are fetched, past the removed ones
+        ranked = sorted(min_dists, key=lambda cur_ref: (min_dists[cur_ref], cur_ref))
+        if after_key is not None:
+            ranked = [cur_ref for cur_ref in ranked if self._is_after(key_order, [min_dists[cur_ref], cur_ref], after_key)]
+
+        wanted = None
+        if limit is not None:
+            wanted = (offset or 0) + limit + 1
+
+        entries = []
+        while ranked and ((wanted is None) or (len(entries) < wanted)):
+            take_refs = ranked
+            if wanted is not None:
+                take_refs = ranked[:wanted - len(entries)]
+            ranked = ranked[len(take_refs):]
+            found = {}
+            for entry in db_collection.find({'_id': {'$in': take_refs}}, LISTED_PROJECTION):
+                found[entry['_id']] = entry
+            for cur_ref in take_refs:
+                if cur_ref in found:
+                    entries.append({'_id': cur_ref, 'min_dist': min_dists[cur_ref], 'media': found[cur_ref]})
+
+        return entries
+
+    def _page_edges_collected(self, edges_collection, db_collection, edge_spec, media_parts, order, key_order, offset, limit, after_key, total_mode):
+        # without the aggregation support, the closest edges are collected and ranked here
+        min_dists = {}
+        for edge in edges_collection.find(edge_spec, {EDGE_REF_B: 1, 'dist': 1}):
+            cur_ref = edge[EDGE_REF_B]
+            cur_dist = edge.get('dist')
+            if cur_dist is None:
+                cur_dist = float('inf')
+            if (cur_ref not in min_dists) or (cur_dist < min_dists[cur_ref]):
+                min_dists[cur_ref] = cur_dist
+        if not min_dists:
+            return ([], 0, None)
+
+        if (not media_parts) and (TOTAL_SKIP == total_mode) and (key_order == self._get_alike_order(None)):
+            entries = self._take_closest_media(db_collection, min_dists, key_order, offset, limit, after_key)
+            total = None
+        else:
+            # sorted as asked by the db, then stably by the distance
+            entries = []
+            search_struct = {'$and': [{'_id': {'$in': list(min_dists)}}] + media_parts}
+            for entry in db_collection.find(search_struct, LISTED_PROJECTION).sort(self._prepare_order(order)):
+                entries.append({'_id': entry['_id'], 'min_dist': min_dists[entry['_id']], 'media': entry})
+            entries.sort(key=lambda entry: entry['min_dist'])
+
+            total = len(entries)
+            if TOTAL_SKIP == total_mode:
+                total = None
+
+            if after_key is not None:
+                entries = [entry for entry in entries if self._is_after(key_order, self._take_key(entry, key_order), after_key)]
+
+        if offset:
+            entries = entries[offset:]
+        next_token = None
+        if limit is not None:
+            if (len(entries) > limit) and (0 < limit):
+                next_token = self._make_after_token(key_order, self._take_key(entries[limit - 1], key_order))
+            entries = entries[:limit]
+
+        return (entries, total, next_token)
+
+    def _get_alike_edges(self, search_struct, media_feed, tags_with, tags_without, threshold, order, key_order, offset, limit, after_key, total_mode):
+        # ranked as in the embedded layout: the closest first, then as asked, with the same continuation tokens
+        no_res = {'items': [], 'total': 0}
+
+        ref_list = search_struct['_id']
+        if type(ref_list) is dict:
+            ref_list = ref_list['$in']
+        else:
+            ref_list = [ref_list]
+
+        edge_parts = [{EDGE_REF_A: search_struct['_id']}]
+        if threshold:
+            edge_parts.append({'dist': {'$lte': threshold}})
+        edge_spec = edge_parts[0]
+        if 1 < len(edge_parts):
+            edge_spec = {'$and': edge_parts}
+
+        try:
+            edges_collection = self.storage.db[self.edges_name]
+            db_collection = self.storage.db[self.collection_name]
+
+            if aggregation_support.is_supported(self.storage.db):
+                paged = self._page_edges_aggregated(edges_collection, edge_spec, self._get_alike_media_parts(media_feed, tags_with, tags_without, 'media.'), key_order, offset, limit, after_key, total_mode)
+            else:
+                paged = self._page_edges_collected(edges_collection, db_collection, edge_spec, self._get_alike_media_parts(media_feed, tags_with, tags_without), order, key_order, offset, limit, after_key, total_mode)
+            page_entries, total, next_token = paged
+
+            if not page_entries:
+                return {'items': [], 'total': total}
+
+            # evals of the taken media, as linked to the first of the asked refs
+            take_refs = [entry['_id'] for entry in page_entries]
+            take_evals = {}
+            page_spec = {'$and': edge_parts + [{EDGE_REF_B: {'$in': take_refs}}]}
+            for edge in edges_collection.find(page_spec, EDGE_PROJECTION):
+                cur_eval = {}
+                for one_field in EDGE_EVAL_FIELDS:
+                    cur_eval[one_field] = edge.get(one_field)
+                take_evals.setdefault(edge[EDGE_REF_B], {}).setdefault(edge[EDGE_REF_A], []).append(cur_eval)
+        except:
+            self.correct = False
+            return no_res
+
+        output = []
+
+        for entry in page_entries:
+            cur_ref = entry['_id']
+            cur_item = {'ref': cur_ref}
+            use_evals = []
+            ref_evals = take_evals.get(cur_ref, {})
+            for one_ref in ref_list:
+                if one_ref in ref_evals:
+                    use_evals = sorted(ref_evals[one_ref], key=lambda one_eval: (one_eval['method'], one_eval['dim']))
+                    break
+            for one_eval in use_evals:
+                try:
+                    if one_eval['diff'] is not None:
+                        one_eval['diff'] = int(one_eval['diff'])
+                except:
+                    pass
+            cur_item['evals'] = use_evals
+            cur_entry = self._take_alike_fields(entry['media'])
+            for one_part in cur_entry:
+                cur_item[one_part] = cur_entry[one_part]
+            output.append(cur_item)
+
+        return {'items': output, 'total': total, 'next': next_token}
+
+    def _collect_alike_links(self, ref_list, threshold):
+        # {asked ref: {linked ref: evals}}, out of a single fetch of the asked media, or of their edges
+        links = {}
+        for one_ref in ref_list:
+            links[one_ref] = {}
+
+        if LAYOUT_EDGES == self.layout:
+            edge_parts = [{EDGE_REF_A: {'$in': ref_list}}]
+            if threshold:
+                edge_parts.append({'dist': {'$lte': threshold}})
+            for edge in self.storage.db[self.edges_name].find({'$and': edge_parts}, EDGE_PROJECTION):
+                cur_eval = {}
+                for one_field in EDGE_EVAL_FIELDS:
+                    cur_eval[one_field] = edge.get(one_field)
+                links[edge[EDGE_REF_A]].setdefault(edge[EDGE_REF_B], []).append(cur_eval)
+            for one_ref in links:
+                for linked_ref in links[one_ref]:
+                    links[one_ref][linked_ref].sort(key=lambda one_eval: (one_eval['method'], one_eval['dim']))
+            return links
+
+        for entry in self.storage.db[self.collection_name].find({'_id': {'$in': ref_list}}, {'alike': 1}):
+            cur_alikes = entry.get('alike')
+            if not cur_alikes:
+                continue
+            if type(cur_alikes) is not list:
+                cur_alikes = [cur_alikes]
+            ref_links = links[entry['_id']]
+            for one_alike in cur_alikes:
+                if ('ref' not in one_alike) or (not one_alike['ref']):
+                    continue
+                cur_evals = []
+                if ('evals' in one_alike) and (one_alike['evals']):
+                    cur_evals = one_alike['evals']
+                if type(cur_evals) is not list:
+                    cur_evals = [cur_evals]
+                use_evals = []
+                for one_eval in cur_evals:
+                    if not one_eval:
+                        continue
+                    if threshold:
+                        if 'dist' not in one_eval:
+                            continue
+                        if threshold < float(one_eval['dist']):
+                            continue
+                    use_evals.append(one_eval)
+                if use_evals and (one_alike['ref'] not in ref_links):
+                    ref_links[one_alike['ref']] = use_evals
+
+        return links
+
+    def _make_alike_item(self, cur_ref, evals, entry):
+        cur_item = {'ref': cur_ref}
+        use_evals = []
+        for one_eval in evals:
+            one_eval = dict(one_eval)
+            try:
+                if ('diff' in one_eval) and (one_eval['diff'] is not None):
+                    one_eval['diff'] = int(one_eval['diff'])
+            except:
+                pass
+            use_evals.append(one_eval)
+        cur_item['evals'] = use_evals
+        cur_entry = self._take_alike_fields(entry)
+        for one_part in cur_entry:
+            cur_item[one_part] = cur_entry[one_part]
+        return cur_item
+
+    def _get_alike_groups_aggregated(self, ref_list, media_parts, threshold, key_order, offset, limit):
+        # links of all the asked refs are joined with the linked media and ranked in a single run,
+        # then grouped per the asked ref, each group sliced to its page in the db
+        if LAYOUT_EDGES == self.layout:
+            edge_parts = [{EDGE_REF_A: {'$in': ref_list}}]
+            if threshold:
+                edge_parts.append({'dist': {'$lte': threshold}})
+            source_collection = self.storage.db[self.edges_name]
+            push_eval = dict([(one_field, '$' + one_field) for one_field in EDGE_EVAL_FIELDS])
+            pipeline = [
+                {'$match': {'$and': edge_parts}},
+                {'$sort': OrderedDict([('method', 1), ('dim', 1)])},
+                {'$group': {'_id': {'asked': '$' + EDGE_REF_A, 'ref': '$' + EDGE_REF_B}, 'evals': {'$push': push_eval}, 'min_dist': {'$min': '$dist'}}}
+            ]
+        else:
+            source_collection = self.storage.db[self.collection_name]
+            pipeline = [
+                {'$match': {'_id': {'$in': ref_list}}},
+                {'$project': {'alike': 1}},
+                {'$unwind': '$alike'},
+                {'$project': {'ref': '$alike.ref', 'evals': self._make_evals_expr(threshold)}},
+                {'$match': {'ref': {'$nin': [None, '']}, 'evals.0': {'$exists': True}}},
+                {'$group': {'_id': {'asked': '$_id', 'ref': '$ref'}, 'evals': {'$first': '$evals'}}},
+                {'$project': {'evals': 1, 'min_dist': {'$min': '$evals.dist'}}}
+            ]
+
+        pipeline += [
+            {'$lookup': {'from': self.collection_name, 'localField': '_id.ref', 'foreignField': '_id', 'as': 'media'}},
+            {'$unwind': '$media'}
+        ]
+        if media_parts:
+            pipeline.append({'$match': {'$and': media_parts}})
+
+        take_fields = {'_id': '$_id.ref', 'asked': '$_id.asked', 'evals': 1, 'min_dist': {'$ifNull': ['$min_dist', float('inf')]}}
+        for one_field in LISTED_FIELDS:
+            take_fields['media.' + one_field] = 1
+        pipeline += [
+            {'$project': take_fields},
+            {'$sort': OrderedDict(key_order)},
+            {'$group': {'_id': '$asked', 'total': {'$sum': 1}, 'items': {'$push': {'ref': '$_id', 'evals': '$evals', 'media': '$media'}}}}
+        ]
+        # without a limit, the whole groups are passed anyway
+        if limit is not None:
+            if 0 < limit:
+                pipeline.append({'$project': {'total': 1, 'items': {'$slice': ['$items', offset or 0, limit]}}})
+            else:
+                pipeline.append({'$project': {'total': 1}})
+
+        try:
+            groups = {}
+            for one_group in source_collection.aggregate(pipeline):
+                groups[one_group['_id']] = one_group
+        except:
+            self.correct = False
+            return {'items': [], 'total': 0}
+
+        output = []
+        for one_ref in ref_list:
+            group_entries = []
+            group_total = 0
+            if one_ref in groups:
+                group_entries = groups[one_ref].get('items', [])
+                group_total = groups[one_ref]['total']
+            if (limit is None) and offset:
+                group_entries = group_entries[offset:]
+
+            group_items = []
+            for entry in group_entries:
+                cur_evals = entry['evals']
+                if LAYOUT_EDGES == self.layout:
+                    cur_evals = [dict([(one_field, one_eval.get(one_field)) for one_field in EDGE_EVAL_FIELDS]) for one_eval in cur_evals]
+                group_items.append(self._make_alike_item(entry['ref'], cur_evals, entry['media']))
+
+            output.append({'ref': one_ref, 'items': group_items, 'total': group_total})
+
+        return {'items': output, 'total': len(output)}
+
+    def get_alike_groups(self, ref_ids, media_feed=None, tags_with=None, tags_without=None, threshold=None, order=None, offset=None, limit=None):
+        '''
+        Similar media as for get_alike_media, grouped per the asked refs, with offset and limit per group;
+        all the groups are ranked and sliced in a single aggregation, or without its support out of a single fetch
+        of the asked media (or their edges) and of the similar media
+        '''
+        no_res = {'items': [], 'total': 0}
+
+        if (not self.correct) or (not self.collection_set):
+            return no_res
+
+        try:
+            if offset is not None:
+                offset = int(offset)
+            if limit is not None:
+                limit = int(limit)
+            if threshold:
+                threshold = float(threshold)
+        except:
+            return no_res
+
+        search_struct = self._prepare_ref_ids(ref_ids)
+        if not search_struct:
+            return no_res
+        ref_list = search_struct['_id']
+        if type(ref_list) is dict:
+            ref_list = ref_list['$in']
+        else:
+            ref_list = [ref_list]
+        ref_list = list(OrderedDict.fromkeys(ref_list))
+
+        if aggregation_support.is_supported(self.storage.db):
+            return self._get_alike_groups_aggregated(ref_list, self._get_alike_media_parts(media_feed, tags_with, tags_without, 'media.'), threshold, self._get_alike_order(order), offset, limit)
+
+        # without the aggregation support, the links are collected and ranked here
+        search_parts = self._get_alike_media_parts(media_feed, tags_with, tags_without)
+        order_list = self._prepare_order(order)
+
+        try:
+            links = self._collect_alike_links(ref_list, threshold)
+
+            linked_refs = set()
+            for one_ref in links:
+                linked_refs.update(links[one_ref].keys())
+
+            ordered_refs = []
+            take_alikes = {}
+            if linked_refs:
+                db_collection = self.storage.db[self.collection_name]
+                cursor = db_collection.find({'$and': [{'_id': {'$in': list(linked_refs)}}] + search_parts}, LISTED_PROJECTION).sort(order_list)
+                for entry in cursor:
+                    ordered_refs.append(entry['_id'])
+                    take_alikes[entry['_id']] = entry
+        except:
+            self.correct = False
+            return no_res
+
+        output = []
+
+        for one_ref in ref_list:
+            ref_links = links[one_ref]
+            # the closest first; the stable sort keeps the asked order on equal distances
+            group_refs = [cur_ref for cur_ref in ordered_refs if cur_ref in ref_links]
+            sort_values = {}
+            for cur_ref in group_refs:
+                cur_cmp = float('inf')
+                for one_eval in ref_links[cur_ref]:
+                    try:
+                        cur_cmp = min(cur_cmp, float(one_eval['dist']))
+                    except:
+                        continue
+                sort_values[cur_ref] = cur_cmp
+            group_refs.sort(key=lambda cur_ref: sort_values[cur_ref])
+
+            group_total = len(group_refs)
+            if offset is not None:
+                group_refs = group_refs[offset:]
+            if limit is not None:
+                group_refs = group_refs[:limit]
+
+            group_items = []
+            for cur_ref in group_refs:
+                group_items.append(self._make_alike_item(cur_ref, ref_links[cur_ref], take_alikes[cur_ref]))
+
+            output.append({'ref': one_ref, 'items': group_items, 'total': group_total})
+
+        return {'items': output, 'total': len(output)}
+
+    def get_feed_media(self, ref_ids=None, media_feed=None, tags_with=None, tags_without=None, order=None, offset=None, limit=None, after=None, total_mode=None):
+        '''
+        Lists the media, with the next token when more of them follow; None on a wrong after token
+        '''
+        if total_mode not in TOTAL_MODES:
+            total_mode = TOTAL_EXACT
         total = 0
         no_res = {'items': [], 'total': 0}
         if not self.correct:
@@ -585,18 +1582,32 @@ class HashStorage(object):
 
         order_list = self._prepare_order(order)
 
+        page_struct = search_struct
+        if after:
+            after_key = self._parse_after_token(after, order_list)
+            if after_key is None:
+                return None
+            page_struct = {'$and': [search_struct, self._prepare_after(order_list, after_key)]}
+
         output = []
+        next_token = None
 
         try:
             db_collection = self.storage.db[self.collection_name]
-            cursor = db_collection.find(search_struct).sort(order_list)
-            total = cursor.count()
+            cursor = db_collection.find(page_struct, LISTED_PROJECTION).sort(order_list)
+            total = self._count_total(db_collection, search_struct, total_mode)
             if offset is not None:
                 cursor = cursor.skip(offset)
             if limit is not None:
-                cursor = cursor.limit(limit)
+                cursor = cursor.limit(limit + 1)
 
+            last_entry = None
             for entry in cursor:
+                if (limit is not None) and (len(output) >= limit):
+                    if last_entry is not None:
+                        next_token = self._make_after_token(order_list, self._take_key(last_entry, order_list))
+                    break
+                last_entry = entry
                 cur_item = {'ref': entry['_id'], 'feed': None}
                 if FEED_FIELD in entry:
                     cur_item[FEED_FIELD] = entry[FEED_FIELD]
@@ -615,7 +1626,7 @@ class HashStorage(object):
             self.correct = False
             return no_res
 
-        return {'items': output, 'total': total}
+        return {'items': output, 'total': total, 'next': next_token}
 
     def get_feeds(self):
         if not self.correct:
@@ -635,7 +1646,11 @@ class HashStorage(object):
 
         return feeds
 
-    def load_feed_hashes(self, media_feed, upto_timepoint=None, limit_count=0):
+    def load_feed_hashes(self, media_feed, upto_timepoint=None, limit_count=0, since_timepoint=None, hash_part=None):
+        '''
+        Opens the cursor of the feed hashes, the most recent first;
+        with hash_part as (method, dim), just that hash is taken, for comparisons on a single hash
+        '''
         if not self.correct:
             return False
 
@@ -646,14 +1661,26 @@ class HashStorage(object):
         limit_spec = self.limit_count + 1
         if limit_count:
             limit_spec = limit_count + 1
+        if NO_LIMIT_COUNT == limit_count:
+            limit_spec = 0
 
         load_spec = {FEED_FIELD: media_feed}
+        time_spec = {}
         if type(upto_timepoint) == datetime.datetime:
-            load_spec[CREATED_FIELD] = {'$lte': upto_timepoint}
+            time_spec['$lte'] = upto_timepoint
+        if type(since_timepoint) == datetime.datetime:
+            time_spec['$gte'] = since_timepoint
+        if time_spec:
+            load_spec[CREATED_FIELD] = time_spec
 
         try:
             collection = self.storage.db[self.collection_name]
-            self.loaded_hashes = collection.find(load_spec).sort([(CREATED_FIELD,-1)]).limit(limit_spec)
+            load_fields = LOADED_PROJECTION
+            if hash_part:
+                load_fields = {HASHES_FIELD: {'$elemMatch': {'method': hash_part[0], 'dim': hash_part[1]}}, CREATED_FIELD: 1}
+            self.loaded_hashes = collection.find(load_spec, load_fields).sort([(CREATED_FIELD,-1)])
+            if limit_spec:
+                self.loaded_hashes = self.loaded_hashes.limit(limit_spec)
         except:
             self.correct = False
             self.loaded_hashes = None
@@ -701,7 +1728,12 @@ class HashStorage(object):
             self.loaded_hashes = None
             return None
 
-        rv = {'ref': entry_id, 'hashes': entry['hashes']}
+        use_hashes = []
+        for one_hash in (entry.get(HASHES_FIELD) or []):
+            one_hash['packed'] = self._unpack_hash_repr(one_hash.get(HASH_REPR_FIELD))
+            use_hashes.append(one_hash)
+
+        rv = {'ref': entry_id, 'hashes': use_hashes, CREATED_FIELD: entry.get(CREATED_FIELD)}
         return rv
 
     def save_new_media(self, store_fields, pass_mode, event_time=None):
@@ -720,7 +1752,7 @@ class HashStorage(object):
         # this is manged outside this storage connector
         try:
             collection = self.storage.db[self.collection_name]
-            old_item = collection.find_one({'_id': id_value})
+            old_item = collection.find_one({'_id': id_value}, {'_id': 1})
             if old_item:
                 return None
         except:
@@ -738,11 +1770,15 @@ class HashStorage(object):
                     continue
 
         for part in save_take_list:
+            if ('alike' == part) and (LAYOUT_EDGES == self.layout):
+                continue
             save_data[part] = []
             if store_fields[part]:
                 part_data = store_fields[part]
                 if type(part_data) is not list:
                     part_data = [part_data]
+                if HASHES_FIELD == part:
+                    part_data = self._pack_hashes(part_data)
                 save_data[part] = part_data
 
         if type(event_time) is datetime.datetime:
@@ -753,6 +1789,7 @@ class HashStorage(object):
         save_data[CREATED_FIELD] = timepoint
         save_data[UPDATED_FIELD] = timepoint
         save_data[RELIKED_FIELD] = timepoint
+        save_data[SCHEMA_VERSION_FIELD] = SCHEMA_VERSION
 
         try:
             collection = self.storage.db[self.collection_name]
@@ -799,6 +1836,74 @@ class HashStorage(object):
 
         return True
 
+    def append_alike_links(self, id_value, alike_parts, event_time=None):
+        '''
+        Links the media to all its similar ones, and back, as a single unordered bulk write
+        returns count of the documents modified by the writes, None on failures
+        '''
+
+        if not self.correct:
+            return None
+        if not self.collection_name:
+            return None
+        if not alike_parts:
+            return 0
+
+        if type(event_time) is datetime.datetime:
+            timepoint = event_time
+        else:
+            timepoint = datetime.datetime.utcnow()
+
+        if LAYOUT_EDGES == self.layout:
+            return self._append_alike_edges(id_value, alike_parts, timepoint)
+
+        link_updates = [({'_id': id_value}, {'$push': {'alike': {'$each': alike_parts}}, '$set': {RELIKED_FIELD: timepoint}})]
+        for alike_part in alike_parts:
+            back_part = {'ref': id_value, 'evals': alike_part['evals']}
+            link_updates.append(({'_id': alike_part['ref']}, {'$push': {'alike': back_part}, '$set': {RELIKED_FIELD: timepoint}}))
+
+        # media removed meanwhile are just not matched, thus not counted
+        try:
+            collection = self.storage.db[self.collection_name]
+            updated = self._write_bulk(collection, link_updates)
+        except:
+            logging.warning('can not write alike links of: ' + str(id_value))
+            return None
+
+        # the new media with its links and each back-linked media, as really modified
+        return updated
+
+    def _make_edge_updates(self, id_value, alike_parts):
+        edge_updates = []
+        for alike_part in alike_parts:
+            cur_evals = alike_part['evals']
+            if type(cur_evals) is not list:
+                cur_evals = [cur_evals]
+            for one_eval in cur_evals:
+                for ref_a, ref_b in [(id_value, alike_part['ref']), (alike_part['ref'], id_value)]:
+                    edge = {EDGE_REF_A: ref_a, EDGE_REF_B: ref_b}
+                    for one_field in EDGE_EVAL_FIELDS:
+                        edge[one_field] = one_eval.get(one_field)
+                    edge_updates.append(({'_id': self._edge_id(ref_a, ref_b, edge['method'], edge['dim'])}, {'$set': edge}))
+        return edge_updates
+
+    def _append_alike_edges(self, id_value, alike_parts, timepoint):
+        linked_refs = [alike_part['ref'] for alike_part in alike_parts]
+
+        try:
+            edges_collection = self.storage.db[self.edges_name]
+            updated = self._write_bulk(edges_collection, self._make_edge_updates(id_value, alike_parts), True)
+            collection = self.storage.db[self.collection_name]
+            result = collection.update({'_id': {'$in': [id_value] + linked_refs}}, {'$set': {RELIKED_FIELD: timepoint}}, upsert=False, multi=True)
+        except:
+            logging.warning('can not write alike edges of: ' + str(id_value))
+            return None
+
+        # the written edges and the media with their reliked time set
+        if result:
+            updated += result.get('nModified', result.get('n', 0))
+        return updated
+
     def set_media_tags(self, id_value, tags, set_mode, pass_mode, event_time=None):
 
         if not self.correct:
@@ -861,42 +1966,216 @@ class HashStorage(object):
 
         try:
             collection = self.storage.db[self.collection_name]
-            collection.remove({'_id': id_value})
+            rv = collection.remove({'_id': id_value})
         except:
             self.correct = False
             return False
 
-        return True
+        if (type(rv) is dict) and (not rv.get('n')):
+            return True
 
-    def excise_alike_media(self, id_value, id_alike, pass_mode, event_time=None):
+        # the hash indexes of other processes are reloaded on the changed count
+        try:
+            collection = self.storage.db[COLLECTION_GENERAL]
+            collection.update({'_id': self.collection_rank}, {'$inc': {REMOVED_COUNT_FIELD: 1}})
+        except:
+            logging.warning('can not note media removal at archive: ' + str(self.collection_rank))
 
-        if not self.correct:
-            return False
-        if not self.collection_name:
-            return False
+        return True
 
-        if not id_alike:
-            return False
+    def get_removed_count(self):
+        '''
+        Count of media removals noted at the archive, None on failures
+        '''
+        if not self.correct:
+            return None
+        if not self.collection_set:
+            return None
 
         try:
-            id_alike = str(id_alike)
+            collection = self.storage.db[COLLECTION_GENERAL]
+            doc = collection.find_one({'_id': self.collection_rank}, {REMOVED_COUNT_FIELD: 1})
         except:
+            self.correct = False
+            return None
+
+        if not doc:
+            return None
+        return int(doc.get(REMOVED_COUNT_FIELD) or 0)
+
+    def excise_alike_media(self, id_value, id_alike, pass_mode, event_time=None):
+
+        if not id_alike:
             return False
 
-        for check_char in ['\\', '\'', '"']:
-            if check_char in id_alike:
-                return False
-        excise_spec = 'this.ref == "' + id_alike + '"'
+        rv = self.excise_alike_links([id_value], id_alike, event_time)
+        if rv is None:
+            return bool(pass_mode)
+
+        return True
+
+    def excise_alike_links(self, id_values, id_alike, event_time=None):
+        '''
+        Removes links to the (deleted) media from all the listed media, as a single multi-update
+        returns count of the updated media, None on failures
+        '''
+
+        if not self.correct:
+            return None
+        if not self.collection_name:
+            return None
+
+        if not id_alike:
+            return None
 
         if type(event_time) is datetime.datetime:
             timepoint = event_time
         else:
             timepoint = datetime.datetime.utcnow()
 
+        if LAYOUT_EDGES == self.layout:
+            try:
+                edges_collection = self.storage.db[self.edges_name]
+                linked_refs = edges_collection.find({EDGE_REF_A: id_alike}).distinct(EDGE_REF_B)
+                edges_collection.remove({EDGE_REF_A: id_alike})
+                edges_collection.remove({EDGE_REF_B: id_alike})
+            except:
+                return None
+            id_values = list(set(list(id_values or []) + list(linked_refs)))
+
+        if not id_values:
+            return 0
+
         try:
             collection = self.storage.db[self.collection_name]
-            collection.update({'_id': id_value}, {'$pull': {'alike': {'$where': excise_spec}}, '$set': {RELIKED_FIELD: timepoint}}, upsert=False)
+            result = collection.update({'_id': {'$in': list(id_values)}}, {'$pull': {'alike': {'ref': id_alike}}, '$set': {RELIKED_FIELD: timepoint}}, upsert=False, multi=True)
         except:
-            return bool(pass_mode)
+            return None
 
-        return True
+        if not result:
+            return 0
+        if 'nModified' in result:
+            return result['nModified']
+        return result.get('n', 0)
+
+    def convert_hashes(self, batch_size=100):
+        '''
+        Online conversion of the hex hash representations into the Int64/BinData forms;
+        the media are marked by the schema version, and each is set just if not replaced meanwhile
+        (a replacement gets a new created_on), returns count of converted media
+        '''
+        if not self.correct:
+            return None
+        if not self.collection_name:
+            return None
+
+        converted = 0
+        try:
+            collection = self.storage.db[self.collection_name]
+            cursor = collection.find({SCHEMA_VERSION_FIELD: {'$exists': False}}, {HASHES_FIELD: 1, CREATED_FIELD: 1}).batch_size(batch_size)
+            for entry in cursor:
+                old_hashes = entry.get(HASHES_FIELD) or []
+                new_hashes = self._pack_hashes(old_hashes)
+                set_spec = {'_id': entry['_id'], CREATED_FIELD: entry.get(CREATED_FIELD), SCHEMA_VERSION_FIELD: {'$exists': False}}
+                res = collection.update(set_spec, {'$set': {HASHES_FIELD: new_hashes, SCHEMA_VERSION_FIELD: SCHEMA_VERSION}}, upsert=False)
+                if res and res.get('n') and (new_hashes != old_hashes):
+                    converted += 1
+        except:
+            self.correct = False
+            return None
+
+        return converted
+
+    def _move_links_to_edges(self, batch_size, to_unset):
+        collection = self.storage.db[self.collection_name]
+        edges_collection = self.storage.db[self.edges_name]
+
+        moved = 0
+        batch = []
+        for entry in collection.find({'alike.0': {'$exists': True}}, {'alike': 1}):
+            batch.append(entry)
+            if len(batch) < batch_size:
+                continue
+            moved += self._move_links_batch(collection, edges_collection, batch, to_unset)
+            batch = []
+        if batch:
+            moved += self._move_links_batch(collection, edges_collection, batch, to_unset)
+
+        return moved
+
+    def _move_links_batch(self, collection, edges_collection, batch, to_unset):
+        edge_updates = []
+        for entry in batch:
+            edge_updates += self._make_edge_updates(entry['_id'], entry['alike'])
+        if edge_updates:
+            self._write_bulk(edges_collection, edge_updates, True)
+
+        if to_unset:
+            # just the moved links are pulled, links appended or changed meanwhile are taken by a next run
+            link_updates = []
+            for entry in batch:
+                link_updates.append(({'_id': entry['_id']}, {'$pullAll': {'alike': entry['alike']}}))
+            self._write_bulk(collection, link_updates)
+            collection.update({'_id': {'$in': [entry['_id'] for entry in batch]}, 'alike': {'$size': 0}}, {'$unset': {'alike': ''}}, multi=True)
+
+        return len(batch)
+
+    def convert_links_to_edges(self, batch_size=100):
+        '''
+        Copies the embedded alike links into the edges collection, and switches the archive to the edges layout
+        returns count of media with copied links, None on failures
+        running servers take the new layout once their cached archive expires; the embedded links are kept
+        till LAYOUT_SWITCH_TIME after the switch, for the servers still reading them; a run after that time
+        takes the links written in the embedded layout meanwhile, and removes the embedded links
+        '''
+
+        if not self.correct:
+            return None
+        if not self.collection_name:
+            return None
+
+        try:
+            batch_size = max(1, int(batch_size))
+        except:
+            batch_size = 100
+
+        if not self._prepare_edges():
+            return None
+
+        try:
+            general_collection = self.storage.db[COLLECTION_GENERAL]
+            if LAYOUT_EDGES != self.layout:
+                # the links are copied while the archive is still read in the embedded layout
+                moved = self._move_links_to_edges(batch_size, False)
+                timepoint = datetime.datetime.utcnow()
+                general_collection.update({'_id': self.collection_rank}, {'$set': {LAYOUT_FIELD: LAYOUT_EDGES, LAYOUT_SWITCHED_FIELD: timepoint, UPDATED_FIELD: timepoint}})
+                archive_cache.invalidate(self._archive_key())
+                self.layout = LAYOUT_EDGES
+                return moved
+
+            # archives switched before the switch time was kept have settled long ago
+            doc = general_collection.find_one({'_id': self.collection_rank}, {LAYOUT_SWITCHED_FIELD: 1})
+            switched_on = None
+            if doc:
+                switched_on = doc.get(LAYOUT_SWITCHED_FIELD)
+            to_unset = True
+            if (type(switched_on) is datetime.datetime) and (datetime.datetime.utcnow() < switched_on + datetime.timedelta(seconds=LAYOUT_SWITCH_TIME)):
+                to_unset = False
+                logging.info('embedded links of archive ' + str(self.collection_rank) + ' are kept, the layout switch is not settled yet')
+
+            moved = self._move_links_to_edges(batch_size, to_unset)
+
+            # links of media removed by the embedded layout requests
+            present_refs = set()
+            for entry in self.storage.db[self.collection_name].find({}, {'_id': 1}):
+                present_refs.add(entry['_id'])
+            edges_collection = self.storage.db[self.edges_name]
+            gone_refs = [one_ref for one_ref in edges_collection.distinct(EDGE_REF_A) if one_ref not in present_refs]
+            if gone_refs:
+                edges_collection.remove({EDGE_REF_A: {'$in': gone_refs}})
+                edges_collection.remove({EDGE_REF_B: {'$in': gone_refs}})
+        except:
+            self.correct = False
+            return None
+
+        return moved
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Benchmarks of the similarity search parts
+#
+# python -m mediasearch.utils.bench index [count ...]
+# python -m mediasearch.utils.bench serve [workers ...]
+# python -m mediasearch.utils.bench cascade [count ...]
+# python -m mediasearch.utils.bench projection [alike_count ...]
+# python -m mediasearch.utils.bench encode [dim ...]
+#
+
+import os, sys, time, datetime, random, signal, threading, argparse, binascii
+try:
+    import httplib
+except:
+    import http.client as httplib
+try:
+    import bson
+except:
+    bson = None
+import numpy
+from mediasearch.algs.hashindex import FeedHashes, ENGINE_LINEAR, ENGINE_MIH, packed_to_words
+from mediasearch.algs.imagehash import ImageHash, binary_array_to_hex, binary_array_to_int, hex_to_hash
+from mediasearch.app.prefork import PreforkServer
+
+BENCH_METHOD = 'image_phash'
+BENCH_INDEX_COUNTS = [10000, 100000, 1000000]
+BENCH_INDEX_QUERIES = 100
+BENCH_CASCADE_COUNTS = [1000, 10000, 100000]
+BENCH_CASCADE_GATE = ('image_dhash', 8, 24)
+BENCH_PROJECTION_ALIKES = [0, 10, 100, 1000]
+BENCH_PROJECTION_MEDIA = 1000
+BENCH_ENCODE_DIMS = [8, 16, 32]
+BENCH_ENCODE_HASHES = 1000
+BENCH_SERVE_WORKERS = [1, 2, 4, 8]
+BENCH_SERVE_REQUESTS = 400
+BENCH_SERVE_CLIENTS = 16
+BENCH_SERVE_WORK_MS = 2
+BENCH_SERVE_WAIT_MS = 20
+
+def _report(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+def _random_packed(rnd, bits):
+    return bytes(bytearray([rnd.randint(0, 255) for i in range(bits // 8)]))
+
+def _flip_packed(rnd, packed, flips):
+    data = bytearray(packed)
+    for bit in rnd.sample(range(len(data) * 8), flips):
+        data[bit // 8] ^= (1 << (bit % 8))
+    return bytes(data)
+
+def bench_index(counts=None, queries=BENCH_INDEX_QUERIES, dim=8, radius=16, seed=1):
+    '''
+    Linear scan vs. multi-index hashing on random hashes;
+    half of the queries are stored hashes with up to radius / 2 bits flipped
+    '''
+    if not counts:
+        counts = BENCH_INDEX_COUNTS
+
+    bits = dim * dim
+    rnd = random.Random(seed)
+    base_time = datetime.datetime(2014, 1, 1)
+
+    for count in counts:
+        stored = [_random_packed(rnd, bits) for i in range(count)]
+        query_set = []
+        for i in range(queries):
+            if i % 2:
+                query_set.append(_random_packed(rnd, bits))
+            else:
+                query_set.append(_flip_packed(rnd, stored[rnd.randint(0, count - 1)], rnd.randint(0, radius // 2)))
+
+        results = {}
+        for engine in [ENGINE_LINEAR, ENGINE_MIH]:
+            feed_hashes = FeedHashes(None, engine)
+            build_start = time.time()
+            for rank, packed in enumerate(stored):
+                feed_hashes.append(rank, base_time + datetime.timedelta(seconds=rank), [{'method': BENCH_METHOD, 'dim': dim, 'packed': packed}])
+            # the multi-index is made at the first query
+            feed_hashes.search(BENCH_METHOD, dim, packed_to_words(query_set[0]), radius, 0, count)
+            build_time = time.time() - build_start
+
+            found = []
+            query_start = time.time()
+            for packed in query_set:
+                cur_refs, cur_distances = feed_hashes.search(BENCH_METHOD, dim, packed_to_words(packed), radius, 0, count)
+                found.append(sorted(cur_refs))
+            query_time = time.time() - query_start
+
+            results[engine] = found
+            _report('%s: %d items, build %.2f s, %.3f ms per query' % (engine, count, build_time, 1000.0 * query_time / queries))
+
+        if results[ENGINE_LINEAR] != results[ENGINE_MIH]:
+            _report('results differ at %d items' % (count,))
+
+def bench_cascade(counts=None, queries=BENCH_INDEX_QUERIES, gate=BENCH_CASCADE_GATE, seed=1):
+    '''
+    Full insert-time comparison vs. the gated one, over feeds of random media with all the hashes;
+    half of the queries are stored media with a few bits flipped at each hash
+    '''
+    # the server parts are imported just for the benchmarks that use them
+    from mediasearch.plugin.process import MediaSearch
+
+    if not counts:
+        counts = BENCH_CASCADE_COUNTS
+
+    search = MediaSearch()
+    parts = []
+    for method in sorted(search.hash_methods):
+        for dim in search.hash_methods[method]['dims']:
+            parts.append((method, dim, search._alg_get_threshold(method, dim)))
+
+    rnd = random.Random(seed)
+    base_time = datetime.datetime(2014, 1, 1)
+
+    for count in counts:
+        stored = [[_random_packed(rnd, dim * dim) for method, dim, threshold in parts] for i in range(count)]
+        feed_hashes = FeedHashes(None, ENGINE_LINEAR)
+        for rank, packed_set in enumerate(stored):
+            feed_hashes.append(rank, base_time + datetime.timedelta(seconds=rank), [{'method': part[0], 'dim': part[1], 'packed': packed} for part, packed in zip(parts, packed_set)])
+
+        query_set = []
+        for i in range(queries):
+            if i % 2:
+                packed_set = [_random_packed(rnd, dim * dim) for method, dim, threshold in parts]
+            else:
+                packed_set = [_flip_packed(rnd, packed, rnd.randint(0, part[2] // 2)) for part, packed in zip(parts, stored[rnd.randint(0, count - 1)])]
+            query_set.append([(part[0], part[1], packed_to_words(packed), part[2]) for part, packed in zip(parts, packed_set)])
+
+        full_start = time.time()
+        full_found = [search._proc_compare_feed(feed_hashes, None, cmp_parts, 0, count) for cmp_parts in query_set]
+        full_time = time.time() - full_start
+
+        gated_start = time.time()
+        gated_found = [search._proc_compare_feed_cascade(feed_hashes, None, cmp_parts, gate, 0, count) for cmp_parts in query_set]
+        gated_time = time.time() - gated_start
+
+        missed = len([rank for rank in range(queries) if full_found[rank] != gated_found[rank]])
+        _report('%d items: full %.3f ms, gated %.3f ms per query, %d of %d queries differ' % (count, 1000.0 * full_time / queries, 1000.0 * gated_time / queries, missed, queries))
+
+def _project_media(doc, fields, hash_part=None):
+    # as the db does for the projections of the read paths: top level fields, 'alike.ref', a hash by $elemMatch
+    from mediasearch.plugin.storage import HASHES_FIELD
+
+    projected = {'_id': doc['_id']}
+    for one_field in fields:
+        if 'alike.ref' == one_field:
+            projected['alike'] = [{'ref': one_alike['ref']} for one_alike in doc['alike']]
+        elif one_field in doc:
+            projected[one_field] = doc[one_field]
+    if hash_part:
+        projected[HASHES_FIELD] = [one_hash for one_hash in doc[HASHES_FIELD] if (one_hash['method'], one_hash['dim']) == hash_part][:1]
+    return projected
+
+def bench_projection(alike_counts=None, media_count=BENCH_PROJECTION_MEDIA, seed=1):
+    '''
+    Bytes and BSON decode time of media documents, full vs. projected as on the read paths,
+    for several lengths of the alike arrays
+    '''
+    from mediasearch.plugin.process import MediaSearch, REMOVE_FIELDS
+    from mediasearch.plugin.storage import HashStorage, LISTED_FIELDS, LOADED_PROJECTION, HASHES_FIELD, CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD
+
+    if bson is None:
+        _report('bson module not available')
+        return
+    if not alike_counts:
+        alike_counts = BENCH_PROJECTION_ALIKES
+
+    search = MediaSearch()
+    parts = []
+    for method in sorted(search.hash_methods):
+        for dim in search.hash_methods[method]['dims']:
+            parts.append((method, dim))
+
+    storage = HashStorage(None)
+    rnd = random.Random(seed)
+    timepoint = datetime.datetime(2014, 1, 1)
+    read_paths = [
+        ('listed', LISTED_FIELDS, None),
+        ('loaded', list(LOADED_PROJECTION.keys()), None),
+        ('hash', [CREATED_FIELD], parts[0]),
+        ('remove', REMOVE_FIELDS, None)
+    ]
+
+    for alike_count in alike_counts:
+        docs = []
+        for rank in range(media_count):
+            hashes = [{'method': method, 'dim': dim, 'repr': binascii.hexlify(_random_packed(rnd, dim * dim))} for method, dim in parts]
+            alike = [{'ref': 'media_%08d' % rnd.randint(0, 10 ** 8), 'evals': [{'method': method, 'dim': dim, 'diff': rnd.randint(0, 20), 'dist': rnd.random()} for method, dim in parts]} for i in range(alike_count)]
+            docs.append({'_id': 'media_%08d' % rank, 'feed': 'default', HASHES_FIELD: storage._pack_hashes(hashes), 'alike': alike, 'tags': ['tag_a', 'tag_b'], CREATED_FIELD: timepoint, UPDATED_FIELD: timepoint, RELIKED_FIELD: timepoint})
+
+        cases = [('full', [bson.BSON.encode(doc) for doc in docs])]
+        for name, fields, hash_part in read_paths:
+            cases.append((name, [bson.BSON.encode(_project_media(doc, fields, hash_part)) for doc in docs]))
+
+        for name, encoded in cases:
+            decode_start = time.time()
+            for data in encoded:
+                bson.BSON(data).decode()
+            decode_time = time.time() - decode_start
+            _report('%d alike, %s: %d bytes, %.1f us decode per media' % (alike_count, name, sum([len(data) for data in encoded]) // media_count, 1000000.0 * decode_time / media_count))
+
+def _loop_to_hex(arr):
+    # the former per-bit encoding, for the comparison
+    h = 0
+    s = []
+    for i,v in enumerate(arr.flatten()):
+        if v: h += 2**(i % 8)
+        if (i % 8) == 7:
+            s.append(hex(h)[2:].rjust(2, '0'))
+            h = 0
+    return "".join(s)
+
+def _loop_from_hex(hexstr):
+    l = []
+    for i in range(len(hexstr) // 2):
+        v = int("0x" + hexstr[i*2:i*2+2], 16)
+        for j in range(8):
+            l.append(v & 2**j > 0)
+    return numpy.array(l)
+
+def _time_per_hash(call, values):
+    start = time.time()
+    results = [call(value) for value in values]
+    return (results, 1000000.0 * (time.time() - start) / len(values))
+
+def bench_encode(dims=None, hash_count=BENCH_ENCODE_HASHES, seed=1):
+    '''
+    Per-hash cost of the hex encoding, hex decoding and dict key hashing of image hashes,
+    the per-bit loops vs. the packbits ones, which have to give the same values
+    '''
+    if not dims:
+        dims = BENCH_ENCODE_DIMS
+
+    rnd = numpy.random.RandomState(seed)
+    for dim in dims:
+        arrays = [rnd.rand(dim, dim) > 0.5 for i in range(hash_count)]
+
+        loop_hexes, loop_encode = _time_per_hash(_loop_to_hex, arrays)
+        hexes, encode = _time_per_hash(binary_array_to_hex, arrays)
+        loop_bits, loop_decode = _time_per_hash(_loop_from_hex, hexes)
+        bits, decode = _time_per_hash(lambda hexstr: hex_to_hash(hexstr).hash, hexes)
+        loop_keys, loop_key = _time_per_hash(lambda arr: sum([2**(i % 8) for i,v in enumerate(arr.flatten()) if v]), arrays)
+        keys, key = _time_per_hash(binary_array_to_int, arrays)
+        image_hashes = [ImageHash(arr) for arr in arrays]
+        first_keys, first_key = _time_per_hash(hash, image_hashes)
+        cached_keys, cached_key = _time_per_hash(hash, image_hashes)
+
+        differ = len([rank for rank in range(hash_count) if (loop_hexes[rank] != hexes[rank]) or (not numpy.array_equal(loop_bits[rank], bits[rank])) or (loop_keys[rank] != keys[rank]) or (loop_keys[rank] != first_keys[rank]) or (loop_keys[rank] != cached_keys[rank])])
+        _report('%dx%d: encode %.1f -> %.1f us, decode %.1f -> %.1f us, key %.1f -> %.1f us, %.2f us cached, %d of %d hashes differ' % (dim, dim, loop_encode, encode, loop_decode, decode, loop_key, key, cached_key, differ, hash_count))
+
+def _make_serve_app(work_ms, wait_ms):
+    # a synthetic request: some CPU work, and some waiting, as on db or remote media
+    def serve_app(environ, start_response):
+        work_till = time.time() + (work_ms / 1000.0)
+        while time.time() < work_till:
+            pass
+        time.sleep(wait_ms / 1000.0)
+        body = b'{"_items": []}'
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+    return serve_app
+
+def _load_server(port, requests, clients):
+    lock = threading.Lock()
+    counts = {'left': requests, 'failed': 0}
+
+    def client_loop():
+        while True:
+            with lock:
+                if counts['left'] <= 0:
+                    return
+                counts['left'] -= 1
+            try:
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request('GET', '/')
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                if 200 != response.status:
+                    raise ValueError(response.status)
+            except:
+                with lock:
+                    counts['failed'] += 1
+
+    threads = [threading.Thread(target=client_loop) for i in range(clients)]
+    start = time.time()
+    for one_thread in threads:
+        one_thread.start()
+    for one_thread in threads:
+        one_thread.join()
+    return (time.time() - start, counts['failed'])
+
+def bench_serve(worker_counts=None, requests=BENCH_SERVE_REQUESTS, clients=BENCH_SERVE_CLIENTS, work_ms=BENCH_SERVE_WORK_MS, wait_ms=BENCH_SERVE_WAIT_MS):
+    '''
+    Throughput of the pre-fork server with a synthetic app, for several worker counts
+    '''
+    if not worker_counts:
+        worker_counts = BENCH_SERVE_WORKERS
+
+    for worker_count in worker_counts:
+        server = PreforkServer(_make_serve_app(work_ms, wait_ms), '127.0.0.1', 0, worker_count, 0)
+        port = server.bind()
+        pid = os.fork()
+        if not pid:
+            try:
+                server.serve()
+            finally:
+                os._exit(0)
+        server.server.server_close()
+
+        # warm-up, till the workers are started
+        _load_server(port, worker_count * 2, worker_count)
+        elapsed, failed = _load_server(port, requests, clients)
+        _report('%d workers: %d requests, %.1f requests/s, %d failed' % (worker_count, requests, requests / elapsed, failed))
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['index', 'serve', 'cascade', 'projection', 'encode'])
+    parser.add_argument('counts', nargs='*', type=int)
+    parser.add_argument('-r', '--radius', help='Hamming radius of the index queries', type=int, default=16)
+    parser.add_argument('-n', '--requests', help='count of the serve requests', type=int, default=BENCH_SERVE_REQUESTS)
+    parser.add_argument('-c', '--clients', help='count of the concurrent serve clients', type=int, default=BENCH_SERVE_CLIENTS)
+    args = parser.parse_args()
+
+    if 'index' == args.bench:
+        bench_index(args.counts, radius=args.radius)
+
+    if 'cascade' == args.bench:
+        bench_cascade(args.counts)
+
+    if 'projection' == args.bench:
+        bench_projection(args.counts)
+
+    if 'encode' == args.bench:
+        bench_encode(args.counts)
+
+    if 'serve' == args.bench:
+        bench_serve(args.counts, args.requests, args.clients)
+
+if __name__ == '__main__':
+    main()
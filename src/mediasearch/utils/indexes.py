@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Indexes of the stored collections: built in the background on existing archives, checked by query plans
+#
+# python -m mediasearch.utils.indexes build [-n dbname]
+# python -m mediasearch.utils.indexes verify [-n dbname]
+#
+
+import os, sys, time, logging, datetime, threading, argparse
+from mediasearch.utils.dbs import mongo_dbs
+from mediasearch.utils.migrate import connect_storage, MONGODB_SERVER_HOST, MONGODB_SERVER_PORT
+from mediasearch.plugin.storage import COLLECTION_GENERAL, COLLECTION_PARTICULAR, COLLECTION_EDGES, LAYOUT_FIELD, LAYOUT_EDGES
+from mediasearch.plugin.storage import FEED_FIELD, TAGS_FIELD, CREATED_FIELD, UPDATED_FIELD, RELIKED_FIELD, PROVIDER_FIELD, ARCHIVE_FIELD, EDGE_REF_A, EDGE_REF_B
+from mediasearch.plugin.storage import MEDIA_INDEXES, EDGE_INDEXES, GENERAL_INDEXES
+from mediasearch.plugin.hashcache import COLLECTION_HASH_CACHE, HASH_CACHE_INDEXES
+from mediasearch.plugin.jobs import COLLECTION_JOBS, JOB_INDEXES
+
+def index_name(keys):
+    # as the default db naming, e.g. feed_1_created_on_-1__id_1
+    return '_'.join(['%s_%s' % (one_field, one_dir) for one_field, one_dir in keys])
+
+def explain_plan(explained):
+    '''
+    Of the winning plan of an explain() output: {indexes: names of the used indexes, empty for collection scans,
+    sorted: whether the results are sorted in memory}
+    '''
+    if 'queryPlanner' not in explained:
+        # the explain format before MongoDB 3.0
+        names = []
+        cursor_name = str(explained.get('cursor', ''))
+        if cursor_name.startswith('BtreeCursor '):
+            names.append(cursor_name.split(' ')[1])
+        return {'indexes': names, 'sorted': bool(explained.get('scanAndOrder'))}
+
+    names = []
+    sorted_mode = False
+    parts = [explained['queryPlanner'].get('winningPlan')]
+    while parts:
+        one_part = parts.pop()
+        if type(one_part) is list:
+            parts.extend(one_part)
+        if type(one_part) is not dict:
+            continue
+        if one_part.get('indexName') and (one_part['indexName'] not in names):
+            names.append(one_part['indexName'])
+        if 'SORT' == one_part.get('stage'):
+            sorted_mode = True
+        parts.extend([one_value for one_value in one_part.values() if type(one_value) in [dict, list]])
+
+    return {'indexes': names, 'sorted': sorted_mode}
+
+class StorageIndexes(object):
+    def __init__(self, background=True):
+        self.background = background
+        self.lock = threading.Lock()
+        self.owner_pid = None
+
+    def set_background(self, background):
+        self.background = bool(background)
+        return True
+
+    def _ensure(self, collection, index_list):
+        built = 0
+        for one_index in index_list:
+            try:
+                collection.create_index(one_index, name=index_name(one_index), background=self.background)
+                built += 1
+            except Exception as exc:
+                logging.warning('can not build index ' + index_name(one_index) + ' on ' + str(collection.name) + ': ' + str(exc))
+        return built
+
+    def _list_archives(self, db):
+        # (media collection, edges collection or None) of all the archives
+        archives = []
+        for doc in db[COLLECTION_GENERAL].find({}, {LAYOUT_FIELD: 1}).sort([('_id', 1)]):
+            edges_name = None
+            if LAYOUT_EDGES == doc.get(LAYOUT_FIELD):
+                edges_name = COLLECTION_EDGES.format(rank=str(doc['_id']))
+            archives.append((COLLECTION_PARTICULAR.format(rank=str(doc['_id'])), edges_name))
+        return archives
+
+    def ensure_all(self, db):
+        '''
+        Builds the missing indexes of the general collections and of all the archives,
+        returns count of the ensured indexes, None on failures
+        '''
+        built = 0
+        try:
+            built += self._ensure(db[COLLECTION_GENERAL], GENERAL_INDEXES)
+            built += self._ensure(db[COLLECTION_HASH_CACHE], HASH_CACHE_INDEXES)
+            built += self._ensure(db[COLLECTION_JOBS], JOB_INDEXES)
+            for collection_name, edges_name in self._list_archives(db):
+                built += self._ensure(db[collection_name], MEDIA_INDEXES)
+                if edges_name:
+                    built += self._ensure(db[edges_name], EDGE_INDEXES)
+        except Exception as exc:
+            logging.warning('can not build indexes: ' + str(exc))
+            return None
+
+        return built
+
+    def _build(self):
+        db_holder = mongo_dbs.get_db()
+        if not db_holder:
+            return
+        start = time.time()
+        built = self.ensure_all(db_holder.db)
+        if built is not None:
+            logging.info('indexes ensured: ' + str(built) + ', in ' + str(round(time.time() - start, 1)) + ' s')
+
+    def prepare(self):
+        '''
+        Starts the build of the missing indexes, in a thread, once per server process
+        '''
+        with self.lock:
+            if self.owner_pid == os.getpid():
+                return True
+            self.owner_pid = os.getpid()
+            builder = threading.Thread(target=self._build)
+            builder.daemon = True
+            builder.start()
+
+        return True
+
+    def prepare_forked(self, connect_db=None):
+        '''
+        Starts the build of the missing indexes in a forked process, for a server that runs no threads
+        as it forks its workers; connect_db makes the db connection of the forked process
+        '''
+        # forked twice, the builder is left to init and not waited for by the server
+        try:
+            pid = os.fork()
+        except OSError as exc:
+            logging.warning('can not fork the index builder: ' + str(exc))
+            return False
+
+        if pid:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            return True
+
+        exit_code = 1
+        try:
+            if not os.fork():
+                if connect_db:
+                    connect_db()
+                self._build()
+            exit_code = 0
+        except Exception as exc:
+            logging.warning('can not build indexes: ' + str(exc))
+        finally:
+            os._exit(exit_code)
+
+    def _explain(self, collection, spec, sort):
+        cursor = collection.find(spec)
+        if sort:
+            cursor = cursor.sort(sort)
+        return explain_plan(cursor.explain())
+
+    def verify(self, db, feed='default', tag='tag'):
+        '''
+        Query plans of the hot queries: [{collection, query, expected, used, sorted, ok}],
+        ok when an index is used and the results are not sorted in memory;
+        on small collections, the db may take another fitting index than the expected one
+        '''
+        timepoint = datetime.datetime.utcnow()
+        checks = [
+            (COLLECTION_GENERAL, 'archive', {PROVIDER_FIELD: '', ARCHIVE_FIELD: ''}, None, GENERAL_INDEXES[0]),
+            (COLLECTION_HASH_CACHE, 'evict', {}, [('used_on', 1)], HASH_CACHE_INDEXES[0]),
+            (COLLECTION_JOBS, 'queued', {'state': 'queued'}, [('created_on', 1)], JOB_INDEXES[0]),
+            (COLLECTION_JOBS, 'list', {'provider': '', 'archive': ''}, [('created_on', -1)], JOB_INDEXES[1]),
+            (COLLECTION_JOBS, 'expired', {'state': 'running', 'claimed_on': {'$lt': timepoint}}, [('claimed_on', 1)], JOB_INDEXES[2])
+        ]
+        for collection_name, edges_name in self._list_archives(db):
+            checks += [
+                (collection_name, 'load', {FEED_FIELD: feed, CREATED_FIELD: {'$gte': timepoint}}, [(CREATED_FIELD, -1)], MEDIA_INDEXES[0]),
+                (collection_name, 'created', {FEED_FIELD: feed}, [(CREATED_FIELD, -1), ('_id', 1)], MEDIA_INDEXES[0]),
+                (collection_name, 'tagged', {'$and': [{FEED_FIELD: feed}, {TAGS_FIELD: tag}]}, [(CREATED_FIELD, -1), ('_id', 1)], MEDIA_INDEXES[1]),
+                (collection_name, 'ref', {FEED_FIELD: feed}, [('_id', 1)], MEDIA_INDEXES[2]),
+                (collection_name, 'updated', {FEED_FIELD: feed}, [(UPDATED_FIELD, -1), ('_id', 1)], MEDIA_INDEXES[3]),
+                (collection_name, 'reliked', {FEED_FIELD: feed}, [(RELIKED_FIELD, -1), ('_id', 1)], MEDIA_INDEXES[4])
+            ]
+            if edges_name:
+                checks += [
+                    (edges_name, 'alike', {EDGE_REF_A: {'$in': ['']}}, [('dist', 1), (EDGE_REF_B, 1)], EDGE_INDEXES[0]),
+                    (edges_name, 'linked', {EDGE_REF_B: ''}, None, EDGE_INDEXES[1])
+                ]
+
+        results = []
+        for collection_name, query_name, spec, sort, expected in checks:
+            try:
+                plan = self._explain(db[collection_name], spec, sort)
+            except Exception as exc:
+                logging.warning('can not explain ' + query_name + ' on ' + collection_name + ': ' + str(exc))
+                plan = {'indexes': [], 'sorted': None}
+            results.append({'collection': collection_name, 'query': query_name, 'expected': index_name(expected), 'used': plan['indexes'], 'sorted': plan['sorted'], 'ok': bool(plan['indexes']) and (plan['sorted'] is False)})
+
+        return results
+
+storage_indexes = StorageIndexes()
+
+def _report(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['build', 'verify'])
+    parser.add_argument('-n', '--database', help='mediasearch database name', default='mediasearch')
+    parser.add_argument('-a', '--db_host', help='MongoDB host', default=MONGODB_SERVER_HOST)
+    parser.add_argument('-p', '--db_port', help='MongoDB port', type=int, default=MONGODB_SERVER_PORT)
+    parser.add_argument('-f', '--feed', help='feed to explain the queries with', default='default')
+    args = parser.parse_args()
+
+    storage = connect_storage(args.database, args.db_host, args.db_port)
+
+    if 'build' == args.action:
+        built = storage_indexes.ensure_all(storage.db)
+        if built is None:
+            os._exit(1)
+        _report(str(built) + ' indexes ensured')
+
+    if 'verify' == args.action:
+        failed = 0
+        for one_result in storage_indexes.verify(storage.db, args.feed):
+            if not one_result['ok']:
+                failed += 1
+            state = 'ok'
+            if not one_result['ok']:
+                state = 'NOT INDEXED, expected ' + one_result['expected']
+            _report('%s %s: %s; used %s, sorted in memory: %s' % (one_result['collection'], one_result['query'], state, ', '.join(one_result['used']) or 'none', one_result['sorted']))
+        if failed:
+            os._exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Online migrations of the stored archives, can be run alongside a running server
+#
+# python -m mediasearch.utils.migrate hashes [-n dbname]
+# python -m mediasearch.utils.migrate edges [-n dbname]
+#
+
+MONGODB_SERVER_HOST = 'localhost'
+MONGODB_SERVER_PORT = 27017
+
+import os, sys, time, logging, argparse
+from collections import namedtuple
+try:
+    from pymongo import MongoClient
+except:
+    logging.error('MongoDB support is not installed')
+    os._exit(1)
+from mediasearch.plugin.storage import HashStorage, COLLECTION_GENERAL, PROVIDER_FIELD, ARCHIVE_FIELD, LAYOUT_SWITCH_TIME
+
+MIGRATE_BATCH_SIZE = 100
+MIGRATE_SETTLE_MARGIN = 5
+
+def _report(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+def connect_storage(dbname, host=MONGODB_SERVER_HOST, port=MONGODB_SERVER_PORT):
+    DbHolder = namedtuple('DbHolder', 'db')
+    return DbHolder(db=MongoClient(host, port)[dbname])
+
+def list_provider_archives(storage):
+    provider_archives = []
+    for doc in storage.db[COLLECTION_GENERAL].find().sort([('_id', 1)]):
+        provider_archives.append((doc[PROVIDER_FIELD], doc[ARCHIVE_FIELD]))
+    return provider_archives
+
+def migrate_hashes(storage, batch_size=MIGRATE_BATCH_SIZE):
+    '''
+    Hex hash representations into the Int64/BinData forms, for all the archives
+    '''
+    for provider, archive in list_provider_archives(storage):
+        media_storage = HashStorage(storage)
+        media_storage.set_storage(provider, archive, False)
+        if not media_storage.storage_set():
+            continue
+        converted = media_storage.convert_hashes(batch_size)
+        if converted is None:
+            logging.error('can not convert hashes of: ' + str(provider) + '/' + str(archive))
+            continue
+        _report(str(provider) + '/' + str(archive) + ': ' + str(converted) + ' media converted')
+
+def migrate_edges(storage, batch_size=MIGRATE_BATCH_SIZE, settle_time=LAYOUT_SWITCH_TIME + MIGRATE_SETTLE_MARGIN):
+    '''
+    Embedded alike links into the edges collections, for all the archives;
+    the first pass copies the links and switches the layout, a second pass once running servers
+    have taken the switch copies links written meanwhile and removes the embedded ones
+    '''
+    switched = []
+    for provider, archive in list_provider_archives(storage):
+        media_storage = HashStorage(storage)
+        media_storage.set_storage(provider, archive, False)
+        if not media_storage.storage_set():
+            continue
+        moved = media_storage.convert_links_to_edges(batch_size)
+        if moved is None:
+            logging.error('can not move links of: ' + str(provider) + '/' + str(archive))
+            continue
+        switched.append((provider, archive))
+        _report(str(provider) + '/' + str(archive) + ': links of ' + str(moved) + ' media copied to edges')
+
+    if not switched:
+        return
+    _report('running servers take the edges layout within ' + str(LAYOUT_SWITCH_TIME) + ' s, the embedded links are removed then')
+    time.sleep(settle_time)
+
+    for provider, archive in switched:
+        media_storage = HashStorage(storage)
+        media_storage.set_storage(provider, archive, False)
+        moved = media_storage.convert_links_to_edges(batch_size)
+        if moved is None:
+            logging.error('can not move links of: ' + str(provider) + '/' + str(archive))
+            continue
+        _report(str(provider) + '/' + str(archive) + ': links of ' + str(moved) + ' media moved to edges')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('migration', choices=['hashes', 'edges'])
+    parser.add_argument('-n', '--database', help='mediasearch database name', default='mediasearch')
+    parser.add_argument('-a', '--db_host', help='MongoDB host', default=MONGODB_SERVER_HOST)
+    parser.add_argument('-p', '--db_port', help='MongoDB port', type=int, default=MONGODB_SERVER_PORT)
+    args = parser.parse_args()
+
+    storage = connect_storage(args.database, args.db_host, args.db_port)
+
+    if 'hashes' == args.migration:
+        migrate_hashes(storage)
+
+    if 'edges' == args.migration:
+        migrate_edges(storage)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Process-wide counters, exposed by the _stats entry
+#
+
+import threading
+
+class MediaStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def timing(self, name, seconds):
+        # kept as count, total and max; listed as name_count, name_avg_ms, name_max_ms
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def add_gauge(self, name, getter):
+        # gauges are taken at the read time, e.g. current sizes of caches
+        with self.lock:
+            self.gauges[name] = getter
+
+    def get_values(self):
+        with self.lock:
+            values = dict(self.counters)
+            gauges = list(self.gauges.items())
+            for name, timing in self.timings.items():
+                values[name + '_count'] = timing[0]
+                values[name + '_avg_ms'] = round(1000.0 * timing[1] / timing[0], 3)
+                values[name + '_max_ms'] = round(1000.0 * timing[2], 3)
+
+        for name, getter in gauges:
+            try:
+                values[name] = getter()
+            except:
+                values[name] = None
+
+        return values
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+
+media_stats = MediaStats()
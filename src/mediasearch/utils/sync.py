@@ -42,8 +42,6 @@ class Sync(object):
                 return False
 
         self.fh = None
-        self.lockfile = lockfile
-
 
         return True
 
@@ -52,7 +50,7 @@ class Sync(object):
             return False
 
         try:
-            fcntl.lockf(fh.fileno(), fcntl.LOCK_EX)
+            fcntl.lockf(self.fh.fileno(), fcntl.LOCK_EX)
         except:
             return False
 
@@ -63,7 +61,7 @@ class Sync(object):
             return False
 
         try:
-            fcntl.lockf(fh.fileno(), fcntl.LOCK_UN)
+            fcntl.lockf(self.fh.fileno(), fcntl.LOCK_UN)
         except:
             return False
 
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Pool of worker processes for the CPU-bound media hashing
+#
+# the pool is started by the server before it starts any threads and before it forks
+# server processes, which then share it; each worker has a fixed pipe channel, taken
+# by a cross-process lock for a task; a crashed or stuck worker fails just its current
+# item, and it is replaced on the same channel by the starting process, retried with
+# a backoff on failures; a pre-forking server polls the supervision from its master loop,
+# since a thread of the master could hold a lock while a server process is forked
+#
+
+import os, io, time, signal, logging, threading, multiprocessing
+from mediasearch.algs.methods import MediaHashMethods
+
+HASH_TASK_TIMEOUT = 60
+HASH_TASK_POLL = 1
+HASH_CHANNEL_POLL = 0.05
+RESTART_BACKOFF_MIN = 1
+RESTART_BACKOFF_MAX = 60
+STATE_LIVE = 0
+STATE_BROKEN = 1
+STATE_DOWN = 2
+
+def _worker_loop(conn):
+    # workers are forked from the server, not to take its signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    hash_methods_holder = MediaHashMethods()
+    while True:
+        try:
+            task = conn.recv()
+        except:
+            break
+        if task is None:
+            break
+
+        task_id, image_path, image_data = task
+        image_source = image_path
+        if image_data is not None:
+            image_source = io.BytesIO(image_data)
+
+        try:
+            result = hash_methods_holder.create_hashes(image_source)
+        except:
+            result = []
+
+        try:
+            conn.send((task_id, result))
+        except:
+            break
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+class HashWorkers(object):
+    def __init__(self, count=0, timeout=HASH_TASK_TIMEOUT):
+        self.count = count
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.owner_pid = None
+        self.channels = None
+        self.worker_ends = None
+        self.channel_locks = None
+        self.states = None
+        self.pids = None
+        self.holders = None
+        self.processes = None
+        self.task_rank = 0
+        self.supervised = True
+        self.backoffs = None
+        self.retry_times = None
+
+    def set_supervised(self, supervised):
+        '''
+        Whether start() runs the supervision in a thread; when not, supervise() is to be polled by the caller
+        '''
+        self.supervised = bool(supervised)
+        return True
+
+    def set_count(self, count):
+        try:
+            count = int(count)
+        except:
+            count = 0
+        self.count = max(0, count)
+        return True
+
+    def get_count(self):
+        return self.count
+
+    def is_active(self):
+        return bool(self.count)
+
+    def get_live(self):
+        if self.states is None:
+            return 0
+        return len([one_state for one_state in self.states if STATE_LIVE == one_state])
+
+    def _start_worker(self, rank):
+        process = multiprocessing.Process(target=_worker_loop, args=(self.worker_ends[rank],))
+        process.daemon = True
+        process.start()
+        self.processes[rank] = process
+        self.pids[rank] = process.pid
+        self.states[rank] = STATE_LIVE
+
+    def _stop_worker(self, rank):
+        process = self.processes[rank]
+        self.processes[rank] = None
+        if process is None:
+            return
+        try:
+            if process.is_alive():
+                process.terminate()
+            process.join(1)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join(1)
+        except:
+            pass
+
+    def start(self):
+        '''
+        Starts the workers, with their supervision if set so; to be called before any other
+        threads are started and before server processes are forked; returns count of live workers
+        '''
+        with self.lock:
+            if (not self.count) or (self.channels is not None):
+                return self.get_live()
+
+            self.owner_pid = os.getpid()
+            self.channels = []
+            self.worker_ends = []
+            self.channel_locks = []
+            self.processes = [None] * self.count
+            self.states = multiprocessing.Array('i', [STATE_DOWN] * self.count, lock=False)
+            self.pids = multiprocessing.Array('i', [0] * self.count, lock=False)
+            self.holders = multiprocessing.Array('i', [0] * self.count, lock=False)
+            self.backoffs = [0] * self.count
+            self.retry_times = [0] * self.count
+            for rank in range(self.count):
+                parent_conn, child_conn = multiprocessing.Pipe()
+                self.channels.append(parent_conn)
+                self.worker_ends.append(child_conn)
+                self.channel_locks.append(multiprocessing.Lock())
+                try:
+                    self._start_worker(rank)
+                except:
+                    logging.error('can not start hash worker')
+
+            if self.supervised:
+                supervisor = threading.Thread(target=self._supervise)
+                supervisor.daemon = True
+                supervisor.start()
+
+        return self.get_live()
+
+    def _release_orphaned(self, rank):
+        # a channel held by a server process that died meanwhile, possibly with a request half sent
+        holder = self.holders[rank]
+        if (not holder) or _is_running(holder):
+            return
+        logging.warning('hash worker channel held by a stopped process: ' + str(holder))
+        self.holders[rank] = 0
+        self.states[rank] = STATE_BROKEN
+        try:
+            self.channel_locks[rank].release()
+        except:
+            pass
+
+    def supervise(self):
+        '''
+        Replaces the stopped or broken workers, once; just in the starting process
+        '''
+        if (self.channels is None) or (self.owner_pid != os.getpid()):
+            return False
+
+        for rank in range(self.count):
+            self._release_orphaned(rank)
+            process = self.processes[rank]
+            if (STATE_LIVE == self.states[rank]) and (process is not None) and process.is_alive():
+                continue
+            if time.time() < self.retry_times[rank]:
+                continue
+
+            self.states[rank] = STATE_DOWN
+            self._stop_worker(rank)
+            try:
+                self._start_worker(rank)
+                self.backoffs[rank] = 0
+                logging.info('hash worker restarted: ' + str(rank))
+            except:
+                self.backoffs[rank] = min(RESTART_BACKOFF_MAX, max(RESTART_BACKOFF_MIN, 2 * self.backoffs[rank]))
+                self.retry_times[rank] = time.time() + self.backoffs[rank]
+                logging.error('can not restart hash worker, next try in ' + str(self.backoffs[rank]) + ' s')
+
+        return True
+
+    def _supervise(self):
+        while True:
+            time.sleep(HASH_TASK_POLL)
+            self.supervise()
+
+    def _take_channel(self):
+        # a live worker with a free channel, waited for up to the task timeout
+        with self.lock:
+            self.task_rank += 1
+            offset = self.task_rank
+        wait_till = time.time() + self.timeout
+        while True:
+            for shift in range(self.count):
+                rank = (offset + shift) % self.count
+                if STATE_LIVE != self.states[rank]:
+                    continue
+                if not self.channel_locks[rank].acquire(False):
+                    continue
+                if STATE_LIVE != self.states[rank]:
+                    self.channel_locks[rank].release()
+                    continue
+                self.holders[rank] = os.getpid()
+                return (rank, offset)
+            if time.time() >= wait_till:
+                return (None, offset)
+            time.sleep(HASH_CHANNEL_POLL)
+
+    def create_hashes(self, image_path=None, image_data=None):
+        '''
+        Hashes of the image, given by a file path or by the file bytes
+        returns list of {method, dim, packed}, empty on failures
+        '''
+        # started here when not started by a server, e.g. by the tools
+        if self.channels is None:
+            self.start()
+        if self.channels is None:
+            return []
+
+        rank, task_rank = self._take_channel()
+        if rank is None:
+            logging.warning('no hash worker available for: ' + str(image_path))
+            return []
+
+        conn = self.channels[rank]
+        worker_pid = self.pids[rank]
+        task_id = (os.getpid(), task_rank)
+        result = None
+        try:
+            conn.send((task_id, image_path, image_data))
+            waited = 0
+            while waited < self.timeout:
+                if conn.poll(HASH_TASK_POLL):
+                    reply = conn.recv()
+                    # replies to tasks given up before are passed
+                    if reply[0] == task_id:
+                        result = reply[1]
+                        break
+                    continue
+                if (STATE_LIVE != self.states[rank]) or (self.pids[rank] != worker_pid):
+                    break
+                waited += HASH_TASK_POLL
+        except:
+            result = None
+
+        if result is None:
+            logging.warning('hash worker failed on: ' + str(image_path))
+            if self.pids[rank] == worker_pid:
+                self.states[rank] = STATE_BROKEN
+
+        self.holders[rank] = 0
+        self.channel_locks[rank].release()
+
+        if not result:
+            return []
+        return result
+
+hash_workers = HashWorkers()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Throwaway databases for the storage tests: on a local MongoDB when reachable, else on mongomock when installed
+#
+
+import uuid
+try:
+    from pymongo import MongoClient
+except:
+    MongoClient = None
+try:
+    import mongomock
+except:
+    mongomock = None
+
+MONGODB_TEST_HOST = 'localhost'
+MONGODB_TEST_PORT = 27017
+MONGODB_TEST_TIMEOUT_MS = 500
+
+class StandInDb(object):
+    def __init__(self, client, dbname):
+        self.client = client
+        self.dbname = dbname
+        self.db = client[dbname]
+
+    def drop(self):
+        try:
+            self.client.drop_database(self.dbname)
+        except:
+            pass
+
+def connect_mongodb():
+    # a new database on a reachable MongoDB server, None otherwise
+    if MongoClient is None:
+        return None
+    try:
+        client = MongoClient(MONGODB_TEST_HOST, MONGODB_TEST_PORT, serverSelectionTimeoutMS=MONGODB_TEST_TIMEOUT_MS)
+        client.server_info()
+    except:
+        return None
+    return StandInDb(client, 'mediasearch_test_' + uuid.uuid4().hex[:8])
+
+def connect_any():
+    # the real server preferred, mongomock as the stand-in, None when neither is there
+    stand_in = connect_mongodb()
+    if (stand_in is None) and (mongomock is not None):
+        stand_in = StandInDb(mongomock.MongoClient(), 'mediasearch_test')
+    return stand_in
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the similar media listings: the aggregated and the collected paths give the same pages
+#
+
+import json, random, datetime, itertools, unittest
+from mediasearch.plugin.storage import HashStorage, storage_layouts, aggregation_support, LAYOUT_EMBEDDED, LAYOUT_EDGES
+from stand_in_db import connect_any
+
+MEDIA_COUNT = 16
+LINK_COUNT = 4
+START_TIME = datetime.datetime(2020, 1, 1)
+
+def make_archive(db_holder, layout):
+    # media with the (feed, tags, created_on) repeating, linked to some of the earlier ones, on coarse distances
+    rnd = random.Random(7)
+    saved_layout = storage_layouts.get_new_layout()
+    storage_layouts.set_new_layout(layout)
+    try:
+        storage = HashStorage(db_holder)
+        storage.set_storage('prov', layout, True)
+    finally:
+        storage_layouts.set_new_layout(saved_layout)
+
+    for rank in range(MEDIA_COUNT):
+        ref = 'm%02d' % (rank,)
+        created_on = START_TIME + datetime.timedelta(seconds=(rank // 3))
+        storage.save_new_media({'ref': ref, 'feed': 'f%d' % (rank % 2,), 'tags': ['t%d' % (rank % 3,)], 'hashes': [], 'alike': []}, False, created_on)
+        alike_parts = []
+        for linked in rnd.sample(range(rank), min(rank, LINK_COUNT)):
+            evals = []
+            for method, dim in [('dhash', 8), ('phash', 16)]:
+                diff = rnd.randint(0, 8)
+                evals.append({'method': method, 'dim': dim, 'diff': diff, 'dist': diff / 8.0})
+            alike_parts.append({'ref': 'm%02d' % (linked,), 'evals': evals})
+        storage.append_alike_links(ref, alike_parts, created_on)
+
+    return storage
+
+def dump(res):
+    return json.dumps(res, default=str, sort_keys=True)
+
+class AlikeListingsTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_any()
+        if self.db_holder is None:
+            self.skipTest('neither MongoDB nor mongomock is available')
+
+    def tearDown(self):
+        aggregation_support.set_supported(None)
+        self.db_holder.drop()
+
+    def _both(self, call):
+        aggregation_support.set_supported(True)
+        aggregated = call()
+        aggregation_support.set_supported(False)
+        collected = call()
+        return (aggregated, collected)
+
+    def _pages(self, storage, refs, feed, tags_with, threshold, order, limit):
+        # all the pages, as followed by the continuation tokens
+        pages = []
+        after = None
+        while True:
+            res = storage.get_alike_media(refs, feed, tags_with, None, threshold, order, None, limit, after)
+            pages.append(res)
+            after = res.get('next')
+            if (not after) or (len(pages) > MEDIA_COUNT):
+                return pages
+
+    def _check_layout(self, layout):
+        storage = make_archive(self.db_holder, layout)
+        self.assertEqual(layout, storage.get_layout())
+
+        ref_lists = [['m05'], ['m03', 'm11', 'm03'], ['m%02d' % (rank,) for rank in range(0, MEDIA_COUNT, 3)] + ['mXX']]
+        filters = [(None, None), ('f0', None), (None, [['t1']])]
+        grid = itertools.product(ref_lists, filters, [None, 0.5], [None, ['created'], ['updated', 'ref']])
+        for refs, (feed, tags_with), threshold, order in grid:
+            case = (layout, refs, feed, tags_with, threshold, order)
+            aggregated, collected = self._both(lambda: storage.get_alike_media(refs, feed, tags_with, None, threshold, order, 1, 3))
+            self.assertEqual(dump(aggregated), dump(collected), case)
+
+            aggregated, collected = self._both(lambda: self._pages(storage, refs, feed, tags_with, threshold, order, 2))
+            self.assertEqual(dump(aggregated), dump(collected), case)
+            listed = [one_item['ref'] for one_page in aggregated for one_item in one_page['items']]
+            self.assertEqual(len(set(listed)), len(listed), case)
+            self.assertEqual(aggregated[0]['total'], len(listed), case)
+
+            for offset, limit in [(None, None), (1, 2)]:
+                aggregated, collected = self._both(lambda: storage.get_alike_groups(refs, feed, tags_with, None, threshold, order, offset, limit))
+                self.assertEqual(dump(aggregated), dump(collected), case + (offset, limit))
+
+        self.assertTrue(storage.is_correct())
+
+    def test_edges_closest(self):
+        # without filters and totals, the collected edges are paged before their media are fetched
+        storage = make_archive(self.db_holder, LAYOUT_EDGES)
+        self.db_holder.db[storage.get_collection_name()].remove({'_id': {'$in': ['m02', 'm07']}})
+        aggregation_support.set_supported(False)
+
+        refs = ['m%02d' % (rank,) for rank in range(0, MEDIA_COUNT, 3)]
+        for order in [None, ['ref']]:
+            listed = storage.get_alike_media(refs, None, None, None, None, order)
+            self.assertTrue(listed['items'])
+            self.assertFalse(set(['m02', 'm07']) & set([one_item['ref'] for one_item in listed['items']]))
+            for offset, limit in [(None, None), (2, 3), (None, 0), (1, 100)]:
+                exact = storage.get_alike_media(refs, None, None, None, None, order, offset, limit)
+                skipped = storage.get_alike_media(refs, None, None, None, None, order, offset, limit, None, 'skip')
+                self.assertEqual(None, skipped['total'])
+                self.assertEqual(dump(exact['items']), dump(skipped['items']), (order, offset, limit))
+                self.assertEqual(exact.get('next'), skipped.get('next'), (order, offset, limit))
+
+        self.assertTrue(storage.is_correct())
+
+    def test_embedded(self):
+        self._check_layout(LAYOUT_EMBEDDED)
+
+    def test_edges(self):
+        self._check_layout(LAYOUT_EDGES)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the feed comparisons: the packed word scans give what the per-pair hash comparison does
+#
+
+import random, datetime, binascii, unittest
+import numpy
+from mediasearch.algs.hashindex import FeedHashes, ENGINE_LINEAR, packed_from_hex, packed_to_words
+from mediasearch.plugin.process import MediaSearch
+
+ITEM_COUNT = 60
+QUERY_COUNT = 10
+START_TIME = datetime.datetime(2020, 1, 1)
+
+def random_packed(rnd, bits):
+    return bytes(bytearray([rnd.randint(0, 255) for i in range(bits // 8)]))
+
+def flip_packed(rnd, packed, flips):
+    data = bytearray(packed)
+    for bit in rnd.sample(range(len(data) * 8), flips):
+        data[bit // 8] ^= (1 << (bit % 8))
+    return bytes(data)
+
+def to_hex(packed):
+    return str(binascii.hexlify(packed).decode('ascii'))
+
+def eval_key(one_eval):
+    return (one_eval['method'], one_eval['dim'])
+
+class CompareParityTest(unittest.TestCase):
+    def setUp(self):
+        self.search = MediaSearch()
+
+    def _pairs(self):
+        # all the method/dim pairs with a threshold, the dims of not even words included
+        pairs = []
+        for method in sorted(self.search.hash_methods):
+            for dim in sorted(self.search.hash_methods[method]['lims']):
+                if dim:
+                    pairs.append((method, dim))
+        return pairs
+
+    def _stored(self, rnd, pairs):
+        # media near to each other, each lacking some of the hashes
+        stored = []
+        bases = [random_packed(rnd, dim * dim) for method, dim in pairs]
+        for rank in range(ITEM_COUNT):
+            hashes = []
+            for (method, dim), base in zip(pairs, bases):
+                if rnd.randint(0, 9):
+                    threshold = self.search._alg_get_threshold(method, dim)
+                    hashes.append({'method': method, 'dim': dim, 'packed': flip_packed(rnd, base, rnd.randint(0, 2 * threshold))})
+            stored.append(('m%02d' % (rank,), hashes))
+        return (stored, bases)
+
+    def test_feed_parity(self):
+        rnd = random.Random(5)
+        pairs = self._pairs()
+        stored, bases = self._stored(rnd, pairs)
+        feed_hashes = FeedHashes(None, ENGINE_LINEAR)
+        for rank, (ref, hashes) in enumerate(stored):
+            feed_hashes.append(ref, START_TIME + datetime.timedelta(seconds=rank), hashes)
+        start, stop = feed_hashes.window(None, None)
+
+        for query_rank in range(QUERY_COUNT):
+            cmp_parts = []
+            query_hex = {}
+            for (method, dim), base in zip(pairs, bases):
+                threshold = self.search._alg_get_threshold(method, dim)
+                query_hex[(method, dim)] = to_hex(flip_packed(rnd, base, rnd.randint(0, threshold)))
+                cmp_parts.append((method, dim, packed_to_words(packed_from_hex(query_hex[(method, dim)])), threshold))
+            media_ref = stored[query_rank][0]
+
+            expected = {}
+            for ref, hashes in stored:
+                if ref == media_ref:
+                    continue
+                for one_hash in hashes:
+                    compared = self.search._alg_compare_hashes(one_hash['method'], one_hash['dim'], query_hex[(one_hash['method'], one_hash['dim'])], to_hex(one_hash['packed']))
+                    self.assertTrue(compared is not None)
+                    if compared['similar']:
+                        expected.setdefault(ref, []).append({'method': one_hash['method'], 'dim': one_hash['dim'], 'diff': str(int(compared['diff'])), 'dist': compared['dist']})
+
+            feed_diffs = self.search._proc_compare_feed(feed_hashes, media_ref, cmp_parts, start, stop)
+            self.assertTrue(expected)
+            self.assertEqual(sorted(expected.keys()), sorted(feed_diffs.keys()))
+            for ref in expected:
+                self.assertEqual(sorted(expected[ref], key=eval_key), sorted(feed_diffs[ref], key=eval_key), ref)
+
+    def test_cascade(self):
+        # with the gate bound relaxed to the whole gate hash, the cascade finds what the full comparison does;
+        # with the bound at the gate lims, it misses just the media more distant than that at the gate hash
+        rnd = random.Random(6)
+        pairs = self._pairs()
+        stored, bases = self._stored(rnd, pairs)
+        feed_hashes = FeedHashes(None, ENGINE_LINEAR)
+        for rank, (ref, hashes) in enumerate(stored):
+            feed_hashes.append(ref, START_TIME + datetime.timedelta(seconds=rank), hashes)
+        start, stop = feed_hashes.window(None, None)
+        gate_method, gate_dim = ('image_dhash', 8)
+        gate_threshold = self.search._alg_get_threshold(gate_method, gate_dim)
+
+        missed = 0
+        for query_rank in range(QUERY_COUNT):
+            cmp_parts = []
+            gate_hex = None
+            for (method, dim), base in zip(pairs, bases):
+                threshold = self.search._alg_get_threshold(method, dim)
+                packed = flip_packed(rnd, base, rnd.randint(0, threshold))
+                if (gate_method, gate_dim) == (method, dim):
+                    gate_hex = to_hex(packed)
+                cmp_parts.append((method, dim, packed_to_words(packed), threshold))
+            media_ref = stored[query_rank][0]
+
+            full_diffs = self.search._proc_compare_feed(feed_hashes, media_ref, cmp_parts, start, stop)
+            relaxed_diffs = self.search._proc_compare_feed_cascade(feed_hashes, media_ref, cmp_parts, (gate_method, gate_dim, gate_dim * gate_dim), start, stop)
+            self.assertEqual(full_diffs, relaxed_diffs)
+
+            gated_diffs = self.search._proc_compare_feed_cascade(feed_hashes, media_ref, cmp_parts, (gate_method, gate_dim, gate_threshold), start, stop)
+            for ref, hashes in stored:
+                if ref not in full_diffs:
+                    self.assertFalse(ref in gated_diffs, ref)
+                    continue
+                if ref in gated_diffs:
+                    self.assertEqual(full_diffs[ref], gated_diffs[ref], ref)
+                    continue
+                missed += 1
+                gate_hashes = [to_hex(one_hash['packed']) for one_hash in hashes if (gate_method, gate_dim) == (one_hash['method'], one_hash['dim'])]
+                self.assertEqual(1, len(gate_hashes), ref)
+                self.assertFalse(self.search._alg_compare_hashes(gate_method, gate_dim, gate_hex, gate_hashes[0])['similar'], ref)
+
+        self.assertTrue(missed)
+
+    def test_collect_diffs(self):
+        # the scan distances are numpy integers, the diffs are kept as strings, as of the per-pair comparisons
+        for method, dim in self._pairs():
+            zero_hex = '0' * (dim * dim // 4)
+            compared = self.search._alg_compare_hashes(method, dim, zero_hex, '07' + zero_hex[2:])
+            feed_diffs = {}
+            self.search._proc_collect_diffs(feed_diffs, 'm00', method, dim, ['m00', 'm01'], numpy.array([0, 3], dtype=numpy.intp))
+            self.assertEqual(['m01'], list(feed_diffs.keys()))
+            self.assertEqual([{'method': method, 'dim': dim, 'diff': str(compared['diff']), 'dist': compared['dist']}], feed_diffs['m01'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the media fetcher, against a local http server
+#
+
+import os, time, shutil, tempfile, threading, unittest
+try:
+    import BaseHTTPServer
+    import SocketServer
+except:
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+from mediasearch.utils.fetch import MediaFetcher
+
+SLOW_DELAY = 0.2
+SMALL_BODY = b'x' * 100
+LARGE_BODY = b'y' * 5000
+ETAG = '"media-1"'
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.proxy_auths.append(self.headers.get('Proxy-Authorization'))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            path = self.path
+            if path.startswith('http://'):
+                path = '/' + path.split('/', 3)[3]
+            if '/slow' == path:
+                time.sleep(SLOW_DELAY)
+                self._send(200, SMALL_BODY)
+            elif '/large' == path:
+                self._send(200, LARGE_BODY)
+            elif '/tagged' == path:
+                if self.headers.get('If-None-Match') == ETAG:
+                    self._send(304, b'', {'ETag': ETAG})
+                else:
+                    self._send(200, SMALL_BODY, {'ETag': ETAG})
+            elif '/moved' == path:
+                self._send(302, b'', {'Location': '/large'})
+            else:
+                self._send(200, SMALL_BODY)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.paths = []
+        self.proxy_auths = []
+        self.active = 0
+        self.max_active = 0
+
+class BlockResponse(object):
+    # gives some blocks of the body, then ends it or fails as a dropped connection
+    def __init__(self, block, count, broken):
+        self.blocks = [block] * count
+        self.broken = broken
+
+    def read(self, size):
+        if self.blocks:
+            return self.blocks.pop()
+        if self.broken:
+            raise IOError('connection reset')
+        return b''
+
+class MediaFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+        self.fetched = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for fetched in self.fetched:
+            if fetched is not None:
+                fetched.discard()
+
+    def _fetch(self, fetcher, path, headers=None):
+        fetched = fetcher.fetch(self.base_url + path, headers)
+        self.fetched.append(fetched)
+        return fetched
+
+    def test_host_concurrency(self):
+        fetcher = MediaFetcher(connections=8, host_connections=2, proxies={})
+        results = []
+        def fetch_slow():
+            results.append(self._fetch(fetcher, '/slow'))
+        threads = [threading.Thread(target=fetch_slow) for rank in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(6, len([fetched for fetched in results if fetched and (fetched.data == SMALL_BODY)]))
+        self.assertEqual(2, self.server.max_active)
+
+    def test_host_rate(self):
+        fetcher = MediaFetcher(proxies={})
+        self.assertTrue(fetcher.set_host_limits(1, 10))
+        self.assertFalse(fetcher.set_host_limits(0, None))
+        start = time.time()
+        for rank in range(3):
+            self.assertEqual(200, self._fetch(fetcher, '/').status)
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_not_modified(self):
+        fetcher = MediaFetcher(proxies={})
+        fetched = self._fetch(fetcher, '/tagged')
+        self.assertEqual(200, fetched.status)
+        self.assertEqual(ETAG, fetched.get_header('ETag'))
+
+        fetched = self._fetch(fetcher, '/tagged', {'If-None-Match': ETAG})
+        self.assertEqual(304, fetched.status)
+        self.assertFalse(fetched.data)
+        self.assertEqual(None, fetched.path)
+
+    def test_memory_limit(self):
+        fetcher = MediaFetcher(memory_limit=1000, proxies={})
+        fetched = self._fetch(fetcher, '/')
+        self.assertEqual(SMALL_BODY, fetched.data)
+        self.assertEqual(None, fetched.path)
+
+        fetched = self._fetch(fetcher, '/moved')
+        self.assertEqual(None, fetched.data)
+        self.assertTrue(os.path.isfile(fetched.path))
+        with open(fetched.path, 'rb') as local_file:
+            self.assertEqual(LARGE_BODY, local_file.read())
+
+    def test_broken_spill(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fetcher = MediaFetcher(memory_limit=1000, proxies={})
+            self.assertRaises(IOError, fetcher._read_body, BlockResponse(SMALL_BODY, 15, True), tmp_dir)
+            self.assertEqual([], os.listdir(tmp_dir))
+
+            data, path = fetcher._read_body(BlockResponse(SMALL_BODY, 15, False), tmp_dir)
+            self.assertEqual(None, data)
+            with open(path, 'rb') as spilled:
+                self.assertEqual(SMALL_BODY * 15, spilled.read())
+            self.assertEqual([os.path.basename(path)], os.listdir(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_proxy(self):
+        # the stand-in takes the absolute urls, as a proxy
+        saved_bypass = os.environ.pop('no_proxy', None)
+        try:
+            fetcher = MediaFetcher(proxies={'http': 'http://user:pass@' + self.base_url[len('http://'):]})
+            fetched = fetcher.fetch('http://media.test/large')
+            self.fetched.append(fetched)
+        finally:
+            if saved_bypass is not None:
+                os.environ['no_proxy'] = saved_bypass
+        self.assertEqual(LARGE_BODY, fetched.data)
+        self.assertEqual(['http://media.test/large'], self.server.paths)
+        self.assertEqual(['Basic dXNlcjpwYXNz'], self.server.proxy_auths)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the hash cache keys: hashes made by other hash methods or dimensions are not taken
+#
+
+import unittest
+from mediasearch.utils.dbs import mongo_dbs
+from mediasearch.algs.methods import MediaHashMethods
+from mediasearch.plugin.hashcache import HashCache, COLLECTION_HASH_CACHE
+from stand_in_db import connect_any
+
+DIGEST = 'a' * 40
+MEDIA_URL = 'http://example.com/m.jpg'
+PACKED_HASHES = [{'method': 'image_dhash', 'dim': 8, 'packed': b'\x01' * 8}]
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_any()
+        if self.db_holder is None:
+            self.skipTest('neither MongoDB nor mongomock is available')
+        self.saved_db = mongo_dbs.get_db()
+        mongo_dbs.set_db(self.db_holder)
+
+    def tearDown(self):
+        mongo_dbs.set_db(self.saved_db)
+        self.db_holder.drop()
+
+    def test_default(self):
+        hash_methods_holder = MediaHashMethods()
+        fingerprint = hash_methods_holder.get_fingerprint()
+        self.assertEqual(fingerprint, HashCache().get_fingerprint())
+
+        hash_methods_holder.get_methods()['image_dhash']['dims'].append(16)
+        self.assertNotEqual(fingerprint, hash_methods_holder.get_fingerprint())
+
+    def test_other_methods(self):
+        former = HashCache()
+        former.set_fingerprint('former')
+        self.assertTrue(former.put(DIGEST, PACKED_HASHES))
+        self.assertTrue(former.put_url(MEDIA_URL, DIGEST, 'etag', None))
+        self.assertEqual(PACKED_HASHES, former.get(DIGEST))
+
+        # another process, with other hash methods, on the same collection
+        current = HashCache()
+        current.set_fingerprint('current')
+        self.assertEqual(None, current.get(DIGEST))
+        self.assertEqual(None, current.get_url(MEDIA_URL))
+
+        current.set_fingerprint('former')
+        self.assertEqual(PACKED_HASHES, current.get(DIGEST))
+        self.assertEqual(DIGEST, current.get_url(MEDIA_URL)['digest'])
+        self.assertEqual(2, self.db_holder.db[COLLECTION_HASH_CACHE].find().count())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the hash index engines: the multi-index finds what the linear scan does, and serves just the radii it prunes
+#
+
+import random, datetime, unittest
+from mediasearch.algs.hashindex import FeedHashes, ENGINE_LINEAR, ENGINE_MIH, MIH_MAX_SHARE, hash_key, packed_to_words
+from mediasearch.algs.mihash import chunk_bounds_for, candidate_share
+
+ITEM_COUNT = 2000
+QUERY_COUNT = 40
+START_TIME = datetime.datetime(2020, 1, 1)
+
+def random_packed(rnd, bits):
+    return bytes(bytearray([rnd.randint(0, 255) for i in range(bits // 8)]))
+
+def flip_packed(rnd, packed, flips):
+    data = bytearray(packed)
+    for bit in rnd.sample(range(len(data) * 8), flips):
+        data[bit // 8] ^= (1 << (bit % 8))
+    return bytes(data)
+
+class MultiIndexTest(unittest.TestCase):
+    def _feeds(self, stored, dim):
+        feeds = {}
+        for engine in [ENGINE_LINEAR, ENGINE_MIH]:
+            feeds[engine] = FeedHashes(None, engine)
+            for rank, packed in enumerate(stored):
+                feeds[engine].append('m%05d' % (rank,), START_TIME + datetime.timedelta(seconds=rank), [{'method': 'phash', 'dim': dim, 'packed': packed}])
+        return feeds
+
+    def _found(self, feed_hashes, dim, packed, radius):
+        start, stop = feed_hashes.window(None, None)
+        refs, distances = feed_hashes.search('phash', dim, packed_to_words(packed), radius, start, stop)
+        return sorted(zip(refs, [int(one_distance) for one_distance in distances]))
+
+    def test_chunking(self):
+        # at most MAX_CHUNK_RADIUS probed per substring, and the default lims of a quarter of the bits not pruned
+        for bits, radius in [(64, 4), (64, 10), (64, 16), (256, 24), (256, 64)]:
+            bounds = chunk_bounds_for(bits, radius)
+            self.assertEqual(bits, sum([one_bound[1] for one_bound in bounds]))
+            self.assertTrue((radius // len(bounds)) <= 2, (bits, radius))
+        self.assertTrue(candidate_share(chunk_bounds_for(64, 8), 8) <= MIH_MAX_SHARE)
+        self.assertTrue(candidate_share(chunk_bounds_for(64, 16), 16) > MIH_MAX_SHARE)
+        self.assertTrue(candidate_share(chunk_bounds_for(256, 64), 64) > MIH_MAX_SHARE)
+
+    def test_engines(self):
+        rnd = random.Random(3)
+        for dim, radii in [(8, [4, 8, 16]), (16, [24, 64])]:
+            bits = dim * dim
+            stored = [random_packed(rnd, bits) for rank in range(ITEM_COUNT)]
+            feeds = self._feeds(stored, dim)
+            for radius in radii:
+                for rank in range(QUERY_COUNT):
+                    packed = flip_packed(rnd, stored[rnd.randint(0, ITEM_COUNT - 1)], rnd.randint(0, radius))
+                    self.assertEqual(self._found(feeds[ENGINE_LINEAR], dim, packed, radius), self._found(feeds[ENGINE_MIH], dim, packed, radius), (dim, radius))
+
+                # the multi-index serves just the prunable radii, the others are scanned
+                pruned = candidate_share(chunk_bounds_for(bits, radius), radius) <= MIH_MAX_SHARE
+                self.assertEqual(pruned, feeds[ENGINE_MIH]._searcher(hash_key('phash', dim), radius) is not None, (dim, radius))
+
+            for feed_hashes in feeds.values():
+                feed_hashes.remove('m00007')
+                feed_hashes.append('m99999', START_TIME + datetime.timedelta(seconds=ITEM_COUNT), [{'method': 'phash', 'dim': dim, 'packed': flip_packed(rnd, stored[7], 1)}])
+            for radius in radii:
+                found = self._found(feeds[ENGINE_MIH], dim, stored[7], radius)
+                self.assertEqual(self._found(feeds[ENGINE_LINEAR], dim, stored[7], radius), found)
+                self.assertTrue(('m99999', 1) in found)
+                self.assertFalse('m00007' in [one_found[0] for one_found in found])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the image hash encodings: the packed ones give the values of the former per-bit loops,
+# and the batched hashes the bits of the per-image ones
+#
+
+import unittest
+import numpy
+import Image
+from mediasearch.algs.imagehash import ImageHash, binary_array_to_hex, binary_array_to_int, hex_to_hash
+from mediasearch.algs.imagehash import phash, dhash, phash_batch, dhash_batch, packed_to_hex
+
+SHAPES = [(8, 8), (16, 16), (32, 32), (9, 9), (3, 5), (1, 7), (1, 12)]
+ARRAYS_PER_SHAPE = 20
+
+def loop_to_hex(arr):
+    # the former per-bit encoding
+    h = 0
+    s = []
+    for i,v in enumerate(arr.flatten()):
+        if v: h += 2**(i % 8)
+        if (i % 8) == 7:
+            s.append(hex(h)[2:].rjust(2, '0'))
+            h = 0
+    return "".join(s)
+
+def loop_from_hex(hexstr):
+    l = []
+    for i in range(len(hexstr) // 2):
+        v = int("0x" + hexstr[i*2:i*2+2], 16)
+        for j in range(8):
+            l.append(v & 2**j > 0)
+    return numpy.array(l)
+
+def loop_to_int(arr):
+    return sum([2**(i % 8) for i,v in enumerate(arr.flatten()) if v])
+
+class EncodingsTest(unittest.TestCase):
+    def _arrays(self, shape):
+        rnd = numpy.random.RandomState(shape[0] * 100 + shape[1])
+        arrays = [numpy.zeros(shape, dtype=bool), numpy.ones(shape, dtype=bool)]
+        for rank in range(ARRAYS_PER_SHAPE):
+            arrays.append(rnd.rand(*shape) > 0.5)
+        return arrays
+
+    def test_hex(self):
+        for shape in SHAPES:
+            for arr in self._arrays(shape):
+                hexstr = binary_array_to_hex(arr)
+                self.assertEqual(loop_to_hex(arr), hexstr, shape)
+                self.assertEqual(str, type(hexstr))
+                self.assertTrue(numpy.array_equal(loop_from_hex(hexstr), hex_to_hash(hexstr).hash), shape)
+
+    def test_int(self):
+        for shape in SHAPES:
+            for arr in self._arrays(shape):
+                self.assertEqual(loop_to_int(arr), binary_array_to_int(arr), shape)
+                self.assertEqual(loop_to_int(arr), hash(ImageHash(arr)), shape)
+
+    def test_odd_hex(self):
+        # a trailing odd digit is dropped, as the former decoding did
+        self.assertTrue(numpy.array_equal(loop_from_hex('a5f'), hex_to_hash('a5f').hash))
+        self.assertEqual(0, len(hex_to_hash('').hash))
+
+    def test_changed_hash(self):
+        arr = numpy.zeros((8, 8), dtype=bool)
+        image_hash = ImageHash(arr)
+        self.assertEqual(0, hash(image_hash))
+        arr[0, 3] = True
+        self.assertEqual(8, hash(image_hash))
+        image_hash.hash = numpy.ones((8, 8), dtype=bool)
+        self.assertEqual(8 * 255, hash(image_hash))
+
+class BatchTest(unittest.TestCase):
+    def _images(self):
+        # smoothed noise of various sizes and modes, some smaller than the hashed sizes
+        rnd = numpy.random.RandomState(3)
+        images = []
+        for rank in range(12):
+            width, height = rnd.randint(8, 300), rnd.randint(8, 300)
+            image = Image.fromarray((rnd.rand(height, width, 3) * 255).astype(numpy.uint8))
+            image = image.resize((width // 3 + 1, height // 3 + 1)).resize((width, height))
+            if rank % 3:
+                image = image.convert('L')
+            images.append(image)
+        return images
+
+    def test_parity(self):
+        images = self._images()
+        for dim in [4, 8, 16]:
+            for single, batch in [(phash, phash_batch), (dhash, dhash_batch)]:
+                packed = batch(images, dim)
+                self.assertEqual((len(images), dim * dim // 8), packed.shape)
+                for rank, image in enumerate(images):
+                    self.assertEqual(binary_array_to_hex(single(image, dim).hash), packed_to_hex(packed[rank]), (single.__name__, dim, rank))
+
+    def test_wrong_sizes(self):
+        self.assertEqual(None, phash_batch(self._images(), 1))
+        self.assertEqual(None, dhash_batch(self._images(), '8'))
+
+if __name__ == '__main__':
+    unittest.main()
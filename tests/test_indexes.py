@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the index checks: query plans of the explain() formats, verified against a MongoDB server
+#
+
+import unittest
+from mediasearch.utils.indexes import StorageIndexes, explain_plan, index_name
+from mediasearch.plugin.storage import HashStorage, storage_layouts, MEDIA_INDEXES, LAYOUT_EMBEDDED, LAYOUT_EDGES
+from stand_in_db import connect_mongodb
+
+CREATED_INDEX = 'feed_1_created_on_-1__id_1'
+REF_INDEX = 'feed_1__id_1'
+TAGGED_INDEX = 'feed_1_tags_1_created_on_-1__id_1'
+
+class ExplainPlanTest(unittest.TestCase):
+    def test_index_name(self):
+        self.assertEqual(CREATED_INDEX, index_name(MEDIA_INDEXES[0]))
+        self.assertEqual(REF_INDEX, index_name(MEDIA_INDEXES[2]))
+
+    def test_legacy_format(self):
+        # as of MongoDB 2.6 and before
+        explained = {'cursor': 'BasicCursor', 'isMultiKey': False, 'n': 3, 'scanAndOrder': False, 'indexBounds': {}}
+        self.assertEqual({'indexes': [], 'sorted': False}, explain_plan(explained))
+
+        explained = {'cursor': 'BtreeCursor ' + CREATED_INDEX, 'n': 3, 'scanAndOrder': False, 'indexBounds': {'feed': [['default', 'default']]}}
+        self.assertEqual({'indexes': [CREATED_INDEX], 'sorted': False}, explain_plan(explained))
+
+        explained = {'cursor': 'BtreeCursor ' + REF_INDEX + ' reverse', 'n': 3, 'scanAndOrder': True}
+        self.assertEqual({'indexes': [REF_INDEX], 'sorted': True}, explain_plan(explained))
+
+    def test_collection_scan(self):
+        explained = {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN', 'filter': {'feed': {'$eq': 'default'}}, 'direction': 'forward'}, 'rejectedPlans': []}}
+        self.assertEqual({'indexes': [], 'sorted': False}, explain_plan(explained))
+
+    def test_fetched_index_scan(self):
+        winning = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'keyPattern': {'feed': 1, 'created_on': -1, '_id': 1}, 'indexName': CREATED_INDEX, 'direction': 'forward'}}
+        rejected = [{'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': REF_INDEX}}]
+        explained = {'queryPlanner': {'winningPlan': winning, 'rejectedPlans': rejected}}
+        self.assertEqual({'indexes': [CREATED_INDEX], 'sorted': False}, explain_plan(explained))
+
+    def test_sorted_index_scan(self):
+        # 3.x puts a key generator between the sort and the fetch, 4.x does not
+        fetched = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': REF_INDEX}}
+        winning = {'stage': 'SORT', 'sortPattern': {'created_on': -1}, 'inputStage': {'stage': 'SORT_KEY_GENERATOR', 'inputStage': fetched}}
+        self.assertEqual({'indexes': [REF_INDEX], 'sorted': True}, explain_plan({'queryPlanner': {'winningPlan': winning}}))
+
+        winning = {'stage': 'SORT', 'sortPattern': {'created_on': -1}, 'inputStage': fetched}
+        self.assertEqual({'indexes': [REF_INDEX], 'sorted': True}, explain_plan({'queryPlanner': {'winningPlan': winning}}))
+
+    def test_merged_index_scans(self):
+        winning = {'stage': 'FETCH', 'inputStage': {'stage': 'OR', 'inputStages': [
+            {'stage': 'IXSCAN', 'indexName': TAGGED_INDEX},
+            {'stage': 'IXSCAN', 'indexName': CREATED_INDEX},
+            {'stage': 'IXSCAN', 'indexName': TAGGED_INDEX}
+        ]}}
+        self.assertEqual(set([TAGGED_INDEX, CREATED_INDEX]), set(explain_plan({'queryPlanner': {'winningPlan': winning}})['indexes']))
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_mongodb()
+        if self.db_holder is None:
+            self.skipTest('no MongoDB server is reachable')
+
+    def tearDown(self):
+        self.db_holder.drop()
+
+    def test_verify(self):
+        saved_layout = storage_layouts.get_new_layout()
+        try:
+            for layout in [LAYOUT_EMBEDDED, LAYOUT_EDGES]:
+                storage_layouts.set_new_layout(layout)
+                storage = HashStorage(self.db_holder)
+                self.assertTrue(storage.set_storage('prov', layout, True))
+        finally:
+            storage_layouts.set_new_layout(saved_layout)
+
+        indexes = StorageIndexes(background=False)
+        self.assertTrue(indexes.ensure_all(self.db_holder.db))
+
+        results = indexes.verify(self.db_holder.db)
+        checked = set([(one_result['collection'], one_result['query']) for one_result in results])
+        self.assertTrue(('storage_1', 'tagged') in checked)
+        self.assertTrue(('storage_2_edges', 'alike') in checked)
+        self.assertFalse(('storage_1_edges', 'alike') in checked)
+        for one_result in results:
+            self.assertTrue(one_result['ok'], one_result)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the insert job leases: a job taken over from an expired claim is not touched by its former worker
+#
+
+import datetime, unittest
+from mediasearch.utils.dbs import mongo_dbs
+from mediasearch.plugin.jobs import InsertJobs, COLLECTION_JOBS, JOB_CLAIM_TIMEOUT, STATE_RUNNING, STATE_DONE, STATE_FAILED
+from stand_in_db import connect_any
+
+class JobLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_any()
+        if self.db_holder is None:
+            self.skipTest('neither MongoDB nor mongomock is available')
+        self.saved_db = mongo_dbs.get_db()
+        mongo_dbs.set_db(self.db_holder)
+
+    def tearDown(self):
+        mongo_dbs.set_db(self.saved_db)
+        self.db_holder.drop()
+
+    def _expire(self, job):
+        # as when the worker last renewed the lease longer than the timeout ago
+        expired_on = datetime.datetime.utcnow() - datetime.timedelta(seconds=JOB_CLAIM_TIMEOUT + 1)
+        expired_on = expired_on.replace(microsecond=(expired_on.microsecond // 1000 * 1000))
+        self.db_holder.db[COLLECTION_JOBS].update({'_id': job['_id']}, {'$set': {'claimed_on': expired_on}})
+        job['claimed_on'] = expired_on
+
+    def test_taken_over(self):
+        jobs = InsertJobs(0)
+        queued = jobs.queue_job('prov', 'arch', {'ref': 'm00'}, False, None)
+        former = jobs.claim_job()
+        self.assertEqual(queued['_id'], former['_id'])
+        self.assertTrue(jobs.set_stage(former, 'fetch'))
+        self.assertEqual('fetch', former['stage'])
+
+        self._expire(former)
+        current = jobs.claim_job()
+        self.assertEqual(queued['_id'], current['_id'])
+        self.assertEqual(2, current['attempts'])
+
+        self.assertFalse(jobs.set_stage(former, 'hash'))
+        self.assertFalse(jobs.finish_job(former, STATE_FAILED, 'fetch'))
+        stored = self.db_holder.db[COLLECTION_JOBS].find_one({'_id': queued['_id']})
+        self.assertEqual(STATE_RUNNING, stored['state'])
+        self.assertEqual('fetch', stored['stage'])
+
+        self.assertTrue(jobs.set_stage(current, 'store'))
+        self.assertTrue(jobs.finish_job(current, STATE_DONE))
+        stored = self.db_holder.db[COLLECTION_JOBS].find_one({'_id': queued['_id']})
+        self.assertEqual(STATE_DONE, stored['state'])
+        self.assertEqual(None, jobs.claim_job())
+
+if __name__ == '__main__':
+    unittest.main()
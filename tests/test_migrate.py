@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the links migration: servers holding the archive as embedded keep reading its links
+#
+
+import datetime, unittest
+from mediasearch.plugin.storage import HashStorage, COLLECTION_GENERAL, LAYOUT_SWITCHED_FIELD, LAYOUT_SWITCH_TIME, LAYOUT_EMBEDDED, LAYOUT_EDGES
+from stand_in_db import connect_any
+from test_alike import make_archive, dump
+
+class EdgesMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_any()
+        if self.db_holder is None:
+            self.skipTest('neither MongoDB nor mongomock is available')
+
+    def tearDown(self):
+        self.db_holder.drop()
+
+    def _listing(self, storage):
+        return dump([storage.get_alike_media([one_ref])['items'] for one_ref in ['m03', 'm05', 'm11']])
+
+    def _linked_count(self, storage):
+        return self.db_holder.db[storage.get_collection_name()].find({'alike.0': {'$exists': True}}).count()
+
+    def test_settled_switch(self):
+        storage = make_archive(self.db_holder, LAYOUT_EMBEDDED)
+        listed = self._listing(storage)
+        linked = self._linked_count(storage)
+        self.assertTrue(linked)
+
+        # a server process with the archive still cached as embedded
+        stale = HashStorage(self.db_holder)
+        stale.set_storage('prov', LAYOUT_EMBEDDED, False)
+
+        migrating = HashStorage(self.db_holder)
+        migrating.set_storage('prov', LAYOUT_EMBEDDED, False)
+        self.assertEqual(linked, migrating.convert_links_to_edges(5))
+        self.assertEqual(LAYOUT_EDGES, migrating.get_layout())
+        self.assertEqual(linked, migrating.convert_links_to_edges(5))
+
+        self.assertEqual(LAYOUT_EMBEDDED, stale.get_layout())
+        self.assertEqual(linked, self._linked_count(storage))
+        self.assertEqual(listed, self._listing(stale))
+        self.assertEqual(listed, self._listing(migrating))
+
+        # links written by the stale server are taken by the run after the switch has settled
+        stale.append_alike_links('m15', [{'ref': 'm03', 'evals': [{'method': 'dhash', 'dim': 8, 'diff': 0, 'dist': 0.0}]}])
+        settled_on = datetime.datetime.utcnow() - datetime.timedelta(seconds=LAYOUT_SWITCH_TIME + 1)
+        self.db_holder.db[COLLECTION_GENERAL].update({'_id': migrating.collection_rank}, {'$set': {LAYOUT_SWITCHED_FIELD: settled_on}})
+        self.assertTrue(migrating.convert_links_to_edges(5))
+        self.assertEqual(0, self._linked_count(storage))
+
+        listed = dict([(one_item['ref'], one_item['evals']) for one_item in migrating.get_alike_media(['m03'])['items']])
+        self.assertEqual(0.0, listed['m15'][0]['dist'])
+        self.assertTrue(migrating.is_correct())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Mediasearch
+# Tests of the archive ranks: a removed archive's rank, possibly cached by other processes, is not given again
+#
+
+import datetime, unittest
+from mediasearch.plugin.storage import HashStorage, archive_cache, COLLECTION_GENERAL, COLLECTION_RANKS, LAST_RANK_FIELD
+from stand_in_db import connect_any
+
+class RankSequenceTest(unittest.TestCase):
+    def setUp(self):
+        self.db_holder = connect_any()
+        if self.db_holder is None:
+            self.skipTest('neither MongoDB nor mongomock is available')
+        archive_cache.clear()
+
+    def tearDown(self):
+        archive_cache.clear()
+        self.db_holder.drop()
+
+    def _create(self, archive):
+        storage = HashStorage(self.db_holder)
+        self.assertTrue(storage.set_storage('prov', archive, True))
+        return storage
+
+    def test_removed_top(self):
+        self.assertEqual(1, self._create('a1').collection_rank)
+        dropped = self._create('a2')
+        self.assertEqual(2, dropped.collection_rank)
+
+        # another process still holds the dropped archive cached
+        cached = archive_cache.get(dropped._archive_key())
+        self.assertTrue(dropped.drop_provider_archive(True))
+        archive_cache.put(dropped._archive_key(), cached)
+
+        self.assertEqual(3, self._create('a3').collection_rank)
+        stale = HashStorage(self.db_holder)
+        self.assertTrue(stale.set_storage('prov', 'a2', False))
+        self.assertEqual(2, stale.collection_rank)
+        self.assertEqual(0, self.db_holder.db[stale.get_collection_name()].find().count())
+
+    def test_former_archives(self):
+        # archives made before the sequence keep their ranks, new ones are put above them
+        timepoint = datetime.datetime.utcnow()
+        for rank in [1, 5]:
+            self.db_holder.db[COLLECTION_GENERAL].save({'_id': rank, 'provider': 'prov', 'archive': 'f%d' % (rank,), 'created_on': timepoint, 'updated_on': timepoint})
+
+        self.assertEqual(6, self._create('a6').collection_rank)
+        self.assertEqual(7, self._create('a7').collection_rank)
+        self.assertEqual(7, self.db_holder.db[COLLECTION_RANKS].find_one({'_id': COLLECTION_GENERAL})[LAST_RANK_FIELD])
+
+if __name__ == '__main__':
+    unittest.main()